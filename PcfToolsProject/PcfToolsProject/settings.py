@@ -11,21 +11,46 @@ https://docs.djangoproject.com/en/2.0/ref/settings/
 """
 
 import os
+import tempfile
+
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
+def env(name, default=None):
+    """ Return the environment variable PCFTOOLS_<name>, or default if it is not set """
+    return os.environ.get('PCFTOOLS_' + name, default)
+
+
+def env_bool(name, default):
+    value = env(name)
+    return default if value is None else value.lower() in ('1', 'true', 'yes', 'on')
+
+
+# Settings profile: "development" (default) or "production", which turns debug off, requires PCFTOOLS_SECRET_KEY
+# and PCFTOOLS_ALLOWED_HOSTS, keeps the database connections open and tunes SQLite (see DATABASES)
+PROFILE = env('PROFILE', 'development')
+if PROFILE not in ('development', 'production'):
+    raise ImproperlyConfigured("PCFTOOLS_PROFILE must be development or production, not %s" % (PROFILE))
+PRODUCTION = PROFILE == 'production'
+
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/2.0/howto/deployment/checklist/
 
 # SECURITY WARNING: keep the secret key used in production secret!
-SECRET_KEY = '(oo22dl+3@*5=uip31j@bm2zbjnwgxh-kmtqs1mr+ur&nj!nth'
+SECRET_KEY = env('SECRET_KEY')
+if SECRET_KEY is None:
+    if PRODUCTION:
+        raise ImproperlyConfigured("PCFTOOLS_SECRET_KEY is required by the production profile")
+    SECRET_KEY = '(oo22dl+3@*5=uip31j@bm2zbjnwgxh-kmtqs1mr+ur&nj!nth'
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+DEBUG = env_bool('DEBUG', not PRODUCTION)
 
-ALLOWED_HOSTS = ['127.0.0.1']
+ALLOWED_HOSTS = [host.strip() for host in env('ALLOWED_HOSTS', "127.0.0.1").split(",") if host.strip()]
 
 
 # Application definition
@@ -38,11 +63,11 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'debug_toolbar',
-    'banklinemanager',
+    'banklinemanager.apps.BanklinemanagerConfig',
 ]
 
 MIDDLEWARE = [
+    'banklinemanager.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -50,10 +75,15 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'debug_toolbar.middleware.DebugToolbarMiddleware',
     'django.middleware.locale.LocaleMiddleware',
 ]
 
+# debug_toolbar costs time on every request and is not needed (nor maybe installed) in production
+if DEBUG:
+    INSTALLED_APPS.insert(INSTALLED_APPS.index('banklinemanager.apps.BanklinemanagerConfig'), 'debug_toolbar')
+    MIDDLEWARE.insert(MIDDLEWARE.index('django.middleware.locale.LocaleMiddleware'),
+                      'debug_toolbar.middleware.DebugToolbarMiddleware')
+
 ROOT_URLCONF = 'PcfToolsProject.urls'
 
 TEMPLATES = [
@@ -78,12 +108,45 @@ WSGI_APPLICATION = 'PcfToolsProject.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/2.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+# PCFTOOLS_DB_ENGINE selects SQLite (default) or PostgreSQL (needs psycopg2, and a user allowed to create the
+# pg_trgm extension or a database where it exists). The tests run on the database selected, e.g.
+# PCFTOOLS_DB_ENGINE=postgresql PCFTOOLS_DB_NAME=pcftools python manage.py test banklinemanager
+DB_ENGINE = env('DB_ENGINE', 'sqlite')
+if DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': env('DB_NAME', 'pcftools'),
+            'USER': env('DB_USER', ""),
+            'PASSWORD': env('DB_PASSWORD', ""),
+            'HOST': env('DB_HOST', ""),
+            'PORT': env('DB_PORT', ""),
+        }
     }
-}
+elif DB_ENGINE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': env('DB_NAME', os.path.join(BASE_DIR, 'db.sqlite3')),
+            # seconds a writer waits for the lock of another one before "database is locked"
+            'OPTIONS': {'timeout': 20} if PRODUCTION else {},
+        }
+    }
+else:
+    raise ImproperlyConfigured("PCFTOOLS_DB_ENGINE must be sqlite or postgresql, not %s" % (DB_ENGINE))
+# Seconds a connection is kept open for the next requests of its thread (0 closes it after each request)
+DATABASES['default']['CONN_MAX_AGE'] = int(env('CONN_MAX_AGE', 600 if PRODUCTION else 0))
+
+# Pragmas run on each new SQLite connection (see banklinemanager/database.py). The write-ahead log lets the
+# searches read while an import writes, instead of waiting for the writer lock; with it, synchronous=NORMAL
+# is safe and a commit no longer waits for the disk. The database file is memory mapped (256 MB) and each
+# connection caches 64 MB of pages (a negative cache_size is in KB).
+BANKLINE_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,
+} if env_bool('SQLITE_TUNING', PRODUCTION) else {}
 
 
 # Password validation
@@ -126,6 +189,33 @@ STATIC_URL = '/static/'
 
 INTERNAL_IPS = ['127.0.0.1']
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # shared by the web server and the import_datafiles command, which both invalidate it
+    'search': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'pcftools_search_cache'),
+    },
+}
+
+# Cache of the search results, invalidated by imports (see banklinemanager/search_cache.py)
+BANKLINE_SEARCH_CACHE = 'search'
+BANKLINE_SEARCH_CACHE_TIMEOUT = 600
+
+# Number of threads importing the uploaded datafiles in background (0 imports during the upload request)
+BANKLINE_IMPORT_WORKERS = 2
+# Number of processes normalizing and validating the lines of the datafiles of several batches, shared by the
+# imports (see banklinemanager/importers.py). 0 validates in the importing thread; on a server with spare CPU
+# cores, e.g. PCFTOOLS_VALIDATION_WORKERS=3 for 4 cores
+BANKLINE_VALIDATION_WORKERS = int(env('VALIDATION_WORKERS', 0))
+
+# Requests slower than this (in ms) are logged as warnings with their slowest SQL queries, and the number of
+# requests, slow requests and imports kept by the stats view (see banklinemanager/instrumentation.py)
+BANKLINE_SLOW_REQUEST_MS = 1000
+BANKLINE_INSTRUMENTATION_HISTORY = 200
+
 # Redirect to home URL after login or logout (Default redirects to /accounts/profile/)
 LOGIN_REDIRECT_URL = '/banklinemanager/'
 LOGOUT_REDIRECT_URL = '/banklinemanager/'
\ No newline at end of file
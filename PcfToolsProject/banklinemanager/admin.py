@@ -1,17 +1,40 @@
 from django.contrib import admin
 
-from .models import Bank, BankLine
+from .models import Bank, BankCsvFormat, BankLine, Category, CategoryRule, ImportedFile
+from .search_cache import invalidate_banklines
 
 """ Class BankeAdmin """
+class BankCsvFormatInline(admin.StackedInline):
+    model = BankCsvFormat
+    extra = 0
+
 @admin.register(Bank)
 class BankAdmin(admin.ModelAdmin):
     search_fields = ['name']
+    inlines = [BankCsvFormatInline]
+
+""" Class ImportedFileAdmin """
+@admin.register(ImportedFile)
+class ImportedFileAdmin(admin.ModelAdmin):
+    list_display = ['file_name', 'bank', 'imported_at', 'date_start', 'date_end', 'line_counter', 'inserted_line_counter']
+    list_filter = ['bank']
+    search_fields = ['file_name', 'sha256']
+
+""" Class CategoryAdmin """
+class CategoryRuleInline(admin.TabularInline):
+    model = CategoryRule
+    extra = 1
+
+@admin.register(Category)
+class CategoryAdmin(admin.ModelAdmin):
+    search_fields = ['name']
+    inlines = [CategoryRuleInline]
 
 """ Class BankLineAdmin """
 @admin.register(BankLine)
 class BankLineAdmin(admin.ModelAdmin):
-	list_display = ["transaction_date", "wording", "transaction_number", "debit", "credit", "bank_detail", "bank", "user_comment"]
-	list_filter = ['transaction_date']
+	list_display = ["transaction_date", "wording", "transaction_number", "debit", "credit", "bank_detail", "bank", "category", "user_comment"]
+	list_filter = ['transaction_date', 'category']
 	search_fields = ['wording', 'bank_detail', 'user_comment']
 	readonly_fields = ["transaction_date", "wording", "transaction_number", "debit", "credit", "bank_detail", "bank"]
 	#fields = ["user_comment"]
@@ -19,4 +42,13 @@ class BankLineAdmin(admin.ModelAdmin):
 	def has_add_permission(self, request):
 		return False
 
+	def delete_model(self, request, obj):
+		super().delete_model(request, obj)
+		invalidate_banklines([obj])
+
+	def delete_queryset(self, request, queryset):
+		banklines = list(queryset.only('bank', 'transaction_date'))
+		super().delete_queryset(request, queryset)
+		invalidate_banklines(banklines)
+
         
\ No newline at end of file
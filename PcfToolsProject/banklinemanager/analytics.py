@@ -0,0 +1,197 @@
+''' Cash-flow statistics of each bank computed with NumPy: running balance, monthly totals and averages,
+largest outflows and a forecast of the next months.
+
+The lines are read with values_list by chunks of ANALYTICS_CHUNK_SIZE into columnar arrays (id, date, debit and
+credit in cents, bank), then sorted once by bank and date. Every statistic of a bank is then computed on slices
+of these arrays (cumulative sums, reduceat over the days or months, argpartition), without a Python loop over
+the lines. The cost of reading the lines from the database is far larger than the statistics themselves.
+NumPy is optional: analytics_available() is False without it and the view and command report an error. '''
+import datetime
+import itertools
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from django.db.models import CharField, FloatField
+from django.db.models.functions import Cast
+
+from .models import Bank, BankLine
+
+
+# Number of lines read from the database and converted to arrays at a time
+ANALYTICS_CHUNK_SIZE = 100000
+LARGEST_OUTFLOWS = 10
+FORECAST_MONTHS = 3
+# Number of the last months whose net flows are extrapolated by the forecast
+FORECAST_HISTORY_MONTHS = 12
+
+
+def analytics_available():
+    return np is not None
+
+
+class BankLineColumns:
+    ''' Columns of bank lines as NumPy arrays of the same length, sorted by bank then date: pk, day
+    (datetime64[D]), debit and credit (int64 cents, debit negative) and bank (bank id). '''
+    def __init__(self, pk, day, debit, credit, bank):
+        # one sort of a single integer key, faster than a lexsort of the two columns (the order of the lines
+        # of a same day does not matter)
+        order = np.argsort((bank << 32) + day.astype(np.int64))
+        self.pk = pk[order]
+        self.day = day[order]
+        self.debit = debit[order]
+        self.credit = credit[order]
+        self.bank = bank[order]
+
+    def __len__(self):
+        return len(self.pk)
+
+    @classmethod
+    def from_queryset(cls, banklines, chunk_size=ANALYTICS_CHUNK_SIZE):
+        ''' Read the banklines queryset by chunks of chunk_size rows into columns. '''
+        # read as text and floats, parsed by NumPy, instead of date and Decimal objects built for each row
+        rows = banklines.order_by().annotate(
+            day=Cast('transaction_date', CharField()), debit_float=Cast('debit', FloatField()),
+            credit_float=Cast('credit', FloatField()),
+        ).values_list('pk', 'day', 'debit_float', 'credit_float', 'bank_id').iterator(chunk_size=chunk_size)
+        chunks = []
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            pk, day, debit, credit, bank = zip(*chunk)
+            chunks.append((np.array(pk, dtype=np.int64), np.array(day, dtype='datetime64[D]'),
+                           _cents(debit), _cents(credit), np.array(bank, dtype=np.int64)))
+        if not chunks:
+            return cls(np.zeros(0, np.int64), np.zeros(0, 'datetime64[D]'), np.zeros(0, np.int64),
+                       np.zeros(0, np.int64), np.zeros(0, np.int64))
+        return cls(*(np.concatenate(column) for column in zip(*chunks)))
+
+    def banks(self):
+        ''' Yield (bank id, slice of the lines of this bank). '''
+        starts = _group_starts(self.bank)
+        ends = list(starts[1:]) + [len(self)]
+        for start, end in zip(starts, ends):
+            yield int(self.bank[start]), slice(start, end)
+
+
+def _cents(amounts):
+    ''' Return the amounts (floats or None) as an int64 array of cents. '''
+    return np.rint(np.array([amount or 0 for amount in amounts], dtype=np.float64) * 100).astype(np.int64)
+
+
+def _euros(cents):
+    return round(int(cents) / 100, 2)
+
+
+def _group_starts(values):
+    ''' Return the indexes where the sorted array values changes, first index included. '''
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1])))
+
+
+def _month_label(month):
+    return str(np.datetime64(month, 'M'))
+
+
+def bank_statistics(columns, lines, top=LARGEST_OUTFLOWS, forecast_months=FORECAST_MONTHS):
+    ''' Return the statistics of the lines (a slice of columns, all of one bank) as a dict ready for JSON. '''
+    day, debit, credit, pk = columns.day[lines], columns.debit[lines], columns.credit[lines], columns.pk[lines]
+    amount = debit + credit
+
+    # balance at the end of each day with lines
+    day_starts = _group_starts(day)
+    balance = np.cumsum(np.add.reduceat(amount, day_starts))
+
+    # totals of each calendar month from the first to the last one, months without lines included
+    month = day.astype('datetime64[M]')
+    month_starts = _group_starts(month)
+    first_month = month[0]
+    month_count = int((month[-1] - first_month).astype(np.int64)) + 1
+    month_index = (month[month_starts] - first_month).astype(np.int64)
+    monthly = {}
+    for name, values in (('debit', debit), ('credit', credit)):
+        monthly[name] = np.zeros(month_count, dtype=np.int64)
+        monthly[name][month_index] = np.add.reduceat(values, month_starts)
+    monthly['line_count'] = np.zeros(month_count, dtype=np.int64)
+    monthly['line_count'][month_index] = np.diff(np.append(month_starts, len(day)))
+    net = monthly['debit'] + monthly['credit']
+
+    # largest outflows: the top most negative amounts, then the earliest
+    outflows = np.flatnonzero(amount < 0)
+    if len(outflows) > top:
+        outflows = outflows[np.argpartition(amount[outflows], top - 1)[:top]]
+    outflows = outflows[np.lexsort((pk[outflows], day[outflows], amount[outflows]))][:top]
+
+    # forecast: linear trend of the net flows of the last months (their mean with a single month)
+    history = net[-FORECAST_HISTORY_MONTHS:].astype(np.float64)
+    following = np.arange(len(history), len(history) + forecast_months)
+    if len(history) > 1:
+        slope, intercept = np.polyfit(np.arange(len(history)), history, 1)
+        predicted = np.rint(slope * following + intercept).astype(np.int64)
+    else:
+        predicted = np.full(forecast_months, int(history[0]), dtype=np.int64)
+
+    return {
+        'bank': int(columns.bank[lines][0]),
+        'line_count': len(day),
+        'balance': {
+            'dates': [str(value) for value in day[day_starts]],
+            'values': [_euros(value) for value in balance],
+            'min': _euros(balance.min()),
+            'max': _euros(balance.max()),
+            'final': _euros(balance[-1]),
+        },
+        'months': [{'month': _month_label(first_month + index), 'line_count': int(monthly['line_count'][index]),
+                    'debit': _euros(monthly['debit'][index]), 'credit': _euros(monthly['credit'][index]),
+                    'net': _euros(net[index])} for index in range(month_count)],
+        'monthly_average': {
+            'debit': round(monthly['debit'].mean() / 100, 2),
+            'credit': round(monthly['credit'].mean() / 100, 2),
+            'net': round(net.mean() / 100, 2),
+        },
+        'largest_outflows': [{'id': int(pk[index]), 'date': str(day[index]), 'amount': _euros(amount[index])}
+                             for index in outflows],
+        'forecast': [{'month': _month_label(month[-1] + 1 + index), 'net': _euros(predicted[index]),
+                      'balance': _euros(balance[-1] + predicted[:index + 1].sum())}
+                     for index in range(forecast_months)],
+    }
+
+
+def cashflow_statistics(banklines, top=LARGEST_OUTFLOWS, forecast_months=FORECAST_MONTHS,
+                        chunk_size=ANALYTICS_CHUNK_SIZE):
+    ''' Return the list of the statistics of each bank of the banklines queryset (see bank_statistics). '''
+    columns = BankLineColumns.from_queryset(banklines, chunk_size)
+    return [bank_statistics(columns, lines, top, forecast_months) for bank_id, lines in columns.banks()]
+
+
+def filter_banklines(bank_id=None, date_start=None, date_end=None):
+    ''' Return the BankLine queryset of bank_id (all banks if None) between the dates date_start and date_end
+    ("YYYY-MM-DD" strings, ignored if empty or invalid). '''
+    banklines = BankLine.objects.all()
+    if bank_id:
+        banklines = banklines.filter(bank=bank_id)
+    if parse_date(date_start):
+        banklines = banklines.filter(transaction_date__gte=parse_date(date_start))
+    if parse_date(date_end):
+        banklines = banklines.filter(transaction_date__lte=parse_date(date_end))
+    return banklines
+
+
+def with_bank_names(statistics):
+    ''' Add the name of its bank to each statistics dict. Return statistics. '''
+    names = dict(Bank.objects.values_list('pk', 'name'))
+    for bank_statistics in statistics:
+        bank_statistics['name'] = names.get(bank_statistics['bank'])
+    return statistics
+
+
+def parse_date(value):
+    ''' Return the date of a "YYYY-MM-DD" string, or None if it is empty or invalid. '''
+    try:
+        return datetime.datetime.strptime(value or "", '%Y-%m-%d').date()
+    except ValueError:
+        return None
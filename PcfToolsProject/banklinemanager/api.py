@@ -0,0 +1,141 @@
+''' Read-only JSON API of the banks and bank lines, for the internal tools (instead of scraping the HTML pages).
+
+api/banks/ lists the banks. api/banklines/ lists the lines from the most recent, filtered by the same GET filters
+as the search page (see BankLine.search_bankline), and api/search/ adds the message and totals of the search.
+The lines are paginated by cursor like the listing (GET after or before, and limit) and serialized from values(),
+without model instances; GET fields selects the returned fields (comma separated).
+The responses of the lines have an ETag derived from the state of the lines in database (see data_etag), so a
+conditional GET (If-None-Match) of an unchanged page gets a 304 with one aggregate query instead of the page.
+They have no Last-Modified header: its one second resolution would give a 304 for lines changed in the same
+second as the previous GET. The ETag of the banks is a digest of the banks themselves. '''
+import hashlib
+
+from django.contrib.auth.decorators import login_required, permission_required
+from django.core.exceptions import ValidationError
+from django.db.models import Count, F, Max
+from django.http import JsonResponse
+from django.utils.http import urlencode
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_safe
+
+from . import search_cache
+from .models import Bank, BankLine
+from .pagination import KeysetPaginator
+from .views import search_filters
+
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+# Fields of the lines returned by the API, all of them if GET fields is not given
+BANKLINE_FIELDS = ('id', 'transaction_date', 'wording', 'transaction_number', 'debit', 'credit', 'amount',
+                   'bank_detail', 'user_comment', 'bank_id', 'category_id')
+# Fields read in any case to compute the cursors of a page
+CURSOR_FIELDS = ('id', 'transaction_date')
+
+
+def data_etag(request):
+    ''' Return the ETag of a response of lines: a digest of the number of lines, their last id and their latest
+    modified_at, which any insert, edit or deletion of lines changes, whatever the process, and of the query.
+    A queryset update() of lines must set modified_at too. '''
+    state = BankLine.objects.aggregate(count=Count('id'), last_id=Max('id'), last_modified=Max('modified_at'))
+    return hashlib.sha1(("%s|%s|%s|%s|%s" % (state['count'], state['last_id'], state['last_modified'], request.path,
+                                             sorted(request.GET.lists()))).encode()).hexdigest()
+
+
+def bank_values():
+    return list(Bank.objects.order_by('name').values(
+        'id', 'name', account_number=F('_account_number'), datafile_format=F('_datafile_format')))
+
+
+def banks_etag(request):
+    request.api_banks = bank_values()
+    return hashlib.sha1(repr(request.api_banks).encode()).hexdigest()
+
+
+def get_fields(request):
+    ''' Return the fields of the lines asked by GET fields, all by default. Raise ValueError for an unknown field. '''
+    fields = [name.strip() for name in request.GET.get('fields', "").split(",") if name.strip()]
+    unknown = [name for name in fields if name not in BANKLINE_FIELDS]
+    if unknown:
+        raise ValueError("Champs inconnus : %s" % (", ".join(unknown)))
+    return fields or list(BANKLINE_FIELDS)
+
+
+def get_limit(request):
+    limit = request.GET.get('limit', "")
+    return min(int(limit), API_MAX_PAGE_SIZE) if limit.isdigit() and int(limit) > 0 else API_PAGE_SIZE
+
+
+def page_url(request, direction, cursor):
+    ''' Return the absolute URL of the page before or after (direction) cursor, with the same query. '''
+    query = [(key, value) for key, value in request.GET.items() if key not in ('after', 'before')]
+    return request.build_absolute_uri("%s?%s" % (request.path, urlencode(query + [(direction, cursor)])))
+
+
+def bankline_page(request, banklines):
+    ''' Return the page of the banklines queryset selected by GET after or before, as a dict: results (the lines
+    as dicts of the selected fields) and the URLs of the previous and next pages (None at the ends). '''
+    fields = get_fields(request)
+    paginator = KeysetPaginator(banklines.values(*dict.fromkeys(CURSOR_FIELDS + tuple(fields))), get_limit(request))
+    page = paginator.page(after=request.GET.get('after'), before=request.GET.get('before'))
+    results = page.object_list
+    if not set(CURSOR_FIELDS) <= set(fields):
+        results = [{name: row[name] for name in fields} for row in results]
+    return {
+        'results': results,
+        'previous': page_url(request, 'before', page.previous_cursor) if page.has_previous and results else None,
+        'next': page_url(request, 'after', page.next_cursor) if page.has_next and results else None,
+    }
+
+
+def error_response(message):
+    return JsonResponse({'error': message}, status=400)
+
+
+@login_required
+@permission_required('banklinemanager.can_list', raise_exception=True)
+@require_safe
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=banks_etag)
+def banks(request):
+    ''' Return in JSON the banks: id, name, account_number and datafile_format. '''
+    return JsonResponse({'results': request.api_banks})
+
+
+@login_required
+@permission_required('banklinemanager.can_list', raise_exception=True)
+@require_safe
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=data_etag)
+def banklines(request):
+    ''' Return in JSON a page of the lines from the most recent, filtered by the GET filters of the search page
+    if any (all the lines otherwise). '''
+    try:
+        bankline_list = BankLine.search_bankline(*search_filters(request.GET).values())[0]
+        if bankline_list is None:
+            bankline_list = BankLine.objects.all()
+        return JsonResponse(bankline_page(request, bankline_list))
+    except (ValueError, ValidationError) as e:
+        return error_response("Requête invalide : %s" % (e))
+
+
+@login_required
+@permission_required('banklinemanager.can_search', raise_exception=True)
+@require_safe
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=data_etag)
+def search(request):
+    ''' Return in JSON a page of the results of the search given by the GET filters of the search page, as in
+    banklines, with the message of the search and the totals of all its results (read from the search cache). '''
+    filters = search_filters(request.GET)
+    try:
+        bankline_list, msg_search = BankLine.search_bankline(*filters.values())
+        if bankline_list is None:
+            return error_response("Aucun filtre de recherche.")
+        data = bankline_page(request, bankline_list)
+    except (ValueError, ValidationError) as e:
+        return error_response("Requête invalide : %s" % (e))
+    data['message'] = msg_search
+    data['totals'] = search_cache.get_or_compute(
+        search_cache.normalize_filters(*filters.values()) + ('totals',),
+        lambda: BankLine.search_totals(bankline_list))
+    return JsonResponse(data)
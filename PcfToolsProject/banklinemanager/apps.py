@@ -1,5 +1,10 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class BanklinemanagerConfig(AppConfig):
     name = 'banklinemanager'
+
+    def ready(self):
+        from .database import configure_connection
+        connection_created.connect(configure_connection, dispatch_uid='banklinemanager_configure_connection')
@@ -0,0 +1,154 @@
+''' Batch import of many datafiles (or zip archives of datafiles) for several bank accounts.
+
+Each datafile is mapped to its Bank from the OFX <ACCTID> tag, or else from its name starting with the
+account number (e.g. "123456789_2018-06.ofx"). Datafiles are parsed in parallel by a process pool and the
+parsed lines are written by the calling process only, one datafile at a time, so SQLite sees a single writer.
+The workers are given the path of a datafile, never its content, and read it as they parse it; the files of a
+zip archive are extracted one at a time to a temporary file. At most MAX_PENDING_PER_WORKER datafiles per
+worker are submitted ahead of the writer, so the memory used does not grow with the number of datafiles.
+Like the uploads, the datafiles already imported (same SHA-256) are skipped and the others are recorded in the
+ImportedFile ledger when imported cleanly. '''
+import os
+import re
+import tempfile
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from django.core.files import File
+
+from .importers import get_importer, init_worker
+from .models import MSG_LINES_ALREADY_COVERED, Bank, BankLine, ImportedFile
+from .parsers import iter_chunks
+
+
+OFX_ACCTID = re.compile(rb'<ACCTID>\s*([0-9A-Za-z]+)')
+FILENAME_ACCOUNT_NUMBER = re.compile(r'^(\d+)(?:[_\-. ]|$)')
+# Only the beginning of a datafile is searched for its <ACCTID>
+ACCTID_SEARCH_SIZE = 64 * 1024
+# Datafiles submitted per worker and not yet written
+MAX_PENDING_PER_WORKER = 2
+
+
+def iter_datafiles(paths, directory):
+    ''' Yield (name, path) for each file of paths. A zip archive yields each of its files instead, extracted to a
+    temporary file of directory when it is requested. '''
+    for path in paths:
+        if zipfile.is_zipfile(path):
+            for datafile in iter_zip_datafiles(path):
+                fd, datafile_path = tempfile.mkstemp(dir=directory)
+                with os.fdopen(fd, 'wb') as extracted_file:
+                    for chunk in datafile.chunks():
+                        extracted_file.write(chunk)
+                yield datafile.name, datafile_path
+        else:
+            yield path, path
+
+
+def iter_zip_datafiles(archive_file):
+    ''' Yield a File for each file of the zip archive archive_file (a path or a file object), decompressed as it
+    is read. Each File is closed when the next one is requested. '''
+    with zipfile.ZipFile(archive_file) as archive:
+        for member in archive.infolist():
+            if not member.is_dir():
+                with archive.open(member) as member_file:
+                    yield File(member_file, name=member.filename)
+
+
+def resolve_bank(name, content, banks=None):
+    ''' Return the Bank of the datafile name with content: the bank whose account number is the OFX <ACCTID>,
+    or else the one whose account number starts the file name. Return None if none matches.
+    banks is a dict {account_number: Bank}, loaded from the database if not given. '''
+    if banks is None:
+        banks = {bank.get_account_number: bank for bank in Bank.objects.all()}
+    acctid_re = OFX_ACCTID.search(content[:ACCTID_SEARCH_SIZE])
+    if acctid_re is not None and acctid_re.group(1).isdigit() and int(acctid_re.group(1)) in banks:
+        return banks[int(acctid_re.group(1))]
+    filename_re = FILENAME_ACCOUNT_NUMBER.match(os.path.basename(name))
+    if filename_re is not None and int(filename_re.group(1)) in banks:
+        return banks[int(filename_re.group(1))]
+    return None
+
+
+def _parse_datafile(importer, path):
+    ''' Parse the datafile at path with importer in a worker process, which already runs in parallel with the other
+    datafiles so the validation is not sent to another pool. The writer links the BankLine objects to its own bank. '''
+    with open(path, 'rb') as datafile:
+        return importer.parse_datafile(datafile, parallel=False)
+
+
+def _error_result(name, bank, message):
+    return {'name': name, 'bank': bank, 'line_counter': 0, 'inserted_line_counter': 0, 'duration': 0,
+            'msg_insert_error': [message]}
+
+
+def _write_datafile(future, name, bank, sha256, size, start):
+    ''' Insert the lines parsed by future and record the datafile in the ledger. Return its result dict. '''
+    result = {'name': name, 'bank': bank, 'line_counter': 0, 'inserted_line_counter': 0}
+    try:
+        banklines, msg_insert_error = future.result()
+        parse_error_counter = len(msg_insert_error)
+        for bankline in banklines:
+            bankline.bank = bank
+        result['line_counter'] = len(banklines)
+        new_banklines, skipped_line_counter = ImportedFile.narrow_banklines(bank, banklines)
+        if skipped_line_counter:
+            msg_insert_error.append(MSG_LINES_ALREADY_COVERED % (skipped_line_counter))
+        result['inserted_line_counter'] = BankLine.bulk_insert_banklines(new_banklines, msg_insert_error)
+        ImportedFile.record(bank, os.path.basename(name), sha256, size, banklines, result['inserted_line_counter'],
+                            parse_error_counter)
+        result['msg_insert_error'] = msg_insert_error
+    except Exception as e:
+        result['msg_insert_error'] = ["-> Le fichier n'a pas été importé  -- file %s, %s" % (name, e)]
+    result['duration'] = time.perf_counter() - start
+    return result
+
+
+def import_datafiles(paths, default_bank=None, workers=None):
+    ''' Parse the datafiles of paths (files or zip archives) in parallel across workers processes and insert their
+    lines. Yield a dict per datafile, in the order parsing ends: name, bank, line_counter, inserted_line_counter,
+    msg_insert_error (same values as BankLine.insert_data_from_*) and duration of its import. '''
+    banks = {bank.get_account_number: bank for bank in Bank.objects.all()}
+    max_pending = MAX_PENDING_PER_WORKER * (workers or os.cpu_count() or 1)
+    with tempfile.TemporaryDirectory(prefix='bankline-batch-') as directory, \
+            ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        pending = {}
+
+        def written(futures):
+            for future in futures:
+                name, path, bank, sha256, size, start = pending.pop(future)
+                yield _write_datafile(future, name, bank, sha256, size, start)
+                if path.startswith(directory):
+                    os.remove(path)
+
+        for name, path in iter_datafiles(paths, directory):
+            with open(path, 'rb') as datafile:
+                bank = resolve_bank(name, datafile.read(ACCTID_SEARCH_SIZE), banks) or default_bank
+                datafile.seek(0)
+                sha256, size = ImportedFile.hash_chunks(iter_chunks(datafile))
+            result = None
+            if bank is None:
+                result = _error_result(name, None, "-> Aucun compte bancaire ne correspond à ce fichier.")
+            else:
+                imported_file = ImportedFile.objects.filter(bank=bank, sha256=sha256).select_related('bank').first()
+                if imported_file is not None:
+                    result = _error_result(name, bank, imported_file.already_imported_message())
+                else:
+                    try:
+                        importer = get_importer(bank)
+                    except ValueError as e:
+                        result = _error_result(name, bank, "-> Le fichier n'a pas été importé  -- file %s, %s" % (name, e))
+            if result is not None:
+                if path.startswith(directory):
+                    os.remove(path)
+                yield result
+                continue
+
+            pending[executor.submit(_parse_datafile, importer, path)] = (
+                name, path, bank, sha256, size, time.perf_counter())
+            # write the datafiles parsed so far before reading more of them
+            while len(pending) >= max_pending:
+                yield from written(wait(pending, return_when=FIRST_COMPLETED).done)
+
+        while pending:
+            yield from written(wait(pending, return_when=FIRST_COMPLETED).done)
@@ -0,0 +1,126 @@
+''' Categorization of banklines by the CategoryRule objects compiled into combined matchers.
+
+The keyword rules, normalized like search_text (see fulltext.normalize_text), are compiled into one Aho-Corasick
+automaton: a single pass over the search_text of a line finds every keyword it contains, whatever the number
+of rules. The regex rules, applied to search_text ignoring case, are joined into one regex of alternatives, each
+one in a named group, tried at every position of the text inside a lookahead. At a given position, the regex
+alternatives are tried in the order of the rules, so a regex rule hides the following ones only where it matches.
+A regex which can't be an alternative of the combined one (groups, backreferences, global flags) is tried on its
+own, and an invalid regex matches nothing: a rule never makes an import fail.
+The rule with the lowest priority (then id) among the matching ones whose amount range contains the amount of the
+line gives its category. A rule without keyword nor regex matches every line of its amount range. '''
+import re
+from collections import deque
+
+
+def compile_regex(pattern, flags=re.IGNORECASE):
+    ''' Return the compiled regex of pattern, or None if pattern is not a valid regex. '''
+    try:
+        return re.compile(pattern, flags)
+    except re.error:
+        return None
+
+
+class KeywordAutomaton:
+    ''' Aho-Corasick automaton finding in one pass which of keywords (a list of strings) a text contains. '''
+    def __init__(self, keywords):
+        # each state is a dict {character: next state}, with the indexes of the keywords ending at it
+        self.transitions = [{}]
+        self.outputs = [set()]
+        for index, keyword in enumerate(keywords):
+            state = 0
+            for character in keyword:
+                if character not in self.transitions[state]:
+                    self.transitions.append({})
+                    self.outputs.append(set())
+                    self.transitions[state][character] = len(self.transitions) - 1
+                state = self.transitions[state][character]
+            self.outputs[state].add(index)
+
+        # failure link of a state: the longest proper suffix of its path which is a path from the root
+        self.fail = [0] * len(self.transitions)
+        queue = deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, next_state in self.transitions[state].items():
+                fail_state = self.fail[state]
+                while fail_state and character not in self.transitions[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.transitions[fail_state].get(character, 0)
+                self.outputs[next_state] |= self.outputs[self.fail[next_state]]
+                queue.append(next_state)
+
+    def search(self, text):
+        ''' Return the set of the indexes of the keywords found in text. '''
+        transitions, fail, outputs = self.transitions, self.fail, self.outputs
+        found = set()
+        state = 0
+        for character in text:
+            while state and character not in transitions[state]:
+                state = fail[state]
+            state = transitions[state].get(character, 0)
+            if outputs[state]:
+                found |= outputs[state]
+        return found
+
+
+class Categorizer:
+    ''' Find the category of banklines from rules, an iterable of CategoryRule objects. '''
+    def __init__(self, rules):
+        self.rules = sorted(rules, key=lambda rule: (rule.priority, rule.pk or 0))
+        keyword_rules, regex_alternatives = [], []
+        self.regex_rules = {}
+        self.separate_regexes = []
+        self.amount_rules = []
+        for position, rule in enumerate(self.rules):
+            pattern = rule.get_pattern()
+            if pattern is None:
+                self.amount_rules.append(position)
+            elif rule.rule_type == rule.RULE_KEYWORD:
+                keyword_rules.append((rule.get_keyword(), position))
+            else:
+                regex = compile_regex(pattern)
+                if regex is None:
+                    continue
+                group_name = "rule_%s" % (position)
+                alternative = "(?P<%s>%s)" % (group_name, pattern)
+                if regex.groups or compile_regex("(?=%s)" % (alternative)) is None:
+                    # its groups would shift the numbering or its flags would be misplaced in the combined regex
+                    self.separate_regexes.append((regex, position))
+                else:
+                    self.regex_rules[group_name] = position
+                    regex_alternatives.append(alternative)
+
+        self.keyword_positions = [position for keyword, position in keyword_rules]
+        self.keywords = KeywordAutomaton([keyword for keyword, position in keyword_rules]) if keyword_rules else None
+        self.regex = re.compile("(?=%s)" % ("|".join(regex_alternatives)), re.IGNORECASE) if regex_alternatives else None
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def matching_rules(self, text):
+        ''' Return the positions in self.rules of the rules found in text by the combined matchers. '''
+        positions = []
+        if self.keywords is not None:
+            positions.extend(self.keyword_positions[index] for index in self.keywords.search(text))
+        if self.regex is not None:
+            positions.extend({self.regex_rules[match.lastgroup] for match in self.regex.finditer(text)})
+        positions.extend(position for regex, position in self.separate_regexes if regex.search(text))
+        return positions
+
+    def categorize(self, bankline):
+        ''' Return the category id of bankline (search_text and amount computed), or None if no rule matches. '''
+        for position in sorted(self.matching_rules(bankline.search_text) + self.amount_rules):
+            rule = self.rules[position]
+            if rule.matches_amount(bankline.amount):
+                return rule.category_id
+            if rule.rule_type == rule.RULE_REGEX and rule.pattern:
+                # this regex may have hidden a following one where it matched: test the next rules one by one
+                return self._categorize_one_by_one(bankline, position + 1)
+        return None
+
+    def _categorize_one_by_one(self, bankline, start):
+        for rule in self.rules[start:]:
+            if rule.matches_amount(bankline.amount) and rule.matches_text(bankline.search_text):
+                return rule.category_id
+        return None
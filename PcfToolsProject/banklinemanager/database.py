@@ -0,0 +1,19 @@
+''' Tuning of the database connections.
+
+Each new SQLite connection runs the pragmas of settings.BANKLINE_SQLITE_PRAGMAS (the production profile enables
+the write-ahead log, synchronous=NORMAL, memory mapping and a larger page cache). journal_mode=WAL is stored in
+the database file, the other pragmas only last as long as their connection, hence running them all on each one;
+with CONN_MAX_AGE a connection serves many requests, so this costs little. '''
+from django.conf import settings
+
+
+def configure_connection(sender, connection, **kwargs):
+    ''' connection_created receiver: run the SQLite pragmas on the new connection. '''
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'BANKLINE_SQLITE_PRAGMAS', {})
+    if not pragmas:
+        return
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA %s = %s" % (name, value))
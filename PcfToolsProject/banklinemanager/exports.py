@@ -0,0 +1,67 @@
+''' Streaming export of banklines to the datafile formats accepted by the import.
+
+Each function reads the queryset with .iterator(chunk_size=EXPORT_CHUNK_SIZE), so neither Django nor the
+database driver keeps the whole result in memory, and yields the datafile piece by piece for a
+StreamingHttpResponse. The first bytes are sent as soon as the first chunk of rows is read. '''
+import csv
+
+from django.utils import timezone
+
+
+# Number of rows fetched from the database at a time during an export
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_ENCODING = 'latin-1'
+# Encoding of the OFX exports, as declared by CHARSET:1252 in their header
+OFX_EXPORT_ENCODING = 'cp1252'
+
+OFX_SGML_HEADER = ("OFXHEADER:100\r\nDATA:OFXSGML\r\nVERSION:102\r\nSECURITY:NONE\r\nENCODING:USASCII\r\n"
+                   "CHARSET:1252\r\nCOMPRESSION:NONE\r\nOLDFILEUID:NONE\r\nNEWFILEUID:NONE\r\n\r\n")
+
+
+class _Echo:
+    ''' File-like object returning what is written, so csv.writer formats one row at a time. '''
+    def write(self, value):
+        return value
+
+
+def _format_amount(amount):
+    ''' Return amount with a decimal comma as in the CEPAC datafiles, or "" for a zero amount. '''
+    return ("%.2f" % (amount)).replace(".", ",") if amount else ""
+
+
+def _escape_sgml(value):
+    ''' Return value with the characters delimiting the SGML tags as entities (unescaped by the parser). '''
+    return value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def iter_csv_cepac(banklines):
+    ''' Yield the banklines as CSV rows in the CEPAC layout read by BankLine.parse_csv_cepac:
+    date (dd/mm/yy);transaction number followed by " -";wording;debit;credit;bank detail, quoted with "|" as the
+    importer reads them. '''
+    writer = csv.writer(_Echo(), delimiter=';', quotechar='|', lineterminator='\r\n')
+    for bankline in banklines.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield writer.writerow([
+            bankline.transaction_date.strftime('%d/%m/%y'),
+            "%s -" % (bankline.transaction_number),
+            bankline.wording,
+            _format_amount(bankline.debit),
+            _format_amount(bankline.credit),
+            bankline.bank_detail,
+        ]).encode(EXPORT_ENCODING, 'replace')
+
+
+def iter_ofxsgml(banklines):
+    ''' Yield the banklines as an OFX SGML statement (read by BankLine.parse_ofxsgml), one <STMTTRN> per line. '''
+    yield (OFX_SGML_HEADER + "<OFX>\r\n<BANKMSGSRSV1>\r\n<STMTTRNRS>\r\n<STMTRS>\r\n<CURDEF>EUR\r\n"
+           "<BANKTRANLIST>\r\n<DTSERVER>%s\r\n" % (timezone.now().strftime('%Y%m%d%H%M%S'))).encode(OFX_EXPORT_ENCODING)
+    for bankline in banklines.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield ("<STMTTRN>\r\n<TRNTYPE>%s\r\n<DTPOSTED>%s\r\n<TRNAMT>%.2f\r\n<FITID>%s\r\n<NAME>%s\r\n<MEMO>%s\r\n"
+               "</STMTTRN>\r\n" % (
+                   "DEBIT" if bankline.debit else "CREDIT",
+                   bankline.transaction_date.strftime('%Y%m%d'),
+                   bankline.debit if bankline.debit else bankline.credit,
+                   _escape_sgml(bankline.transaction_number),
+                   _escape_sgml(bankline.wording),
+                   _escape_sgml(bankline.bank_detail),
+               )).encode(OFX_EXPORT_ENCODING, 'replace')
+    yield "</BANKTRANLIST>\r\n</STMTRS>\r\n</STMTTRNRS>\r\n</BANKMSGSRSV1>\r\n</OFX>\r\n".encode(OFX_EXPORT_ENCODING)
@@ -0,0 +1,185 @@
+''' Normalized search text of BankLine and its optional SQLite FTS5 full-text index.
+
+search_text holds the wording, bank detail and user comment of a line unaccented, lowercased and with
+whitespace collapsed, computed once when the line is saved or imported, so searches compare keywords
+normalized the same way without applying any function to the rows.
+The index is an external content FTS5 table over search_text with the trigram tokenizer, so a MATCH on a
+keyword of 3 or more characters finds the lines containing it anywhere, and a LIKE pattern (used by the fuzzy
+search) is looked up through the trigrams too. Triggers keep it in sync with every INSERT, UPDATE (e.g.
+user_comment edited in the admin) and DELETE on the bankline table.
+On other databases, or when SQLite is built without FTS5, search_bankline falls back to LIKE lookups. On
+PostgreSQL a GIN index of the pg_trgm trigrams of search_text serves these LIKE lookups, "%keyword%" included. '''
+import unicodedata
+
+from django.db import connection as default_connection, migrations
+from django.db.models import Lookup, TextField
+from django.db.models.expressions import RawSQL
+from django.db.utils import DatabaseError
+
+
+FTS_TABLE = 'banklinemanager_bankline_fts'
+FTS_CONTENT_TABLE = 'banklinemanager_bankline'
+FTS_COLUMNS = ('search_text',)
+TRIGRAM_INDEX = 'banklinemanager_bankline_search_text_trgm'
+# The trigram tokenizer cannot match a keyword shorter than 3 characters
+FTS_MIN_KEYWORD_LENGTH = 3
+# Separates the fields in search_text, so "starts with" also matches at the start of each field
+SEARCH_TEXT_SEPARATOR = "\n"
+SEARCH_TEXT_FIELDS = ('wording', 'bank_detail', 'user_comment')
+# A shorter keyword with one typo would match almost any line
+FUZZY_MIN_KEYWORD_LENGTH = 5
+
+_fulltext_available = {}
+
+
+def normalize_text(value):
+    ''' Return value without accents, lowercased and with each run of whitespace replaced by a space. '''
+    value = unicodedata.normalize('NFKD', value or "")
+    value = "".join(character for character in value if not unicodedata.combining(character))
+    return " ".join(value.casefold().split())
+
+
+def search_text(*values):
+    ''' Return the search_text of a line from the values of its SEARCH_TEXT_FIELDS. '''
+    return SEARCH_TEXT_SEPARATOR.join(normalize_text(value) for value in values)
+
+
+def fuzzy_patterns(keyword):
+    ''' Return the LIKE patterns finding keyword with at most one typo: one wrong, extra or missing character,
+    or two swapped characters. '''
+    # "%" and "_" of keyword are wildcards of LIKE: "_" matches any character including itself
+    keyword = keyword.replace("%", "_")
+    variants = set()
+    for i in range(len(keyword)):
+        variants.add(keyword[:i] + "_" + keyword[i + 1:])
+        variants.add(keyword[:i] + keyword[i + 1:])
+        variants.add(keyword[:i] + "_" + keyword[i:])
+        if i + 1 < len(keyword):
+            variants.add(keyword[:i] + keyword[i + 1] + keyword[i] + keyword[i + 2:])
+    return sorted("%%%s%%" % (variant) for variant in variants)
+
+
+def create_fulltext_index(connection, columns=FTS_COLUMNS):
+    ''' Create the FTS5 table over columns and its triggers, then index the existing banklines.
+    Do nothing if the database is not SQLite or if FTS5 with the trigram tokenizer is missing. '''
+    if connection.vendor != 'sqlite':
+        return
+    new_columns = ", ".join("new.%s" % (column) for column in columns)
+    old_columns = ", ".join("old.%s" % (column) for column in columns)
+    columns = ", ".join(columns)
+    with connection.cursor() as cursor:
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE %s USING fts5(%s, content='%s', content_rowid='id', tokenize='trigram')"
+                           % (FTS_TABLE, columns, FTS_CONTENT_TABLE))
+        except DatabaseError:
+            return
+        cursor.execute("CREATE TRIGGER %s_ai AFTER INSERT ON %s BEGIN "
+                       "INSERT INTO %s(rowid, %s) VALUES (new.id, %s); END"
+                       % (FTS_TABLE, FTS_CONTENT_TABLE, FTS_TABLE, columns, new_columns))
+        cursor.execute("CREATE TRIGGER %s_ad AFTER DELETE ON %s BEGIN "
+                       "INSERT INTO %s(%s, rowid, %s) VALUES ('delete', old.id, %s); END"
+                       % (FTS_TABLE, FTS_CONTENT_TABLE, FTS_TABLE, FTS_TABLE, columns, old_columns))
+        cursor.execute("CREATE TRIGGER %s_au AFTER UPDATE OF %s ON %s BEGIN "
+                       "INSERT INTO %s(%s, rowid, %s) VALUES ('delete', old.id, %s); "
+                       "INSERT INTO %s(rowid, %s) VALUES (new.id, %s); END"
+                       % (FTS_TABLE, columns, FTS_CONTENT_TABLE, FTS_TABLE, FTS_TABLE, columns, old_columns,
+                          FTS_TABLE, columns, new_columns))
+        cursor.execute("INSERT INTO %s(%s) VALUES ('rebuild')" % (FTS_TABLE, FTS_TABLE))
+    _fulltext_available.clear()
+
+
+def drop_fulltext_index(connection):
+    ''' Drop the FTS5 table and its triggers, e.g. before a migration rebuilds the bankline table. '''
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for suffix in ('ai', 'ad', 'au'):
+            cursor.execute("DROP TRIGGER IF EXISTS %s_%s" % (FTS_TABLE, suffix))
+        cursor.execute("DROP TABLE IF EXISTS %s" % (FTS_TABLE))
+    _fulltext_available.clear()
+
+
+def rebuild_fulltext_operations(columns=FTS_COLUMNS, previous_columns=None):
+    ''' Return the pair of migration operations to put around the operations which make SQLite rebuild the
+    bankline table (adding a column, a foreign key...), which would lose the full-text triggers: the first drops
+    the index, the second creates it again over columns. Reversed, the index is created over previous_columns
+    (columns by default). '''
+    previous_columns = previous_columns or columns
+
+    def drop_fulltext(apps, schema_editor):
+        drop_fulltext_index(schema_editor.connection)
+
+    def create_fulltext(apps, schema_editor):
+        create_fulltext_index(schema_editor.connection, columns)
+
+    def create_previous_fulltext(apps, schema_editor):
+        create_fulltext_index(schema_editor.connection, previous_columns)
+
+    return (migrations.RunPython(drop_fulltext, create_previous_fulltext),
+            migrations.RunPython(create_fulltext, drop_fulltext))
+
+
+def create_trigram_index(connection):
+    ''' Create the pg_trgm extension if needed and the GIN trigram index over search_text.
+    Do nothing if the database is not PostgreSQL. '''
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cursor.execute("CREATE INDEX IF NOT EXISTS %s ON %s USING gin (%s gin_trgm_ops)"
+                       % (TRIGRAM_INDEX, FTS_CONTENT_TABLE, FTS_COLUMNS[0]))
+
+
+def drop_trigram_index(connection):
+    ''' Drop the GIN trigram index (the pg_trgm extension is kept, other database objects may use it). '''
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("DROP INDEX IF EXISTS %s" % (TRIGRAM_INDEX))
+
+
+def fulltext_available(connection=default_connection):
+    ''' Return True if the FTS5 index exists in the database of connection. Checked once per database. '''
+    if connection.vendor != 'sqlite':
+        return False
+    key = (connection.alias, connection.settings_dict['NAME'])
+    if key not in _fulltext_available:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+            _fulltext_available[key] = cursor.fetchone() is not None
+    return _fulltext_available[key]
+
+
+def fulltext_match(keywords):
+    ''' Return the FTS5 MATCH expression finding the lines which contain any of keywords. '''
+    return " OR ".join('"%s"' % (keyword.replace('"', '""')) for keyword in keywords)
+
+
+@TextField.register_lookup
+class Like(Lookup):
+    ''' search_text__like=pattern: LIKE with the "%" and "_" wildcards of pattern, used when FTS5 is missing. '''
+    lookup_name = 'like'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return "%s LIKE %s" % (lhs, rhs), lhs_params + rhs_params
+
+
+class FulltextSubquery(RawSQL):
+    ''' Ids of the lines matching the MATCH expression of keywords, to use as pk__in=FulltextSubquery(keywords).
+    Unlike RawSQL, the SQL is not wrapped in parentheses: the IN lookup already adds them, and SQLite reads
+    "IN ((SELECT ...))" as a scalar subquery returning only the first id. '''
+    def __init__(self, keywords):
+        super().__init__("SELECT rowid FROM %s WHERE %s MATCH %%s" % (FTS_TABLE, FTS_TABLE), [fulltext_match(keywords)])
+
+    def as_sql(self, compiler, connection):
+        return self.sql, self.params
+
+
+class FulltextLikeSubquery(FulltextSubquery):
+    ''' Ids of the lines matching one of the LIKE patterns, to use as pk__in=FulltextLikeSubquery(patterns).
+    One SELECT per pattern joined by UNION: FTS5 looks up a single LIKE through the trigrams, not an OR of them. '''
+    def __init__(self, patterns):
+        RawSQL.__init__(self, " UNION ".join(
+            ["SELECT rowid FROM %s WHERE %s LIKE %%s" % (FTS_TABLE, FTS_COLUMNS[0])] * len(patterns)), patterns)
@@ -0,0 +1,467 @@
+''' Importers of the datafile formats, registered by format (see Bank.FORMAT_DATAFILE_ACCEPTED).
+
+Every importer shares the same streaming interface: records() reads the raw records of a datafile (OFX
+transaction, CSV row, QIF record, CAMT.053 entry) as the file is read, normalize() turns a record into the
+values of a BankLine, and validate() checks them. The records are normalized and validated by batches of
+VALIDATION_BATCH_SIZE, across a process pool of BANKLINE_VALIDATION_WORKERS when a file has more than one batch
+(processes since the work is pure Python and the GIL would serialize threads), then the shared bulk write stage
+(BankLine.bulk_insert_banklines) stores them. Adding a format only needs a records() and a normalize().
+Importers are pickled to the workers, so they must hold everything they need and never query the database
+outside __init__. '''
+import csv
+import datetime
+import hashlib
+import itertools
+import logging as lg
+import multiprocessing
+import re
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+
+import django
+from django.apps import apps
+from django.conf import settings
+
+from .models import MSG_LINE_NOT_IMPORTED, Bank, BankCsvFormat, BankLine
+from .parsers import (detect_encoding, iter_camt053_entries, iter_chunks, iter_decoded, iter_lines,
+                      iter_ofxsgml_transactions, iter_ofxxml_transactions, iter_qif_records, peek_head)
+
+
+# Number of records normalized and validated at a time, by a worker process of the pool
+VALIDATION_BATCH_SIZE = 2000
+# Fields of BankLine given by the importers
+VALUE_FIELDS = ('transaction_date', 'wording', 'transaction_number', 'debit', 'credit', 'bank_detail')
+MAX_LENGTHS = {name: BankLine._meta.get_field(name).max_length
+               for name in ('transaction_number', 'wording', 'bank_detail')}
+
+OFX_DATE = re.compile(r'(\d{4})(\d{2})(\d{2})')
+OFX_AMOUNT = re.compile(r'([+-]?\d+[,\.]?\d*)')
+CEPAC_DATE = re.compile(r'^(\d{2})/(\d{2})/(\d{2})$')
+CEPAC_TRANSACTION_NUMBER = re.compile(r'^(.*) -$')
+AMOUNT = re.compile(r'^[+-]?\d+(\.\d+)?$')
+# Whitespace and currency symbols allowed around the amounts of CSV and QIF files
+AMOUNT_IGNORED = re.compile(r'[\s€$£]')
+# Amounts of BankLine have 8 digits of which 2 decimals
+AMOUNT_LIMIT = Decimal(10) ** 6
+CENT = Decimal('0.01')
+# QIF dates are day first, as exported by the French banks ("'" separates a 2 digits year in some files)
+QIF_DATE_FORMATS = ('%d/%m/%Y', '%d/%m/%y', '%Y-%m-%d')
+# QIF headers of the bank account records, the other ones list accounts, categories...
+QIF_TRANSACTION_TYPES = ('type:bank', 'type:cash', 'type:ccard', 'type:oth a', 'type:oth l')
+CAMT_DEBIT = "DBIT"
+CAMT_CREDIT = "CRDT"
+CAMT_BOOKED = "BOOK"
+
+IMPORTERS = {}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def register(importer_class):
+    ''' Class decorator registering importer_class as the importer of its datafile_format. '''
+    IMPORTERS[importer_class.datafile_format] = importer_class
+    return importer_class
+
+
+def get_importer(bank):
+    ''' Return the importer of the datafile format of bank. '''
+    importer_class = IMPORTERS.get(bank.get_datafile_format)
+    if importer_class is None:
+        raise ValueError("Ce type de fichier n est pas géré par cette application : %s" % (bank.get_datafile_format))
+    return importer_class(bank)
+
+
+def get_validation_workers():
+    return getattr(settings, 'BANKLINE_VALIDATION_WORKERS', 0)
+
+
+def init_worker():
+    ''' Set up Django in a worker process started by spawn (forked workers inherit it). '''
+    if not apps.ready:
+        django.setup()
+
+
+def get_validation_executor():
+    ''' Return the process pool validating the batches of records, created on first use. Its workers are started
+    by spawn, not fork: the pool is created by the import threads of the web server, and a fork of a multi-threaded
+    process may copy locks held by other threads and their database connections. A spawned worker sets up Django
+    before unpickling anything of this module, which imports the models. '''
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=get_validation_workers(), initializer=django.setup,
+                                            mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+
+def iter_batches(records, batch_size=VALIDATION_BATCH_SIZE):
+    ''' Yield the records by lists of batch_size. '''
+    records = iter(records)
+    batch = list(itertools.islice(records, batch_size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(records, batch_size))
+
+
+def parse_amount(text, decimal_separator=None):
+    ''' Return the amount text (e.g. "-1 234,56", "1,234.56 €" or "+12.5") as a string with a dot as decimal
+    separator and without thousands separator. Without decimal_separator, the last of "," and "." found is the
+    decimal separator. Raise ValueError if text is not an amount. '''
+    amount = AMOUNT_IGNORED.sub("", text)
+    if decimal_separator is None:
+        decimal_separator = "," if amount.rfind(",") > amount.rfind(".") else "."
+    amount = amount.replace("." if decimal_separator == "," else ",", "").replace(decimal_separator, ".")
+    if AMOUNT.match(amount) is None:
+        raise ValueError("Erreur : Le montant %s n'est pas valide." % (text))
+    return amount
+
+
+def debit_credit(amount):
+    ''' Return (debit, credit) of the signed amount string. '''
+    if amount.startswith("-"):
+        return amount, Decimal(0)
+    return Decimal(0), amount.lstrip("+")
+
+
+def collapse(text):
+    ''' Return text with its whitespace collapsed, to avoid future search errors. '''
+    return " ".join(text.split())
+
+
+class Importer:
+    ''' Base class of the importers. A subclass sets datafile_format and implements records() and normalize().
+    binary is True for the formats parsed from the bytes of the file (XML, whose header declares the encoding),
+    the others get text decoded with encoding, or else with the encoding found at the start of the file.
+    generates_transaction_numbers is True for the formats whose lines may have no transaction number: one is
+    then computed from the line (see generated_transaction_number). '''
+    datafile_format = None
+    binary = False
+    encoding = None
+    generates_transaction_numbers = False
+
+    def __init__(self, bank):
+        self.bank = bank
+
+    def records(self, chunks):
+        ''' Return an iterator over the raw records of the datafile given as chunks (bytes if binary, else text). '''
+        raise NotImplementedError
+
+    def normalize(self, record):
+        ''' Return the values of the BankLine of record as a dict (transaction_date "YYYY-MM-DD", wording,
+        transaction_number, debit, credit and bank_detail), or None if record is not a bank line (header...).
+        Raise an exception if record cannot be read. '''
+        raise NotImplementedError
+
+    def describe(self, record):
+        ''' Return the text identifying record in the error messages. '''
+        return str(record)[:64]
+
+    def validate(self, values):
+        ''' Check the values returned by normalize, cut wording and bank_detail to the length of their field and
+        return them. Raise ValueError if a value cannot be stored. '''
+        datetime.date.fromisoformat(str(values['transaction_date']))
+        if not values['transaction_number'] and not self.generates_transaction_numbers:
+            raise ValueError("Erreur : La transaction n'a pas de numéro.")
+        if len(values['transaction_number']) > MAX_LENGTHS['transaction_number']:
+            raise ValueError("Erreur : Le numéro de transaction %s est trop long." % (values['transaction_number']))
+        for name in ('wording', 'bank_detail'):
+            values[name] = values[name][:MAX_LENGTHS[name]]
+        for name in ('debit', 'credit'):
+            try:
+                amount = Decimal(str(values[name]))
+                valid = amount.is_finite() and abs(amount.quantize(CENT)) < AMOUNT_LIMIT
+            except ArithmeticError:
+                valid = False
+            if not valid:
+                raise ValueError("Erreur : Le montant %s n'est pas valide." % (values[name]))
+        return values
+
+    def validate_batch(self, records):
+        ''' Normalize and validate the records. Return the values of the valid lines, as tuples in the order of
+        VALUE_FIELDS (cheaper to send back from a worker than dicts), and the error messages of the other ones.
+        Run by the workers of the validation pool. '''
+        rows = []
+        msg_parse_error = []
+        for record in records:
+            try:
+                values = self.normalize(record)
+                if values is not None:
+                    values = self.validate(values)
+                    rows.append(tuple(values[name] for name in VALUE_FIELDS))
+            except Exception as e:
+                msg_parse_error.append(MSG_LINE_NOT_IMPORTED % (self.describe(record)))
+                lg.warning(e)
+        return rows, msg_parse_error
+
+    def generated_transaction_number(self, values, seen):
+        ''' Return a transaction number for the values of a line without one: a digest of the bank, the values and
+        the number of identical lines met before in the file (counted in seen), so that importing the same lines
+        again gives the same numbers. '''
+        key = "|".join(str(value) for value in (self.bank.pk, values['transaction_date'], values['debit'],
+                                                 values['credit'], values['wording'], values['bank_detail']))
+        seen[key] = seen.get(key, 0) + 1
+        return "%s-%s" % (self.datafile_format, hashlib.sha1(("%s|%s" % (key, seen[key])).encode()).hexdigest())
+
+    def parse(self, records, parallel=True):
+        ''' Normalize and validate the records by batches, in the validation pool if parallel and there is more
+        than one batch. Return the list of unsaved BankLine objects linked to bank and the error messages of the
+        lines which could not be parsed. '''
+        banklines = []
+        msg_parse_error = []
+        seen = {}
+        # BankLine is built from positional arguments, in the order of its fields: more than twice as fast as
+        # keyword arguments for the many lines of a datafile
+        fields = BankLine._meta.concrete_fields
+        defaults = [self.bank.pk if field.attname == 'bank_id' else field.get_default() for field in fields]
+        positions = [[field.attname for field in fields].index(name) for name in VALUE_FIELDS]
+        number_index = VALUE_FIELDS.index('transaction_number')
+        bank_field = BankLine._meta.get_field('bank')
+        for rows, messages in self._validated_batches(records, parallel):
+            msg_parse_error.extend(messages)
+            for row in rows:
+                arguments = list(defaults)
+                for position, value in zip(positions, row):
+                    arguments[position] = value
+                if not row[number_index]:
+                    arguments[positions[number_index]] = self.generated_transaction_number(
+                        dict(zip(VALUE_FIELDS, row)), seen)
+                bankline = BankLine(*arguments)
+                bank_field.set_cached_value(bankline, self.bank)
+                banklines.append(bankline)
+        return banklines, msg_parse_error
+
+    def _validated_batches(self, records, parallel):
+        ''' Yield the result of validate_batch for each batch of records, in order. At most two batches per
+        worker are queued, so records are still read as the batches are validated. '''
+        batches = iter_batches(records, VALIDATION_BATCH_SIZE)
+        first_batches = list(itertools.islice(batches, 2))
+        workers = get_validation_workers()
+        if not parallel or workers <= 0 or len(first_batches) < 2:
+            yield from map(self.validate_batch, itertools.chain(first_batches, batches))
+            return
+        executor = get_validation_executor()
+        pending = deque()
+        for batch in itertools.chain(first_batches, batches):
+            pending.append(executor.submit(self.validate_batch, batch))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def parse_datafile(self, datafile, parallel=True):
+        ''' Parse datafile, a binary file object or an iterable of bytes chunks (e.g. UploadedFile.chunks()). The
+        chunks are decoded incrementally (see detect_encoding) and parsed as they are read, so the file is never
+        held in memory. Return the same values as parse. '''
+        head, chunks = peek_head(iter_chunks(datafile))
+        if not self.binary:
+            chunks = iter_decoded(chunks, self.encoding or detect_encoding(head))
+        return self.parse(self.records(chunks), parallel)
+
+
+@register
+class OfxSgmlImporter(Importer):
+    ''' OFX 1.x (SGML) statements, one record per <STMTTRN> aggregate. '''
+    datafile_format = Bank.FORMAT_OFX_SGML
+
+    def records(self, chunks):
+        return iter_ofxsgml_transactions(chunks)
+
+    def normalize(self, transaction):
+        date_re = OFX_DATE.match(transaction.get('DTPOSTED', ''))
+        if date_re is None:
+            raise ValueError("Erreur : La date de la transaction n a pas pu etre recuperee.")
+        type_debit_credit = transaction['TRNTYPE']
+        montant = OFX_AMOUNT.match(transaction['TRNAMT']).group(1)
+        montant = montant.replace(",", ".")
+        return {
+            'transaction_date': '%s-%s-%s' % (date_re.group(1), date_re.group(2), date_re.group(3)),
+            'wording': transaction['NAME'],
+            'transaction_number': transaction['FITID'],
+            'debit': montant if type_debit_credit.lower().startswith("debit") else Decimal(0),
+            'credit': montant if type_debit_credit.lower().startswith("credit") else Decimal(0),
+            'bank_detail': transaction.get('MEMO', ""),
+        }
+
+    def describe(self, transaction):
+        return "".join("<%s>%s" % (tag, value) for tag, value in transaction.items())[:64]
+
+
+@register
+class OfxXmlImporter(OfxSgmlImporter):
+    ''' OFX 2.x (XML) statements, with the same records as OFX 1.x. '''
+    datafile_format = Bank.FORMAT_OFX_XML
+    binary = True
+
+    def records(self, chunks):
+        return iter_ofxxml_transactions(chunks)
+
+
+@register
+class CepacCsvImporter(Importer):
+    ''' CSV files of the CEPAC bank: date (DD/MM/YY), transaction number (followed by " -"), wording, debit,
+    credit and detail. The rows without such a date (headers, balances) are ignored. '''
+    datafile_format = Bank.FORMAT_CSV
+
+    def records(self, chunks):
+        return csv.reader(iter_lines(chunks), delimiter=';', quotechar='|')
+
+    def normalize(self, row):
+        if len(row) < 6:
+            return None
+        date_re = CEPAC_DATE.match(row[0].strip())
+        if date_re is None:
+            return None
+        number_re = CEPAC_TRANSACTION_NUMBER.match(row[1])
+        return {
+            'transaction_date': '20%s-%s-%s' % (date_re.group(3), date_re.group(2), date_re.group(1)),
+            # Delete multiple whitespace in wording and detail to avoid future search errors.
+            'wording': re.sub(' +', ' ', row[2]).strip(),
+            # Get transaction number (fitid) without " -" to match with ofx datafile by CEPAC
+            'transaction_number': number_re.group(1) if number_re is not None else row[1].strip(),
+            'debit': row[3].replace(",", ".") if row[3] else Decimal(0),
+            'credit': row[4].replace(",", ".") if row[4] else Decimal(0),
+            'bank_detail': re.sub(' +', ' ', row[5]).strip(),
+        }
+
+    def describe(self, row):
+        return row[1].strip() if len(row) > 1 else ";".join(row)[:64]
+
+
+@register
+class ConfigurableCsvImporter(Importer):
+    ''' CSV files whose layout is given by the BankCsvFormat of the bank: the field read from each column, the
+    delimiters, the date format and the decimal separator. A row without transaction number gets a generated one. '''
+    datafile_format = Bank.FORMAT_CSV_CONFIGURABLE
+    generates_transaction_numbers = True
+
+    def __init__(self, bank):
+        super().__init__(bank)
+        try:
+            csv_format = bank.csv_format
+        except BankCsvFormat.DoesNotExist:
+            raise ValueError("Le format CSV du compte %s n'est pas configuré." % (bank))
+        self.columns = csv_format.get_columns()
+        self.delimiter = csv_format.delimiter
+        self.quotechar = csv_format.quotechar
+        self.date_format = csv_format.date_format
+        self.decimal_separator = csv_format.decimal_separator
+        self.skip_rows = csv_format.skip_rows
+        self.encoding = csv_format.encoding or None
+
+    def records(self, chunks):
+        rows = csv.reader(iter_lines(chunks), delimiter=self.delimiter, quotechar=self.quotechar)
+        return itertools.islice(rows, self.skip_rows, None)
+
+    def cell(self, row, name):
+        ''' Return the stripped value of the column of name in row, "" if there is none. '''
+        index = self.columns.get(name)
+        return row[index].strip() if index is not None and index < len(row) else ""
+
+    def normalize(self, row):
+        if not any(value.strip() for value in row):
+            return None
+        if BankCsvFormat.COLUMN_AMOUNT in self.columns:
+            debit, credit = debit_credit(parse_amount(self.cell(row, BankCsvFormat.COLUMN_AMOUNT),
+                                                      self.decimal_separator))
+        else:
+            # debit and credit columns may both be unsigned, the column gives the sign
+            debit = self.cell(row, BankCsvFormat.COLUMN_DEBIT)
+            credit = self.cell(row, BankCsvFormat.COLUMN_CREDIT)
+            debit = "-" + parse_amount(debit, self.decimal_separator).lstrip("+-") if debit else Decimal(0)
+            credit = parse_amount(credit, self.decimal_separator).lstrip("+-") if credit else Decimal(0)
+        return {
+            'transaction_date': datetime.datetime.strptime(self.cell(row, BankCsvFormat.COLUMN_DATE),
+                                                           self.date_format).date().isoformat(),
+            'wording': collapse(self.cell(row, BankCsvFormat.COLUMN_WORDING)),
+            'transaction_number': self.cell(row, BankCsvFormat.COLUMN_NUMBER),
+            'debit': debit,
+            'credit': credit,
+            'bank_detail': collapse(self.cell(row, BankCsvFormat.COLUMN_DETAIL)),
+        }
+
+    def describe(self, row):
+        return self.delimiter.join(row)[:64]
+
+
+@register
+class QifImporter(Importer):
+    ''' QIF files: the records of the bank account sections, with the date (D), amount (T or U), payee (P, the
+    wording), memo (M, the detail) and number (N, added to the detail). QIF has no transaction identifier, so
+    the transaction numbers are generated. '''
+    datafile_format = Bank.FORMAT_QIF
+    generates_transaction_numbers = True
+
+    def records(self, chunks):
+        return iter_qif_records(chunks)
+
+    @staticmethod
+    def parse_date(text):
+        text = text.replace("'", "/").replace(" ", "")
+        for date_format in QIF_DATE_FORMATS:
+            try:
+                return datetime.datetime.strptime(text, date_format).date().isoformat()
+            except ValueError:
+                pass
+        raise ValueError("Erreur : La date %s n'est pas valide." % (text))
+
+    def normalize(self, record):
+        if record['!'].lower() not in QIF_TRANSACTION_TYPES:
+            return None
+        debit, credit = debit_credit(parse_amount(record.get('T') or record.get('U') or ""))
+        memo = collapse(record.get('M', ""))
+        detail = [memo] if record.get('P') else []
+        if record.get('N'):
+            detail.append("N° %s" % (record['N']))
+        return {
+            'transaction_date': self.parse_date(record.get('D', "")),
+            'wording': collapse(record.get('P', "")) or memo,
+            'transaction_number': "",
+            'debit': debit,
+            'credit': credit,
+            'bank_detail': " ".join(value for value in detail if value),
+        }
+
+    def describe(self, record):
+        return " ".join("%s%s" % (code, value) for code, value in record.items() if code != '!')[:64]
+
+
+@register
+class Camt053Importer(Importer):
+    ''' CAMT.053 (ISO 20022) statements, one record per booked entry (<Ntry>). The wording is the name of the
+    other party, or else the additional information of the entry, and the detail its remittance information.
+    The transaction number is the reference given by the bank (AcctSvcrRef, else NtryRef or EndToEndId). '''
+    datafile_format = Bank.FORMAT_CAMT053
+    binary = True
+    generates_transaction_numbers = True
+
+    def records(self, chunks):
+        return iter_camt053_entries(chunks)
+
+    def normalize(self, entry):
+        if entry.get('Sts', CAMT_BOOKED) != CAMT_BOOKED:
+            return None
+        amount = parse_amount(entry.get('Amt', ""), ".").lstrip("+-")
+        if entry.get('CdtDbtInd') == CAMT_DEBIT:
+            debit, credit, name = "-" + amount, Decimal(0), entry.get('CdtrNm', "")
+        elif entry.get('CdtDbtInd') == CAMT_CREDIT:
+            debit, credit, name = Decimal(0), amount, entry.get('DbtrNm', "")
+        else:
+            raise ValueError("Erreur : Le sens de l'opération %s n'est pas valide." % (entry.get('CdtDbtInd')))
+        information, remittance = collapse(entry.get('AddtlNtryInf', "")), collapse(entry.get('Ustrd', ""))
+        wording = collapse(name) or information or remittance
+        end_to_end_id = entry.get('EndToEndId', "")
+        return {
+            'transaction_date': (entry.get('BookgDt') or entry.get('ValDt') or "")[:10],
+            'wording': wording,
+            'transaction_number': (entry.get('AcctSvcrRef') or entry.get('NtryRef')
+                                   or (end_to_end_id if end_to_end_id != "NOTPROVIDED" else "")),
+            'debit': debit,
+            'credit': credit,
+            'bank_detail': remittance if remittance != wording else "",
+        }
+
+    def describe(self, entry):
+        return " ".join(entry.get(key, "") for key in ('AcctSvcrRef', 'BookgDt', 'CdtDbtInd', 'Amt'))[:64]
@@ -0,0 +1,259 @@
+''' Lightweight instrumentation of the requests and imports, usable in production (unlike debug_toolbar).
+
+InstrumentationMiddleware records for each request the number of SQL queries, the total SQL time and the slowest
+queries (with connection.execute_wrapper), the time spent rendering templates and the total duration, streamed
+content included. ImportTimer times the phases of an import: parse, dedup, insert, commit and invalidate.
+Both are kept in a rolling in-process history (see RollingStats) shown by the stats view, and logged as
+"key=value" lines by the logger banklinemanager.instrumentation: a request slower than BANKLINE_SLOW_REQUEST_MS
+is logged as a warning with its slowest queries, the other requests and the imports at the info level.
+Each process has its own history. '''
+import heapq
+import logging as lg
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+
+
+logger = lg.getLogger(__name__)
+
+# Slowest queries kept per request, shown for the slow requests
+SLOWEST_QUERIES_KEPT = 5
+SQL_MAX_LENGTH = 2000
+# View name of the requests matching no URL (e.g. 404 scans), grouped so the stats per view stay bounded
+UNRESOLVED_VIEW = '<unresolved>'
+
+_local = threading.local()
+_stats = None
+_stats_lock = threading.Lock()
+
+
+def get_slow_request_ms():
+    return getattr(settings, 'BANKLINE_SLOW_REQUEST_MS', 1000)
+
+
+def get_stats():
+    ''' Return the RollingStats of this process, created on first use. '''
+    global _stats
+    with _stats_lock:
+        if _stats is None:
+            _stats = RollingStats(getattr(settings, 'BANKLINE_INSTRUMENTATION_HISTORY', 200))
+        return _stats
+
+
+def format_fields(event, fields):
+    ''' Return a structured log line: the event then the fields as key=value, floats in milliseconds rounded. '''
+    return " ".join(["event=%s" % (event)] + ["%s=%s" % (key, "%.1f" % (value) if isinstance(value, float) else value)
+                                             for key, value in fields.items() if not isinstance(value, (list, dict))])
+
+
+class RequestRecorder:
+    ''' Counters of one request. Called by the database connection for each query (see execute_wrapper). '''
+    def __init__(self):
+        self.query_count = 0
+        self.sql_time = 0.0
+        self.render_time = 0.0
+        # heap of (duration, query number, sql, params), smallest first; the SQL with its parameters is only
+        # formatted for the queries still kept at the end (a bulk insert may have thousands of parameters)
+        self._slowest = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.query_count += 1
+            self.sql_time += duration
+            query = (duration, self.query_count, sql, None if many else params)
+            if len(self._slowest) < SLOWEST_QUERIES_KEPT:
+                heapq.heappush(self._slowest, query)
+            elif duration > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, query)
+
+    @staticmethod
+    def _with_params(sql, params):
+        return ("%s -- %r" % (sql, params) if params else sql)[:SQL_MAX_LENGTH]
+
+    def slowest_queries(self):
+        ''' Return the slowest queries as a list of {'sql', 'ms'}, slowest first. '''
+        return [{'sql': self._with_params(sql, params), 'ms': round(duration * 1000, 1)}
+                for duration, number, sql, params in sorted(self._slowest, reverse=True)]
+
+
+def _instrument_template_rendering():
+    ''' Wrap the render method of the Django template backend, so the top level renders (render,
+    render_to_string, TemplateResponse) add their duration to the recorder of the current request. '''
+    from django.template.backends.django import Template
+    if getattr(Template.render, 'instrumented', False):
+        return
+    render = Template.render
+
+    def timed_render(self, context=None, request=None):
+        recorder = getattr(_local, 'recorder', None)
+        if recorder is None:
+            return render(self, context, request)
+        start = time.perf_counter()
+        try:
+            return render(self, context, request)
+        finally:
+            recorder.render_time += time.perf_counter() - start
+
+    timed_render.instrumented = True
+    Template.render = timed_render
+
+
+@contextmanager
+def recording(recorder):
+    ''' Record the queries and template renders of this thread into recorder. '''
+    previous = getattr(_local, 'recorder', None)
+    _local.recorder = recorder
+    try:
+        with connection.execute_wrapper(recorder):
+            yield
+    finally:
+        _local.recorder = previous
+
+
+class InstrumentationMiddleware:
+    ''' Record the SQL queries, render time and duration of each request into the rolling stats. Put it first
+    in MIDDLEWARE so it covers the other middlewares. '''
+    def __init__(self, get_response):
+        self.get_response = get_response
+        _instrument_template_rendering()
+
+    def __call__(self, request):
+        recorder = RequestRecorder()
+        start = time.perf_counter()
+        with recording(recorder):
+            response = self.get_response(request)
+
+        if response.streaming:
+            response.streaming_content = self.stream(response.streaming_content, request, response, recorder, start)
+        else:
+            self.finish(request, response, recorder, start)
+        return response
+
+    def stream(self, streaming_content, request, response, recorder, start):
+        ''' Yield streaming_content, still recording, and finish the record once it is all sent. '''
+        try:
+            with recording(recorder):
+                yield from streaming_content
+        finally:
+            self.finish(request, response, recorder, start)
+
+    @staticmethod
+    def finish(request, response, recorder, start):
+        duration = time.perf_counter() - start
+        resolver_match = getattr(request, 'resolver_match', None)
+        record = {
+            'view': resolver_match.view_name if resolver_match else UNRESOLVED_VIEW,
+            'method': request.method,
+            'path': request.get_full_path()[:200],
+            'status': response.status_code,
+            'duration_ms': round(duration * 1000, 1),
+            'queries': recorder.query_count,
+            'sql_ms': round(recorder.sql_time * 1000, 1),
+            'render_ms': round(recorder.render_time * 1000, 1),
+        }
+        slowest = recorder.slowest_queries()
+        if slowest:
+            record['slowest_sql_ms'] = slowest[0]['ms']
+        slow = record['duration_ms'] >= get_slow_request_ms()
+        if slow:
+            record['slowest_queries'] = slowest
+            logger.warning("%s %s" % (format_fields('slow_request', record),
+                                      " | ".join("%s ms: %s" % (query['ms'], query['sql']) for query in slowest)))
+        else:
+            logger.info(format_fields('request', record))
+        get_stats().add_request(record, slow)
+
+
+class ImportTimer:
+    ''' Durations of the phases of an import. start(phase) ends the current phase and starts the next one,
+    stop() ends the current phase. A phase started several times adds up. '''
+    def __init__(self, label):
+        self.label = label
+        self.phases = {}
+        self.line_count = None
+        self.inserted_line_count = None
+        self._phase = None
+        self._start = None
+
+    def start(self, phase):
+        self.stop()
+        self._phase = phase
+        self._start = time.perf_counter()
+
+    def stop(self):
+        if self._phase is not None:
+            self.phases[self._phase] = self.phases.get(self._phase, 0.0) + time.perf_counter() - self._start
+            self._phase = None
+
+    def as_dict(self):
+        record = {'label': self.label, 'lines': self.line_count, 'inserted': self.inserted_line_count}
+        record.update(("%s_ms" % (phase), round(duration * 1000, 1)) for phase, duration in self.phases.items())
+        record['total_ms'] = round(sum(self.phases.values()) * 1000, 1)
+        return record
+
+    def finish(self):
+        ''' Stop the timer, log its phases and add them to the rolling stats. '''
+        self.stop()
+        record = self.as_dict()
+        logger.info(format_fields('import', record))
+        get_stats().add_import(record)
+
+
+class RollingStats:
+    ''' Last history_size requests, slow requests and imports of this process, with totals per view. '''
+    def __init__(self, history_size):
+        self.lock = threading.Lock()
+        self.requests = deque(maxlen=history_size)
+        self.slow_requests = deque(maxlen=history_size)
+        self.imports = deque(maxlen=history_size)
+        self.views = {}
+
+    def add_request(self, record, slow):
+        with self.lock:
+            self.requests.append(record)
+            if slow:
+                self.slow_requests.append(record)
+            view = self.views.setdefault(record['view'], {
+                'count': 0, 'slow': 0, 'duration_ms': 0.0, 'max_duration_ms': 0.0, 'queries': 0, 'sql_ms': 0.0,
+                'render_ms': 0.0})
+            view['count'] += 1
+            view['slow'] += slow
+            view['max_duration_ms'] = max(view['max_duration_ms'], record['duration_ms'])
+            for key in ('duration_ms', 'queries', 'sql_ms', 'render_ms'):
+                view[key] += record[key]
+
+    def add_import(self, record):
+        with self.lock:
+            self.imports.append(record)
+
+    def as_dict(self):
+        ''' Return the history and the mean values per view, ready for JSON. '''
+        with self.lock:
+            views = {}
+            for name, view in self.views.items():
+                views[name] = {'count': view['count'], 'slow': view['slow'],
+                               'max_duration_ms': round(view['max_duration_ms'], 1)}
+                views[name].update(("mean_%s" % (key), round(view[key] / view['count'], 1))
+                                   for key in ('duration_ms', 'queries', 'sql_ms', 'render_ms'))
+            return {
+                'slow_request_ms': get_slow_request_ms(),
+                'views': views,
+                'requests': list(self.requests),
+                'slow_requests': list(self.slow_requests),
+                'imports': list(self.imports),
+            }
+
+    def clear(self):
+        with self.lock:
+            self.requests.clear()
+            self.slow_requests.clear()
+            self.imports.clear()
+            self.views.clear()
@@ -0,0 +1,121 @@
+''' Background import of datafiles.
+
+An uploaded datafile is copied to a temporary file and an ImportJob is created, then the import runs in a
+thread pool of the web process, so the upload returns immediately and several files are imported at once.
+No external broker is needed. Parsing runs in parallel but writes are serialized by a lock, since SQLite
+allows a single writer. The job status and counters are updated at each phase for the polling endpoint.
+The SHA-256 of the file is computed during the copy: a content already imported into the same bank (see
+ImportedFile) ends the job at once. Setting BANKLINE_IMPORT_WORKERS to 0 runs the jobs synchronously
+(e.g. in tests). '''
+import logging as lg
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .instrumentation import ImportTimer
+from .models import MSG_LINES_ALREADY_COVERED, BankLine, ImportedFile, ImportJob
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_write_lock = threading.Lock()
+
+
+def get_import_workers():
+    return getattr(settings, 'BANKLINE_IMPORT_WORKERS', 2)
+
+
+def get_executor():
+    ''' Return the thread pool running the import jobs, created on first use. '''
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=get_import_workers(), thread_name_prefix='bankline-import')
+        return _executor
+
+
+def submit_import_job(bank, uploaded_file):
+    ''' Copy uploaded_file (a Django UploadedFile) to a temporary file chunk by chunk and queue its import
+    into bank. Return the ImportJob. '''
+    job = ImportJob.objects.create(bank=bank, file_name=uploaded_file.name[:255])
+    fd, path = tempfile.mkstemp(prefix='bankline-import-')
+    with os.fdopen(fd, 'wb') as datafile:
+        sha256, size = ImportedFile.hash_chunks(_written(datafile, uploaded_file.chunks()))
+
+    # the same content already imported into this bank is not parsed again
+    imported_file = ImportedFile.objects.filter(bank=bank, sha256=sha256).select_related('bank').first()
+    if imported_file is not None:
+        os.remove(path)
+        job.status = ImportJob.STATUS_DONE
+        job.messages = imported_file.already_imported_message()
+        job.finished_at = timezone.now()
+        _save_job(job)
+        return job
+
+    if get_import_workers() > 0:
+        get_executor().submit(run_import_job, job.pk, path, sha256, size, True)
+    else:
+        run_import_job(job.pk, path, sha256, size)
+    return job
+
+
+def _written(datafile, chunks):
+    ''' Yield the chunks once written to datafile. '''
+    for chunk in chunks:
+        datafile.write(chunk)
+        yield chunk
+
+
+def run_import_job(job_id, path, sha256, size, close_connection=False):
+    ''' Import the datafile at path, of SHA-256 sha256 and size bytes, for the ImportJob job_id, then record it in
+    the ImportedFile ledger if imported cleanly and delete it. The lines already imported by an earlier file of the
+    ledger are skipped.
+    close_connection closes the database connection of the worker thread at the end. '''
+    job = ImportJob.objects.select_related('bank').get(pk=job_id)
+    timer = ImportTimer("job %s %s" % (job.pk, job.file_name))
+    try:
+        job.status = ImportJob.STATUS_PARSING
+        _save_job(job, ['status'])
+        timer.start('parse')
+        with open(path, 'rb') as datafile:
+            banklines, msg_insert_error = BankLine.parse_datafile(job.bank, datafile)
+        parse_error_counter = len(msg_insert_error)
+
+        job.status = ImportJob.STATUS_INSERTING
+        job.line_counter = len(banklines)
+        _save_job(job, ['status', 'line_counter'])
+        new_banklines, skipped_line_counter = ImportedFile.narrow_banklines(job.bank, banklines)
+        if skipped_line_counter:
+            msg_insert_error.append(MSG_LINES_ALREADY_COVERED % (skipped_line_counter))
+        timer.start('wait_writer')
+        with _write_lock:
+            job.inserted_line_counter = BankLine.bulk_insert_banklines(new_banklines, msg_insert_error, timer=timer)
+            ImportedFile.record(job.bank, job.file_name, sha256, size, banklines, job.inserted_line_counter,
+                                parse_error_counter)
+        timer.line_count, timer.inserted_line_count = job.line_counter, job.inserted_line_counter
+        timer.finish()
+
+        job.status = ImportJob.STATUS_DONE
+        msg_insert_error.append("-> %s lignes sur %s ont été importés." % (job.inserted_line_counter, job.line_counter))
+        job.messages = "\n".join(msg_insert_error)
+    except Exception as e:
+        lg.warning("=> ERREUR import %s : %s" % (job.file_name, e))
+        job.status = ImportJob.STATUS_FAILED
+        job.messages = "-> Le fichier n'a pas été importé  -- file %s, %s" % (job.file_name, e)
+    finally:
+        job.finished_at = timezone.now()
+        _save_job(job)
+        os.remove(path)
+        if close_connection:
+            connection.close()
+
+
+def _save_job(job, update_fields=None):
+    ''' Save job once no other worker is writing, instead of waiting for the SQLite write lock in the database. '''
+    with _write_lock:
+        job.save(update_fields=update_fields)
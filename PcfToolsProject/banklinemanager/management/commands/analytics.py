@@ -0,0 +1,142 @@
+import datetime
+import json
+import time
+from collections import defaultdict
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from banklinemanager import analytics
+
+
+def least_squares(values):
+    ''' Return the slope and intercept of the least squares line of values against their indexes
+    (statistics.linear_regression needs Python 3.10). '''
+    x_mean = (len(values) - 1) / 2
+    y_mean = sum(values) / len(values)
+    slope = (sum((x - x_mean) * (y - y_mean) for x, y in enumerate(values))
+             / sum((x - x_mean) ** 2 for x in range(len(values))))
+    return slope, y_mean - slope * x_mean
+
+
+def python_statistics(banklines, top=analytics.LARGEST_OUTFLOWS, forecast_months=analytics.FORECAST_MONTHS):
+    ''' Compute the same statistics as analytics.cashflow_statistics with a Python loop over the BankLine
+    instances, as done without NumPy. Kept to benchmark and check the vectorized version. '''
+    banks = defaultdict(list)
+    for bankline in banklines.order_by('bank', 'transaction_date', 'pk'):
+        banks[bankline.bank_id].append(bankline)
+
+    results = []
+    for bank_id, lines in banks.items():
+        balance, dates, values, outflows = Decimal(0), [], [], []
+        months = {}
+        for bankline in lines:
+            amount = Decimal(bankline.debit or 0) + Decimal(bankline.credit or 0)
+            balance += amount
+            if dates and dates[-1] == bankline.transaction_date.isoformat():
+                values[-1] = balance
+            else:
+                dates.append(bankline.transaction_date.isoformat())
+                values.append(balance)
+            month = months.setdefault(bankline.transaction_date.strftime('%Y-%m'), [0, Decimal(0), Decimal(0)])
+            month[0] += 1
+            month[1] += Decimal(bankline.debit or 0)
+            month[2] += Decimal(bankline.credit or 0)
+            if amount < 0:
+                outflows.append((amount, bankline.transaction_date, bankline.pk))
+
+        first, last = lines[0].transaction_date, lines[-1].transaction_date
+        month_list = []
+        year, month_number = first.year, first.month
+        while (year, month_number) <= (last.year, last.month):
+            label = "%04d-%02d" % (year, month_number)
+            line_count, debit, credit = months.get(label, [0, Decimal(0), Decimal(0)])
+            month_list.append({'month': label, 'line_count': line_count, 'debit': float(debit),
+                               'credit': float(credit), 'net': float(debit + credit)})
+            year, month_number = (year + 1, 1) if month_number == 12 else (year, month_number + 1)
+
+        nets = [month['net'] for month in month_list]
+        history = nets[-analytics.FORECAST_HISTORY_MONTHS:]
+        if len(history) > 1:
+            slope, intercept = least_squares(history)
+        else:
+            slope, intercept = 0, history[0]
+        forecast, forecast_balance = [], balance
+        for index in range(forecast_months):
+            net = Decimal(round((slope * (len(history) + index) + intercept) * 100)) / 100
+            forecast_balance += net
+            forecast.append({'month': "%04d-%02d" % (year, month_number), 'net': float(net),
+                             'balance': float(forecast_balance)})
+            year, month_number = (year + 1, 1) if month_number == 12 else (year, month_number + 1)
+
+        results.append({
+            'bank': bank_id,
+            'line_count': len(lines),
+            'balance': {'dates': dates, 'values': [float(value) for value in values], 'min': float(min(values)),
+                        'max': float(max(values)), 'final': float(balance)},
+            'months': month_list,
+            'monthly_average': {key: round(sum(round(month[key] * 100) for month in month_list) / len(month_list) / 100, 2)
+                                for key in ('debit', 'credit', 'net')},
+            'largest_outflows': [{'id': pk, 'date': transaction_date.isoformat(), 'amount': float(amount)}
+                                 for amount, transaction_date, pk in sorted(outflows)[:top]],
+            'forecast': forecast,
+        })
+    return results
+
+
+class Command(BaseCommand):
+    help = "Print the cash-flow statistics of each bank computed with NumPy: balance, monthly averages, largest " \
+        "outflows and forecast. With --benchmark, compare their duration with the ORM and Python loop."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bank', type=int, help="Id of the bank, all banks by default")
+        parser.add_argument('--date-start', help="First date of the lines (YYYY-MM-DD)")
+        parser.add_argument('--date-end', help="Last date of the lines (YYYY-MM-DD)")
+        parser.add_argument('--top', type=int, default=analytics.LARGEST_OUTFLOWS, help="Number of largest outflows")
+        parser.add_argument('--forecast-months', type=int, default=analytics.FORECAST_MONTHS,
+                            help="Number of forecast months")
+        parser.add_argument('--output', help="Write the statistics to this JSON file")
+        parser.add_argument('--benchmark', action='store_true',
+                            help="Also compute the statistics with the ORM and a Python loop, and compare")
+
+    def handle(self, *args, **options):
+        if not analytics.analytics_available():
+            raise CommandError("Les statistiques nécessitent NumPy, qui n'est pas installé.")
+        for option in ('date_start', 'date_end'):
+            if options[option] and analytics.parse_date(options[option]) is None:
+                raise CommandError("Date invalide : %s" % (options[option]))
+        banklines = analytics.filter_banklines(options['bank'], options['date_start'], options['date_end'])
+
+        start = time.perf_counter()
+        results = analytics.cashflow_statistics(banklines, options['top'], options['forecast_months'])
+        duration = time.perf_counter() - start
+        analytics.with_bank_names(results)
+
+        for bank_statistics in results:
+            self.stdout.write("%s : %s lignes, solde %.2f (min %.2f, max %.2f), moyenne mensuelle %.2f" % (
+                bank_statistics['name'], bank_statistics['line_count'], bank_statistics['balance']['final'],
+                bank_statistics['balance']['min'], bank_statistics['balance']['max'],
+                bank_statistics['monthly_average']['net']))
+            self.stdout.write("  prévision : %s" % (", ".join(
+                "%s %.2f" % (month['month'], month['balance']) for month in bank_statistics['forecast'])))
+        self.stdout.write("NumPy : %s lignes en %.2fs" % (sum(result['line_count'] for result in results), duration))
+
+        if options['benchmark']:
+            start = time.perf_counter()
+            reference = python_statistics(banklines, options['top'], options['forecast_months'])
+            reference_duration = time.perf_counter() - start
+            same = [self.comparable(result) for result in results] == [self.comparable(result) for result in reference]
+            self.stdout.write("ORM et boucle Python : %.2fs (x%.1f), résultats %s" % (
+                reference_duration, reference_duration / duration if duration else 0,
+                "identiques" if same else "DIFFÉRENTS"))
+            if not same:
+                raise CommandError("Les statistiques NumPy diffèrent de la boucle Python.")
+
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump({'date': datetime.datetime.now().isoformat(timespec='seconds'), 'banks': results},
+                          output_file, indent=2)
+
+    @staticmethod
+    def comparable(bank_statistics):
+        return {key: value for key, value in bank_statistics.items() if key != 'name'}
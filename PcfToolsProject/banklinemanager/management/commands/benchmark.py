@@ -0,0 +1,215 @@
+import csv
+import datetime
+import io
+import json
+import platform
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import RequestFactory
+
+from banklinemanager import search_cache, views
+from banklinemanager.models import Bank, BankLine
+from banklinemanager.pagination import KeysetPaginator
+from banklinemanager.synthetic import (benchmark_database, synthetic_transactions, to_csv_cepac, to_ofxsgml,
+                                      to_ofxxml)
+
+
+IMPORT_FORMATS = (
+    (Bank.FORMAT_OFX_SGML, 'ofxsgml'),
+    (Bank.FORMAT_OFX_XML, 'ofxxml'),
+    (Bank.FORMAT_CSV, 'csv_cepac'),
+)
+# search_bankline arguments: query, type_search, date_start, date_end, sum_min, sum_max, bank (set per run)
+SEARCHES = (
+    ('contains', ("carrefour", "contains", "", "", "", "", None)),
+    ('contains_keywords', ("loyer\r\nsalaire", "contains", "", "", "", "", None)),
+    ('startswith', ("CB BOUL", "startswith", "", "", "", "", None)),
+    ('fuzzy', ("pharmacei", "fuzzy", "", "", "", "", None)),
+    ('date', ("", "contains", "2016-03-01", "2016-05-31", "", "", None)),
+    ('amount', ("", "contains", "", "", "-50", "-20", None)),
+    ('bank', ("", "contains", "", "", "", "", 'bank')),
+    ('combined', ("cb", "contains", "2015-01-01", "2017-12-31", "-100", "-10", 'bank')),
+)
+
+
+class Command(BaseCommand):
+    help = "Benchmark the import of synthetic OFX SGML, OFX XML and CEPAC CSV datafiles, search_bankline under " \
+        "each filter, the index, search and export views. Everything runs on a test database created for the run, " \
+        "in a transaction rolled back after each size. " \
+        "Results can be written to JSON and compared with a baseline written by a previous run."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10000],
+                            help="Number of lines of each datafile, one run per size (e.g. 10000 100000 1000000)")
+        parser.add_argument('--repeat', type=int, default=5, help="Number of runs of each search, median is kept")
+        parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic data generator")
+        parser.add_argument('--output', help="Write the results to this JSON file")
+        parser.add_argument('--baseline', help="Compare the results with this JSON file (output of a previous run)")
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help="Flag a regression when a duration exceeds the baseline by this fraction")
+        parser.add_argument('--min-seconds', type=float, default=0.005,
+                            help="Do not flag durations under this value, too short to be measured reliably")
+        parser.add_argument('--fail-on-regression', action='store_true',
+                            help="Exit with an error when a regression is flagged")
+        parser.add_argument('--no-test-database', action='store_false', dest='test_database',
+                            help="Run on the current database instead of a test database created for the run "
+                                 "(e.g. from the tests, which already run on a test database)")
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['baseline']:
+            try:
+                with open(options['baseline']) as baseline_file:
+                    baseline = json.load(baseline_file)['results']
+            except (OSError, ValueError, KeyError) as e:
+                raise CommandError("Baseline illisible %s : %s" % (options['baseline'], e))
+
+        results = {}
+        with benchmark_database(options['test_database']):
+            try:
+                for size in options['sizes']:
+                    with transaction.atomic():
+                        results[str(size)] = self.run(size, options['seed'], options['repeat'])
+                        transaction.set_rollback(True)
+            finally:
+                # cached searches may hold the rolled back lines
+                search_cache.get_cache().clear()
+                cache.delete(views.BANKLINE_TOTAL_CACHE_KEY)
+
+        report = {
+            'meta': {
+                'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'sizes': options['sizes'],
+                'seed': options['seed'],
+                'repeat': options['repeat'],
+                'database': connection.vendor,
+                'python': platform.python_version(),
+            },
+            'results': results,
+        }
+        regressions = self.print_results(results, baseline, options['threshold'], options['min_seconds'])
+        report['regressions'] = regressions
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump(report, output_file, indent=2)
+            self.stdout.write("Results written to %s" % (options['output']))
+        if regressions and options['fail_on_regression']:
+            raise CommandError("%s regression(s): %s" % (len(regressions), ", ".join(regressions)))
+
+    def run(self, size, seed, repeat):
+        ''' Import size synthetic lines in each datafile format (one bank per format), then time the searches,
+        views and exports on all of them. Return {name: measure}. '''
+        results = {}
+        banks = []
+        for index, (datafile_format, name) in enumerate(IMPORT_FORMATS):
+            bank = Bank.objects.create(name="BENCH %s" % (name), _account_number=10**13 + index,
+                                       _datafile_format=datafile_format)
+            banks.append(bank)
+            transactions = synthetic_transactions(size, prefix="BENCH%s-" % (index), seed=seed + index)
+            if datafile_format == Bank.FORMAT_OFX_SGML:
+                datafile = to_ofxsgml(transactions)
+                insert = lambda: BankLine.insert_data_from_ofxsgml(bank, datafile)
+            elif datafile_format == Bank.FORMAT_OFX_XML:
+                datafile = to_ofxxml(transactions)
+                insert = lambda: BankLine.insert_data_from_ofxxml(bank, datafile)
+            else:
+                datafile = to_csv_cepac(transactions)
+                insert = lambda: BankLine.insert_data_from_csv_cepac(
+                    bank, csv.reader(io.StringIO(datafile), delimiter=';', quotechar='|'))
+            start = time.perf_counter()
+            line_count, inserted, msgs = insert()
+            duration = time.perf_counter() - start
+            results['import_%s' % (name)] = {'seconds': duration, 'lines': inserted,
+                                             'lines_per_second': inserted / duration if duration else None}
+
+        for name, arguments in SEARCHES:
+            arguments = arguments[:-1] + (str(banks[0].pk) if arguments[-1] else "",)
+            counts = []
+
+            def search():
+                bankline_list = BankLine.search_bankline(*arguments)[0]
+                totals = BankLine.search_totals(bankline_list)
+                list(KeysetPaginator(bankline_list, views.SEARCH_PAGE_SIZE).page())
+                counts.append(totals['count'])
+
+            results['search_%s' % (name)] = {'seconds': self.median_duration(search, repeat), 'count': counts[-1]}
+
+        request_factory = RequestFactory()
+        user = User.objects.get_or_create(username="benchmark", defaults={
+            'email': "benchmark@example.com", 'is_staff': True, 'is_superuser': True})[0]
+
+        def get_view(view, data=None):
+            def get():
+                request = request_factory.get("/", data or {})
+                request.user = user
+                response = view(request)
+                # consume the streamed pages and exports, as a client would
+                if response.streaming:
+                    for chunk in response.streaming_content:
+                        pass
+                else:
+                    response.content
+            return get
+
+        def clear_caches(func):
+            def cleared():
+                search_cache.get_cache().clear()
+                cache.delete(views.BANKLINE_TOTAL_CACHE_KEY)
+                func()
+            return cleared
+
+        first_page = KeysetPaginator(BankLine.objects.all(), views.LISTING_PAGE_SIZE).page()
+        measures = (
+            ('view_index', clear_caches(get_view(views.index))),
+            ('view_index_next_page', clear_caches(get_view(views.index, {'after': first_page.next_cursor}))),
+            ('view_search', clear_caches(get_view(views.search, {'query': "carrefour"}))),
+            ('view_search_cached', get_view(views.search, {'query': "carrefour"})),
+            ('view_search_filters', clear_caches(get_view(views.search, {
+                'query': "cb", 'date_start': "2015-01-01", 'date_end': "2017-12-31", 'sum_min': "-100",
+                'sum_max': "-10"}))),
+            ('export_csv', get_view(views.export, {'format': "csv", 'bank': banks[0].pk})),
+            ('export_ofx', get_view(views.export, {'format': "ofx", 'bank': banks[0].pk})),
+        )
+        for name, measure in measures:
+            results[name] = {'seconds': self.median_duration(measure, repeat)}
+        return results
+
+    def print_results(self, results, baseline, threshold, min_seconds):
+        ''' Print the results, compared with the baseline if any. Return the names of the regressions. '''
+        regressions = []
+        for size, measures in results.items():
+            self.stdout.write("%s lines per datafile" % (size))
+            for name, measure in measures.items():
+                line = "  %-24s %10.4fs" % (name, measure['seconds'])
+                if 'lines_per_second' in measure:
+                    line += " %10.0f lines/s" % (measure['lines_per_second'] or 0)
+                elif 'count' in measure:
+                    line += " %10s lines   " % (measure['count'])
+                else:
+                    line += " " * 19
+                baseline_measure = (baseline or {}).get(size, {}).get(name)
+                if baseline_measure and baseline_measure.get('seconds'):
+                    ratio = measure['seconds'] / baseline_measure['seconds']
+                    line += " x%.2f" % (ratio)
+                    if ratio > 1 + threshold and measure['seconds'] >= min_seconds:
+                        measure['regression'] = True
+                        regressions.append("%s/%s" % (size, name))
+                        line += " REGRESSION"
+                    measure['baseline_ratio'] = ratio
+                self.stdout.write(line)
+        return regressions
+
+    @staticmethod
+    def median_duration(func, repeat):
+        ''' Return the median duration of func() over repeat runs, in seconds. '''
+        durations = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            func()
+            durations.append(time.perf_counter() - start)
+        return statistics.median(durations)
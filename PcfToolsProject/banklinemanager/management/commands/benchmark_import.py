@@ -0,0 +1,106 @@
+import io
+import random
+import re
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError
+
+from banklinemanager.models import Bank, BankLine, IMPORT_BATCH_SIZE
+from banklinemanager.parsers import iter_ofxsgml_transactions
+from banklinemanager.synthetic import benchmark_database, synthetic_transactions, to_ofxsgml
+
+
+def regex_ofxsgml_transactions(ofx_file):
+    ''' Parse as done before iter_ofxsgml_transactions: re.findall on the whole file then one re.search per field. '''
+    for transaction in re.findall(r'<STMTTRN>.*?</STMTTRN>', ofx_file, re.DOTALL):
+        record = {}
+        for tag in ('TRNTYPE', 'DTPOSTED', 'TRNAMT', 'FITID', 'NAME', 'MEMO'):
+            value = re.search(r'<%s>(.*?)\n' % (tag), transaction)
+            if value:
+                record[tag] = value.group(1).strip()
+        yield record
+
+
+class Command(BaseCommand):
+    help = "Benchmark the import of a synthetic OFX file: regex parser against the streaming tokenizer, " \
+        "then one INSERT per line (old path) against bulk_create batches, on a test database created for the run."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lines', type=int, default=50000, help="Number of transactions in the OFX file")
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help="bulk_create batch size")
+        parser.add_argument('--parse-only', action='store_true', help="Only benchmark the parsers, without database")
+        parser.add_argument('--no-test-database', action='store_false', dest='test_database',
+                            help="Run on the current database instead of a test database created for the run "
+                                 "(e.g. from the tests, which already run on a test database)")
+
+    def handle(self, *args, **options):
+        line_count = options['lines']
+        prefix = "BENCH%s-" % (random.randint(0, 10**6))
+        ofx_file = to_ofxsgml(synthetic_transactions(line_count, prefix))
+
+        ofx_stream = io.StringIO(ofx_file)
+
+        def parse_stream():
+            ofx_stream.seek(0)
+            return iter_ofxsgml_transactions(ofx_stream)
+
+        self.benchmark_parser("Regex parser (whole file) ", lambda: regex_ofxsgml_transactions(ofx_file))
+        self.benchmark_parser("Streaming tokenizer       ", parse_stream)
+        if options['parse_only']:
+            return
+
+        # Benchmark writes in a test database of its own, the bank and its lines are deleted at the end.
+        with benchmark_database(options['test_database']):
+            bank = Bank.objects.create(name=prefix, _account_number=random.randint(10**12, 10**13),
+                                       _datafile_format=Bank.FORMAT_OFX_SGML)
+            try:
+                start = time.perf_counter()
+                inserted_old = self.insert_one_by_one(bank, ofx_file)
+                duration_old = time.perf_counter() - start
+                BankLine.objects.filter(bank=bank).delete()
+
+                start = time.perf_counter()
+                banklines, msg_insert_error = BankLine.parse_ofxsgml(bank, ofx_file)
+                inserted_new = BankLine.bulk_insert_banklines(banklines, msg_insert_error, options['batch_size'])
+                duration_new = time.perf_counter() - start
+            finally:
+                bank.delete()
+
+        self.stdout.write("Old path (INSERT per line)  : %s lines in %.2fs (%.0f lines/s)"
+                          % (inserted_old, duration_old, inserted_old / duration_old))
+        self.stdout.write("New path (bulk_create, %s) : %s lines in %.2fs (%.0f lines/s)"
+                          % (options['batch_size'], inserted_new, duration_new, inserted_new / duration_new))
+        self.stdout.write("Speedup x%.1f" % (duration_old / duration_new))
+
+    def benchmark_parser(self, label, parse):
+        ''' Consume the records yielded by parse() and print the throughput, then the memory allocated at peak
+        during a second run traced by tracemalloc (kept out of the timing). '''
+        start = time.perf_counter()
+        record_count = sum(1 for record in parse())
+        duration = time.perf_counter() - start
+        tracemalloc.start()
+        for record in parse():
+            pass
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.stdout.write("%s : %s records in %.2fs (%.0f records/s), peak memory %.1f MB"
+                          % (label, record_count, duration, record_count / duration, peak / 2**20))
+
+    @staticmethod
+    def insert_one_by_one(bank, ofx_file):
+        ''' Import as done before bulk_create: one autocommitted INSERT per line. A one-line bulk_create rather than
+        save(), which now also updates the monthly summary and invalidates the search cache, so only the batching
+        is measured. '''
+        inserted_line_counter = 0
+        banklines, msg_insert_error = BankLine.parse_ofxsgml(bank, ofx_file)
+        for bankline in banklines:
+            try:
+                bankline.compute_amount()
+                bankline.compute_search_text()
+                BankLine.objects.bulk_create([bankline])
+                inserted_line_counter += 1
+            except IntegrityError:
+                pass
+        return inserted_line_counter
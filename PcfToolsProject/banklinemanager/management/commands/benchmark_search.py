@@ -0,0 +1,83 @@
+import datetime
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from banklinemanager.fulltext import fulltext_available
+from banklinemanager.models import Bank, BankLine
+from banklinemanager.synthetic import benchmark_database
+
+
+WORDINGS = ["CB CARREFOUR MARKET", "VIR SEPA LOYER", "PRLV EDF CLIENTS", "CB SNCF INTERNET", "CHQ", "VIR SALAIRE",
+            "CB BOULANGERIE DU PORT", "PRLV ORANGE", "RETRAIT DAB", "CB PHARMACIE CENTRALE"]
+SEARCHES = [(["carrefour"], "contains"), (["loyer", "salaire"], "contains"), (["pharma"], "contains"),
+            (["4242"], "contains"), (["CB BOUL"], "startswith"), (["PRLV"], "startswith"), (["pharmacei"], "fuzzy"),
+            (["boulangrie"], "fuzzy")]
+
+
+class Command(BaseCommand):
+    help = "Benchmark search_bankline keyword lookups on synthetic lines: LIKE scans against the full-text index. " \
+        "Lines are inserted on a test database created for the run, in a transaction rolled back at the end."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lines', type=int, default=1000000, help="Number of synthetic bank lines")
+        parser.add_argument('--repeat', type=int, default=5, help="Number of runs of each search")
+        parser.add_argument('--no-test-database', action='store_false', dest='test_database',
+                            help="Run on the current database instead of a test database created for the run "
+                                 "(e.g. from the tests, which already run on a test database)")
+
+    def handle(self, *args, **options):
+        with benchmark_database(options['test_database']):
+            self.benchmark(options['lines'], options['repeat'])
+
+    def benchmark(self, line_count, repeat):
+        if not fulltext_available():
+            raise CommandError("The full-text index is not available in this database.")
+
+        with transaction.atomic():
+            self.insert_synthetic_lines(line_count)
+            self.stdout.write("%-28s %-10s %12s %12s %8s" % ("keywords", "mode", "LIKE (ms)", "FTS (ms)", "lines"))
+            for keywords, type_search in SEARCHES:
+                durations = {}
+                for fulltext in (False, True):
+                    queryset = BankLine.objects.filter(BankLine.keywords_filter(keywords, type_search, fulltext))
+                    durations[fulltext] = self.median_duration(queryset.count, repeat)
+                self.stdout.write("%-28s %-10s %12.1f %12.1f %8s" % (
+                    ", ".join(keywords), type_search, durations[False], durations[True], queryset.count()))
+            transaction.set_rollback(True)
+
+    def insert_synthetic_lines(self, line_count):
+        rand = random.Random(0)
+        bank = Bank.objects.create(name="BENCH SEARCH", _account_number=10**13)
+        first_date = datetime.date(2010, 1, 1)
+        banklines = []
+        start = time.perf_counter()
+        for i in range(line_count):
+            amount = rand.randint(1, 500000) / 100
+            banklines.append(BankLine(
+                transaction_date=first_date + datetime.timedelta(days=rand.randint(0, 3000)),
+                wording="%s %s" % (rand.choice(WORDINGS), rand.randint(1, 99999)),
+                transaction_number="BENCHSEARCH%09d" % (i),
+                debit=-amount if i % 5 else 0,
+                credit=0 if i % 5 else amount,
+                bank_detail="REF %s" % (rand.randint(1, 10**8)),
+                bank=bank))
+            banklines[-1].compute_search_text()
+            if len(banklines) == 10000:
+                BankLine.objects.bulk_create(banklines)
+                banklines = []
+        BankLine.objects.bulk_create(banklines)
+        self.stdout.write("%s synthetic lines inserted and indexed in %.1fs" % (line_count, time.perf_counter() - start))
+
+    @staticmethod
+    def median_duration(func, repeat):
+        ''' Return the median duration of func() over repeat runs, in milliseconds. '''
+        durations = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            func()
+            durations.append((time.perf_counter() - start) * 1000)
+        return statistics.median(durations)
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from banklinemanager.batch import import_datafiles
+from banklinemanager.models import Bank
+
+
+class Command(BaseCommand):
+    help = "Import many datafiles (OFX, CSV, or zip archives of them) in parallel. Each file goes to the bank " \
+        "whose account number is its OFX <ACCTID> or starts its name, e.g. 123456789_2018-06.ofx."
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help="Datafiles or zip archives")
+        parser.add_argument('--bank', type=int, help="Account number of the bank of the files not mapped to a bank")
+        parser.add_argument('--workers', type=int, help="Number of parsing processes (default: number of CPUs)")
+
+    def handle(self, *args, **options):
+        default_bank = None
+        if options['bank'] is not None:
+            try:
+                default_bank = Bank.objects.get(_account_number=options['bank'])
+            except Bank.DoesNotExist:
+                raise CommandError("Aucun compte bancaire n°%s" % (options['bank']))
+
+        total_lines = 0
+        start = time.perf_counter()
+        for result in import_datafiles(options['paths'], default_bank, options['workers']):
+            total_lines += result['line_counter']
+            self.stdout.write("%s [%s] : %s lignes sur %s ont été importés (%.2fs)" % (
+                result['name'], result['bank'] or "?", result['inserted_line_counter'], result['line_counter'],
+                result['duration']))
+            for message in result['msg_insert_error']:
+                self.stdout.write("    %s" % (message))
+        duration = time.perf_counter() - start
+        self.stdout.write("Total : %s lignes lues en %.2fs (%.0f lignes/s)" % (
+            total_lines, duration, total_lines / duration if duration else 0))
@@ -0,0 +1,14 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from banklinemanager.models import BankMonthSummary
+
+
+class Command(BaseCommand):
+    help = "Recompute the monthly summaries of every bank from all the bank lines, e.g. after lines were deleted."
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        summary_count = BankMonthSummary.rebuild()
+        self.stdout.write("%s synthèses mensuelles recalculées en %.2fs" % (summary_count, time.perf_counter() - start))
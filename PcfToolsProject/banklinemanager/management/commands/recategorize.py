@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from banklinemanager.models import BankLine, RECATEGORIZE_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = "Set again the category of the bank lines from the category rules, by chunks of lines."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--uncategorized', action='store_true', help="Only the lines without category")
+        parser.add_argument('--chunk-size', type=int, default=RECATEGORIZE_CHUNK_SIZE, help="Lines read at a time")
+
+    def handle(self, *args, **options):
+        banklines = BankLine.objects.all()
+        if options['uncategorized']:
+            banklines = banklines.filter(category__isnull=True)
+
+        read_counter, changed_counter = 0, 0
+        start = time.perf_counter()
+        for read, changed in BankLine.recategorize(banklines, options['chunk_size']):
+            read_counter += read
+            changed_counter += changed
+            if options['verbosity'] > 1:
+                self.stdout.write("%s lignes lues, %s modifiées" % (read_counter, changed_counter))
+        duration = time.perf_counter() - start
+        self.stdout.write("%s lignes lues, %s catégories modifiées en %.2fs (%.0f lignes/s)" % (
+            read_counter, changed_counter, duration, read_counter / duration if duration else 0))
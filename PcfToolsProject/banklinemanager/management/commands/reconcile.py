@@ -0,0 +1,89 @@
+import csv
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from banklinemanager.models import Bank, BankLine
+from banklinemanager.reconciliation import (DEFAULT_DATE_WINDOW, lines_from_banklines, lines_from_queryset,
+                                            reconcile)
+
+
+class Command(BaseCommand):
+    help = "Reconcile the lines of a bank with the lines of another bank (--other-bank), with the lines of a " \
+        "datafile not imported yet (--file), or with themselves to find the lines imported twice (default). " \
+        "Lines match by amount, dates in a window and similar wordings."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bank', type=int, required=True, help="Account number of the bank")
+        parser.add_argument('--other-bank', type=int, help="Account number of the other bank")
+        parser.add_argument('--file', help="Datafile in the format of the bank, or of --format")
+        parser.add_argument('--format', choices=[choice for choice, label in Bank.FORMAT_DATAFILE_ACCEPTED],
+                            help="Format of --file if not the one of the bank")
+        parser.add_argument('--date-start', help="First date of the lines, YYYY-MM-DD")
+        parser.add_argument('--date-end', help="Last date of the lines, YYYY-MM-DD")
+        parser.add_argument('--window', type=int, default=DEFAULT_DATE_WINDOW, help="Largest gap in days")
+        parser.add_argument('--min-similarity', type=float, default=0.0, help="Lowest wording similarity, 0 to 1")
+        parser.add_argument('--opposite', action='store_true', help="Match opposite amounts (transfers)")
+        parser.add_argument('--report', help="Write every matched, ambiguous and unmatched line in this CSV file")
+
+    def handle(self, *args, **options):
+        bank = self.get_bank(options['bank'])
+        start = time.perf_counter()
+        right = lines_from_queryset(self.filter_dates(BankLine.objects.filter(bank=bank), options))
+        same_set = False
+        if options['other_bank'] is not None:
+            left = lines_from_queryset(self.filter_dates(
+                BankLine.objects.filter(bank=self.get_bank(options['other_bank'])), options))
+        elif options['file']:
+            if options['format']:
+                bank._datafile_format = options['format']
+            with open(options['file'], 'rb') as datafile:
+                banklines, msg_parse_error = BankLine.parse_datafile(bank, datafile)
+            for message in msg_parse_error:
+                self.stdout.write(message)
+            left = lines_from_banklines(banklines)
+        else:
+            left, same_set = right, True
+
+        report = reconcile(left, right, options['window'], options['min_similarity'], options['opposite'], same_set)
+        self.stdout.write("%s lignes comparées à %s lignes en %.2fs" % (len(left), len(right), time.perf_counter() - start))
+        self.stdout.write(str(report))
+        if options['report']:
+            self.write_report(options['report'], report)
+
+    @staticmethod
+    def get_bank(account_number):
+        try:
+            return Bank.objects.get(_account_number=account_number)
+        except Bank.DoesNotExist:
+            raise CommandError("Aucun compte bancaire n°%s" % (account_number))
+
+    @staticmethod
+    def filter_dates(banklines, options):
+        if options['date_start']:
+            banklines = banklines.filter(transaction_date__gte=options['date_start'])
+        if options['date_end']:
+            banklines = banklines.filter(transaction_date__lte=options['date_end'])
+        return banklines
+
+    @staticmethod
+    def write_report(path, report):
+        def columns(line):
+            if line is None:
+                return ["", "", "", ""]
+            return [line.transaction_number, line.transaction_date.isoformat(), line.amount, line.search_text.split("\n")[0]]
+
+        with open(path, 'w', newline='') as report_file:
+            writer = csv.writer(report_file, delimiter=';')
+            writer.writerow(["statut", "numero", "date", "montant", "libelle",
+                             "numero rapproche", "date rapprochee", "montant rapproche", "libelle rapproche", "similarite"])
+            for line, candidate, score in report.matched:
+                writer.writerow(["rapprochee"] + columns(line) + columns(candidate) + ["%.2f" % (score)])
+            for line, candidates in report.ambiguous:
+                for candidate in candidates:
+                    writer.writerow(["ambigue"] + columns(line) + columns(candidate) + [""])
+            for line in report.unmatched_left:
+                writer.writerow(["seule"] + columns(line) + columns(None) + [""])
+            if report.unmatched_right is not report.unmatched_left:
+                for line in report.unmatched_right:
+                    writer.writerow(["seule"] + columns(None) + columns(line) + [""])
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-17 17:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('banklinemanager', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bankline',
+            index=models.Index(fields=['-transaction_date', '-id'], name='bankline_date_id_idx'),
+        ),
+    ]
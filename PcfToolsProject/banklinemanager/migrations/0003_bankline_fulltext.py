@@ -0,0 +1,26 @@
+from django.db import migrations
+
+from banklinemanager.fulltext import create_fulltext_index, drop_fulltext_index
+
+
+# columns indexed until search_text replaced them in 0007
+FTS_COLUMNS = ('wording', 'bank_detail', 'user_comment')
+
+
+def create_fulltext(apps, schema_editor):
+    create_fulltext_index(schema_editor.connection, FTS_COLUMNS)
+
+
+def drop_fulltext(apps, schema_editor):
+    drop_fulltext_index(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('banklinemanager', '0002_bankline_date_id_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fulltext, drop_fulltext),
+    ]
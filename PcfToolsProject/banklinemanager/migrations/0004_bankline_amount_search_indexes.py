@@ -0,0 +1,44 @@
+# Generated by Django 2.2.28 on 2026-10-17 17:35
+
+from django.db import migrations, models
+
+from banklinemanager.fulltext import rebuild_fulltext_operations
+
+
+# columns indexed until search_text replaced them in 0007
+FTS_COLUMNS = ('wording', 'bank_detail', 'user_comment')
+
+DROP_FULLTEXT, CREATE_FULLTEXT = rebuild_fulltext_operations(FTS_COLUMNS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('banklinemanager', '0003_bankline_fulltext'),
+    ]
+
+    operations = [
+        DROP_FULLTEXT,
+        migrations.AddField(
+            model_name='bankline',
+            name='amount',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=8, verbose_name='montant'),
+        ),
+        migrations.RunSQL(
+            "UPDATE banklinemanager_bankline SET amount = credit + debit",
+            migrations.RunSQL.noop,
+        ),
+        CREATE_FULLTEXT,
+        migrations.AddIndex(
+            model_name='bankline',
+            index=models.Index(fields=['bank', 'transaction_date'], name='bankline_bank_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bankline',
+            index=models.Index(fields=['amount'], name='bankline_amount_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bankline',
+            index=models.Index(fields=['bank', 'amount'], name='bankline_bank_amount_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.2.28 on 2026-10-17 17:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('banklinemanager', '0004_bankline_amount_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_name', models.CharField(max_length=255, verbose_name='nom du fichier')),
+                ('status', models.CharField(choices=[('pending', 'En attente'), ('parsing', 'Lecture du fichier'), ('inserting', 'Import des lignes'), ('done', 'Terminé'), ('failed', 'Echec')], default='pending', max_length=16, verbose_name='statut')),
+                ('line_counter', models.IntegerField(default=0, verbose_name='lignes lues')),
+                ('inserted_line_counter', models.IntegerField(default=0, verbose_name='lignes importées')),
+                ('messages', models.TextField(blank=True, verbose_name='messages')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='date de création')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='date de fin')),
+                ('bank', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='banklinemanager.Bank')),
+            ],
+            options={
+                'verbose_name': 'Import de fichier',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
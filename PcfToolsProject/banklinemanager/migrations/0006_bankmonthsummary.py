@@ -0,0 +1,41 @@
+# Generated by Django 2.2.28 on 2026-10-17 17:42
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncMonth
+import django.db.models.deletion
+
+
+def build_summaries(apps, schema_editor):
+    BankLine = apps.get_model('banklinemanager', 'BankLine')
+    BankMonthSummary = apps.get_model('banklinemanager', 'BankMonthSummary')
+    months = BankLine.objects.annotate(month=TruncMonth('transaction_date')).order_by().values(
+        'bank_id', 'month').annotate(line_count=Count('id'), total_debit=Sum('debit'), total_credit=Sum('credit'))
+    BankMonthSummary.objects.bulk_create(BankMonthSummary(**month) for month in months)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('banklinemanager', '0005_importjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BankMonthSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(verbose_name='mois')),
+                ('line_count', models.IntegerField(default=0, verbose_name='nombre de lignes')),
+                ('total_debit', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='total debit')),
+                ('total_credit', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='total credit')),
+                ('bank', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='banklinemanager.Bank')),
+            ],
+            options={
+                'verbose_name': 'Synthèse mensuelle',
+                'ordering': ['bank', 'month'],
+                'unique_together': {('bank', 'month')},
+            },
+        ),
+        migrations.RunPython(build_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 2.2.28 on 2026-10-17 18:02
+
+from django.db import migrations, models
+
+from banklinemanager.fulltext import SEARCH_TEXT_FIELDS, rebuild_fulltext_operations, search_text
+
+
+# columns indexed before search_text
+OLD_FTS_COLUMNS = ('wording', 'bank_detail', 'user_comment')
+
+DROP_FULLTEXT, CREATE_FULLTEXT = rebuild_fulltext_operations(('search_text',), OLD_FTS_COLUMNS)
+
+
+def compute_search_text(apps, schema_editor):
+    BankLine = apps.get_model('banklinemanager', 'BankLine')
+    banklines = []
+    for bankline in BankLine.objects.only('pk', *SEARCH_TEXT_FIELDS).iterator(chunk_size=2000):
+        bankline.search_text = search_text(*(getattr(bankline, field) for field in SEARCH_TEXT_FIELDS))
+        banklines.append(bankline)
+        if len(banklines) == 2000:
+            BankLine.objects.bulk_update(banklines, ['search_text'], batch_size=500)
+            banklines = []
+    BankLine.objects.bulk_update(banklines, ['search_text'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('banklinemanager', '0006_bankmonthsummary'),
+    ]
+
+    operations = [
+        DROP_FULLTEXT,
+        migrations.AddField(
+            model_name='bankline',
+            name='search_text',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='texte de recherche'),
+        ),
+        migrations.RunPython(compute_search_text, migrations.RunPython.noop),
+        CREATE_FULLTEXT,
+    ]
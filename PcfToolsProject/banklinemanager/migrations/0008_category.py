@@ -0,0 +1,53 @@
+# Generated by Django 2.2.28 on 2026-10-17 17:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from banklinemanager.fulltext import rebuild_fulltext_operations
+
+
+DROP_FULLTEXT, CREATE_FULLTEXT = rebuild_fulltext_operations(('search_text',))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('banklinemanager', '0007_bankline_search_text'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Category',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True, verbose_name='nom')),
+            ],
+            options={
+                'verbose_name': 'Catégorie',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='CategoryRule',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rule_type', models.CharField(choices=[('keyword', 'Mot-clé (sans accent ni majuscule)'), ('regex', 'Expression régulière')], default='keyword', max_length=8, verbose_name='type')),
+                ('pattern', models.CharField(blank=True, max_length=255, verbose_name='mot-clé ou expression')),
+                ('amount_min', models.DecimalField(blank=True, decimal_places=2, max_digits=8, null=True, verbose_name='montant minimum')),
+                ('amount_max', models.DecimalField(blank=True, decimal_places=2, max_digits=8, null=True, verbose_name='montant maximum')),
+                ('priority', models.IntegerField(default=100, verbose_name='priorité')),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rules', to='banklinemanager.Category')),
+            ],
+            options={
+                'verbose_name': 'Règle de catégorie',
+                'ordering': ['priority', 'id'],
+            },
+        ),
+        DROP_FULLTEXT,
+        migrations.AddField(
+            model_name='bankline',
+            name='category',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='banklinemanager.Category', verbose_name='catégorie'),
+        ),
+        CREATE_FULLTEXT,
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-17 18:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('banklinemanager', '0008_category'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportedFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_name', models.CharField(max_length=255, verbose_name='nom du fichier')),
+                ('sha256', models.CharField(max_length=64, verbose_name='empreinte SHA-256')),
+                ('size', models.BigIntegerField(default=0, verbose_name='taille')),
+                ('date_start', models.DateField(blank=True, null=True, verbose_name='première date')),
+                ('date_end', models.DateField(blank=True, null=True, verbose_name='dernière date')),
+                ('line_counter', models.IntegerField(default=0, verbose_name='lignes lues')),
+                ('inserted_line_counter', models.IntegerField(default=0, verbose_name='lignes importées')),
+                ('imported_at', models.DateTimeField(auto_now_add=True, verbose_name="date d'import")),
+                ('bank', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='banklinemanager.Bank')),
+            ],
+            options={
+                'verbose_name': 'Fichier importé',
+                'ordering': ['-imported_at'],
+                'unique_together': {('bank', 'sha256')},
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 2.2.28 on 2026-10-17 18:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('banklinemanager', '0009_importedfile'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='bank',
+            name='_datafile_format',
+            field=models.CharField(choices=[('CSV', 'Datafile format CSV for CEPAC only'), ('OFX1', 'Datafile format OFX SGML'), ('OFX2', 'Datafile format OFX XML'), ('CSVC', 'Datafile format CSV with the columns of its CSV format'), ('QIF', 'Datafile format QIF'), ('CAMT', 'Datafile format CAMT.053 (ISO 20022 XML)')], default='OFX1', max_length=4),
+        ),
+        migrations.CreateModel(
+            name='BankCsvFormat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('columns', models.CharField(help_text='Champ lu dans chaque colonne, séparés par des virgules : date, number, wording, detail, debit, credit ou amount (montant signé), vide pour une colonne ignorée. Ex. : date,wording,,amount', max_length=255, verbose_name='colonnes')),
+                ('delimiter', models.CharField(default=';', max_length=1, verbose_name='séparateur')),
+                ('quotechar', models.CharField(default='"', max_length=1, verbose_name='délimiteur de texte')),
+                ('date_format', models.CharField(default='%d/%m/%Y', help_text='Format de strptime, ex. : %d/%m/%Y', max_length=32, verbose_name='format de date')),
+                ('decimal_separator', models.CharField(choices=[(',', 'Virgule'), ('.', 'Point')], default=',', max_length=1, verbose_name='séparateur décimal')),
+                ('skip_rows', models.PositiveSmallIntegerField(default=1, verbose_name="lignes d'en-tête ignorées")),
+                ('encoding', models.CharField(blank=True, help_text='Vide pour le détecter (latin-1 par défaut), ex. : utf-8', max_length=32, verbose_name='encodage')),
+                ('bank', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='csv_format', to='banklinemanager.Bank')),
+            ],
+            options={
+                'verbose_name': 'Format CSV',
+            },
+        ),
+    ]
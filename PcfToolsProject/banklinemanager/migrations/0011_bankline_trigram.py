@@ -0,0 +1,23 @@
+from django.db import migrations
+
+from banklinemanager.fulltext import create_trigram_index, drop_trigram_index
+
+
+def create_trigram(apps, schema_editor):
+    # PostgreSQL only: SQLite searches through its FTS5 table (see 0003_bankline_fulltext)
+    create_trigram_index(schema_editor.connection)
+
+
+def drop_trigram(apps, schema_editor):
+    drop_trigram_index(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('banklinemanager', '0010_bankcsvformat'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram, drop_trigram),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-17 19:00
+
+from django.db import migrations, models
+
+from banklinemanager.fulltext import rebuild_fulltext_operations
+
+
+DROP_FULLTEXT, CREATE_FULLTEXT = rebuild_fulltext_operations(('search_text',))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('banklinemanager', '0011_bankline_trigram'),
+    ]
+
+    operations = [
+        DROP_FULLTEXT,
+        migrations.AddField(
+            model_name='bankline',
+            name='modified_at',
+            field=models.DateTimeField(auto_now=True, verbose_name='date de modification'),
+        ),
+        CREATE_FULLTEXT,
+        migrations.AddIndex(
+            model_name='bankline',
+            index=models.Index(fields=['modified_at'], name='bankline_modified_at_idx'),
+        ),
+    ]
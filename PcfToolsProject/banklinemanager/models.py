@@ -1,11 +1,40 @@
+import bisect
+import codecs
+import datetime
+import hashlib
 import re
+from collections import defaultdict
 from decimal import Decimal
 import logging as lg
 
+from django.core.exceptions import ValidationError
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import transaction, IntegrityError
 from django.db import models
-from django.db.models import Q
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from .categorization import Categorizer, compile_regex
+from .fulltext import (FTS_MIN_KEYWORD_LENGTH, FUZZY_MIN_KEYWORD_LENGTH, SEARCH_TEXT_FIELDS, SEARCH_TEXT_SEPARATOR,
+                       FulltextLikeSubquery, FulltextSubquery, fulltext_available, fuzzy_patterns, normalize_text,
+                       search_text)
+from .instrumentation import ImportTimer
+from .parsers import iter_ofxsgml_transactions, iter_ofxxml_transactions
+from .search_cache import invalidate_banklines
+
+
+# Number of lines sent to the database by each bulk_create during an import
+IMPORT_BATCH_SIZE = 500
+# Number of transaction numbers checked by each duplicate detection query (SQLite allows 999 parameters)
+PRESCAN_CHUNK_SIZE = 500
+# Number of lines read and updated at a time by BankLine.recategorize
+RECATEGORIZE_CHUNK_SIZE = 5000
+
+MSG_LINE_ALREADY_IMPORTED = "-> Il semble que cette ligne est déjà été importée = %s"
+MSG_FILE_ALREADY_IMPORTED = "-> Ce fichier a déjà été importé le %s sur le compte %s (%s lignes importées)."
+MSG_LINES_ALREADY_COVERED = "-> %s lignes déjà importées par les fichiers précédents ont été ignorées."
+MSG_LINE_NOT_IMPORTED = "-> La ligne suivante n'a pas été importée => %s"
 
 
 class Bank(models.Model):
@@ -13,10 +42,17 @@ class Bank(models.Model):
     FORMAT_CSV = "CSV"
     FORMAT_OFX_SGML = "OFX1"
     FORMAT_OFX_XML = "OFX2"
+    FORMAT_CSV_CONFIGURABLE = "CSVC"
+    FORMAT_QIF = "QIF"
+    FORMAT_CAMT053 = "CAMT"
+    # Each format is read by the importer registered for it (see importers.py)
     FORMAT_DATAFILE_ACCEPTED = (
         (FORMAT_CSV, "Datafile format CSV for CEPAC only"),
         (FORMAT_OFX_SGML, "Datafile format OFX SGML"),
         (FORMAT_OFX_XML, "Datafile format OFX XML"),
+        (FORMAT_CSV_CONFIGURABLE, "Datafile format CSV with the columns of its CSV format"),
+        (FORMAT_QIF, "Datafile format QIF"),
+        (FORMAT_CAMT053, "Datafile format CAMT.053 (ISO 20022 XML)"),
         )
 
     name = models.CharField('nom', max_length=32, unique=True)
@@ -38,6 +74,145 @@ class Bank(models.Model):
         return self._datafile_format
 
 
+class BankCsvFormat(models.Model):
+    ''' BankCsvFormat is the layout of the CSV datafiles of a Bank whose datafile format is FORMAT_CSV_CONFIGURABLE:
+    the field read from each column, the delimiters and the formats of the dates and amounts. '''
+    COLUMN_DATE = "date"
+    COLUMN_NUMBER = "number"
+    COLUMN_WORDING = "wording"
+    COLUMN_DETAIL = "detail"
+    COLUMN_DEBIT = "debit"
+    COLUMN_CREDIT = "credit"
+    COLUMN_AMOUNT = "amount"
+    COLUMNS = (COLUMN_DATE, COLUMN_NUMBER, COLUMN_WORDING, COLUMN_DETAIL, COLUMN_DEBIT, COLUMN_CREDIT, COLUMN_AMOUNT)
+    DECIMAL_SEPARATOR_CHOICES = (
+        (",", "Virgule"),
+        (".", "Point"),
+        )
+
+    bank = models.OneToOneField(Bank, on_delete=models.CASCADE, related_name='csv_format')
+    columns = models.CharField('colonnes', max_length=255, help_text=(
+        "Champ lu dans chaque colonne, séparés par des virgules : date, number, wording, detail, debit, credit ou "
+        "amount (montant signé), vide pour une colonne ignorée. Ex. : date,wording,,amount"))
+    delimiter = models.CharField('séparateur', max_length=1, default=";")
+    quotechar = models.CharField('délimiteur de texte', max_length=1, default='"')
+    date_format = models.CharField('format de date', max_length=32, default="%d/%m/%Y",
+                                   help_text="Format de strptime, ex. : %d/%m/%Y")
+    decimal_separator = models.CharField('séparateur décimal', max_length=1, choices=DECIMAL_SEPARATOR_CHOICES,
+                                         default=",")
+    skip_rows = models.PositiveSmallIntegerField("lignes d'en-tête ignorées", default=1)
+    encoding = models.CharField('encodage', max_length=32, blank=True,
+                                help_text="Vide pour le détecter (latin-1 par défaut), ex. : utf-8")
+
+    class Meta:
+        verbose_name = "Format CSV"
+
+    def __str__(self):
+        return "%s : %s" % (self.bank, self.columns)
+
+    def clean(self):
+        columns = self.get_columns()
+        unknown = [name for name in self.columns.split(",") if name.strip() and name.strip() not in self.COLUMNS]
+        if unknown:
+            raise ValidationError({'columns': "Colonnes inconnues : %s" % (", ".join(unknown))})
+        if (self.COLUMN_DATE not in columns or self.COLUMN_WORDING not in columns
+                or not {self.COLUMN_DEBIT, self.COLUMN_CREDIT, self.COLUMN_AMOUNT} & set(columns)):
+            raise ValidationError({'columns': "Les colonnes date, wording et un montant (debit, credit ou amount) "
+                                              "sont obligatoires."})
+        if self.encoding:
+            try:
+                codecs.lookup(self.encoding)
+            except LookupError:
+                raise ValidationError({'encoding': "Encodage inconnu : %s" % (self.encoding)})
+
+    def get_columns(self):
+        ''' Return {field: index of its column} for the fields of COLUMNS found in columns. '''
+        columns = {}
+        for index, name in enumerate(self.columns.split(",")):
+            if name.strip() in self.COLUMNS:
+                columns.setdefault(name.strip(), index)
+        return columns
+
+
+class Category(models.Model):
+    ''' Category is a list of categories (expenses or incomes) of the BankLine, found by the CategoryRule '''
+    name = models.CharField('nom', max_length=64, unique=True)
+
+    class Meta:
+        verbose_name = "Catégorie"
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+
+class CategoryRule(models.Model):
+    ''' CategoryRule gives its Category to the BankLine whose search text contains its keyword or matches its
+    regex, and whose amount is in its range. The matching rule with the lowest priority wins (see categorization.py) '''
+    RULE_KEYWORD = "keyword"
+    RULE_REGEX = "regex"
+    RULE_TYPE_CHOICES = (
+        (RULE_KEYWORD, "Mot-clé (sans accent ni majuscule)"),
+        (RULE_REGEX, "Expression régulière"),
+        )
+
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='rules')
+    rule_type = models.CharField('type', max_length=8, choices=RULE_TYPE_CHOICES, default=RULE_KEYWORD)
+    pattern = models.CharField('mot-clé ou expression', max_length=255, blank=True)
+    amount_min = models.DecimalField('montant minimum', decimal_places=2, max_digits=8, null=True, blank=True)
+    amount_max = models.DecimalField('montant maximum', decimal_places=2, max_digits=8, null=True, blank=True)
+    priority = models.IntegerField('priorité', default=100)
+
+    class Meta:
+        verbose_name = "Règle de catégorie"
+        ordering = ['priority', 'id']
+
+    def __str__(self):
+        return "%s : %s" % (self.category, self.pattern or "%s / %s" % (self.amount_min, self.amount_max))
+
+    def clean(self):
+        if not self.pattern and self.amount_min is None and self.amount_max is None:
+            raise ValidationError("Une règle doit avoir un mot-clé, une expression ou un montant.")
+        if self.rule_type == self.RULE_REGEX:
+            try:
+                re.compile(self.pattern)
+            except re.error as e:
+                raise ValidationError({'pattern': "Expression régulière invalide : %s" % (e)})
+
+    def get_keyword(self):
+        return normalize_text(self.pattern)
+
+    def get_pattern(self):
+        ''' Return the regex matching the search text of the lines of this rule, or None for an amount-only rule. '''
+        if not self.pattern:
+            return None
+        if self.rule_type == self.RULE_REGEX:
+            return self.pattern
+        return re.escape(self.get_keyword())
+
+    def matches_text(self, text):
+        pattern = self.get_pattern()
+        if pattern is None:
+            return True
+        regex = compile_regex(pattern)
+        return regex is not None and regex.search(text) is not None
+
+    def matches_amount(self, amount):
+        return ((self.amount_min is None or amount >= self.amount_min)
+                and (self.amount_max is None or amount <= self.amount_max))
+
+
+class BankLineQuerySet(models.QuerySet):
+    def delete(self):
+        ''' Delete the lines, then rebuild the monthly summaries of their banks and months. '''
+        months = {(bank_id, BankMonthSummary.month_of(transaction_date))
+                  for bank_id, transaction_date in self.order_by().values_list('bank_id', 'transaction_date').distinct()}
+        with transaction.atomic():
+            result = super().delete()
+            BankMonthSummary.rebuild_months(months)
+        return result
+
+
 class BankLine(models.Model):
     ''' BankLine is a table with list of bank lines (rows). Linked to one Bank '''
     transaction_date = models.DateField('date de transaction')
@@ -48,9 +223,26 @@ class BankLine(models.Model):
     bank_detail = models.CharField('détail de la banque', max_length=255, blank=True)
     user_comment = models.CharField('commentaire des utilisateurs', max_length=255, blank=True)
     bank = models.ForeignKey(Bank, on_delete=models.CASCADE) # do not allow bank deletion in admin
+    # credit + debit, kept up to date by save() and bulk_insert_banklines so amount searches use one index
+    amount = models.DecimalField('montant', decimal_places=2, max_digits=8, default=0, editable=False)
+    # wording, bank_detail and user_comment normalized for the searches, kept up to date like amount
+    search_text = models.TextField('texte de recherche', blank=True, default="", editable=False)
+    category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, blank=True, verbose_name='catégorie')
+    # set by save(), bulk_create and recategorize, so the latest one dates the last change of the lines (see api.py)
+    modified_at = models.DateTimeField('date de modification', auto_now=True)
+
+    objects = BankLineQuerySet.as_manager()
 
     class Meta:
         verbose_name = "Ligne Banque"
+        indexes = [
+            # listing order and keyset pagination cursor, also used by transaction_date ranges
+            models.Index(fields=['-transaction_date', '-id'], name='bankline_date_id_idx'),
+            models.Index(fields=['bank', 'transaction_date'], name='bankline_bank_date_idx'),
+            models.Index(fields=['amount'], name='bankline_amount_idx'),
+            models.Index(fields=['bank', 'amount'], name='bankline_bank_amount_idx'),
+            models.Index(fields=['modified_at'], name='bankline_modified_at_idx'),
+        ]
         permissions = (
             ("can_list", "Can list and see all banklines"),
             ("can_search", "Can search banklines"),
@@ -60,105 +252,262 @@ class BankLine(models.Model):
     def __str__(self):
         return self.wording
 
+    def save(self, *args, **kwargs):
+        self.compute_amount()
+        self.compute_search_text()
+        if not self._state.adding:
+            super().save(*args, **kwargs)
+        else:
+            # a new line is added to its monthly summary in the same transaction
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+                BankMonthSummary.add_banklines([self])
+        invalidate_banklines([self])
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            BankMonthSummary.rebuild_months({(self.bank_id, BankMonthSummary.month_of(self.transaction_date))})
+        return result
+
+    def compute_amount(self):
+        ''' Set amount, the signed amount of the line: credit (positive) + debit (negative). '''
+        self.amount = (Decimal(str(self.credit or 0)) + Decimal(str(self.debit or 0))).quantize(Decimal('0.01'))
+
+    def compute_search_text(self):
+        ''' Set search_text, the searchable fields unaccented, lowercased and whitespace-collapsed. '''
+        self.search_text = search_text(*(getattr(self, field) for field in SEARCH_TEXT_FIELDS))
+
+
+    @classmethod
+    def parse_ofxsgml(cls, bank, ofx_file):
+        ''' Parse each bank line (row) of ofx_file into a list of unsaved BankLine objects linked to bank.
+        ofx_file can be a string or a file object, which is read by chunks.
+        Return the list and the error messages of the lines which could not be parsed. '''
+        from .importers import OfxSgmlImporter
+        return OfxSgmlImporter(bank).parse(iter_ofxsgml_transactions(ofx_file))
+
+    @classmethod
+    def parse_ofxxml(cls, bank, ofx_file):
+        ''' Parse each bank line (row) of an OFX XML (OFX 2.x) ofx_file into a list of unsaved BankLine objects
+        linked to bank. ofx_file can be a string, bytes or a file object, which is read by chunks.
+        Return the list and the error messages of the lines which could not be parsed. '''
+        from .importers import OfxXmlImporter
+        return OfxXmlImporter(bank).parse(iter_ofxxml_transactions(ofx_file))
 
     @classmethod
     def insert_data_from_ofxsgml(cls, bank, ofx_file):
         ''' Try to insert each bank line (row) into database from ofx_file. Also need an object Bank.
         Handle data from bank with ofx file format. Maybe need a change for data from other bank system. '''
-        msg_insert_error = []
-        line_counter = 0
-        inserted_line_counter = 0
+        timer = ImportTimer("ofxsgml %s" % (bank))
+        timer.start('parse')
+        banklines, msg_insert_error = cls.parse_ofxsgml(bank, ofx_file)
+        inserted_line_counter = cls.bulk_insert_banklines(banklines, msg_insert_error, timer=timer)
+        timer.line_count, timer.inserted_line_count = len(banklines), inserted_line_counter
+        timer.finish()
 
-        #ofx_file = ofx_file.replace('\r','').replace('\n','')
-        transactions = re.findall(r'<STMTTRN>.*?</STMTTRN>', ofx_file, re.DOTALL)
-        for transaction in transactions:
-            try:
-                date_re = re.search(r'<DTPOSTED>(\d{4})(\d{2})(\d{2})(.*?)\n', transaction)
-                if date_re is not None:
-                    date_formatted = '%s-%s-%s' % (date_re.group(1), date_re.group(2), date_re.group(3))
-                else:
-                    raise Exception("Erreur : La date de la transaction n a pas pu etre recuperee.")
-                type_debit_credit = re.search(r'<TRNTYPE>(.*?)\n', transaction).group(1)
-                #montant = re.search(r'<TRNAMT>(.*?)\n', transaction).group(1)
-                montant = re.search(r'<TRNAMT>([+-]?\d+[,\.]?\d*).*\n', transaction).group(1)
-                montant = montant.replace(",",".")
-                debit = montant if type_debit_credit.lower().startswith("debit") else Decimal(0)
-                credit = montant if type_debit_credit.lower().startswith("credit") else Decimal(0)
-                fitid = re.search(r'<FITID>(.*?)\n', transaction).group(1)
-                name = re.search(r'<NAME>(.*?)\n', transaction).group(1)
-                memo = re.search(r'<MEMO>(.*?)\n', transaction)
-                memo = memo.group(1) if memo else ""
-
-                line_counter += 1
-                bankline = BankLine.objects.create(
-                    transaction_date=date_formatted,
-                    wording=name.strip(),
-                    transaction_number=fitid.strip(),
-                    debit=debit,
-                    credit=credit,
-                    bank_detail=memo.strip(),
-                    bank=bank)
-                if bankline is not None:
-                    inserted_line_counter += 1
+        return len(banklines), inserted_line_counter, msg_insert_error
 
-            except IntegrityError as e:
-                if "UNIQUE constraint failed" in str(e):
-                    msg_insert_error.append("-> Il semble que cette ligne est déjà été importée = %s" % (fitid))
-                lg.warning("=> ERREUR IntegrityError : de transaction data, %s" % (e))
-            except Exception as e:
-                msg_insert_error.append("-> La ligne suivante n'a pas été importée => %s" % (transaction[:64]))
-                lg.warning(e)
+    @classmethod
+    def insert_data_from_ofxxml(cls, bank, ofx_file):
+        ''' Try to insert each bank line (row) into database from an OFX XML (OFX 2.x) ofx_file.
+        Also need an object Bank. Same counters and messages as insert_data_from_ofxsgml. '''
+        timer = ImportTimer("ofxxml %s" % (bank))
+        timer.start('parse')
+        banklines, msg_insert_error = cls.parse_ofxxml(bank, ofx_file)
+        inserted_line_counter = cls.bulk_insert_banklines(banklines, msg_insert_error, timer=timer)
+        timer.line_count, timer.inserted_line_count = len(banklines), inserted_line_counter
+        timer.finish()
 
-        return line_counter, inserted_line_counter, msg_insert_error
+        return len(banklines), inserted_line_counter, msg_insert_error
+
+    @classmethod
+    def parse_csv_cepac(cls, bank, csv_file):
+        ''' Parse each bank line (row) of csv_file (CEPAC layout) into a list of unsaved BankLine objects
+        linked to bank. Return the list and the error messages of the lines which could not be parsed. '''
+        from .importers import CepacCsvImporter
+        return CepacCsvImporter(bank).parse(csv_file)
 
     @classmethod
     def insert_data_from_csv_cepac(cls, bank, csv_file):
         ''' (No recommended) Try to insert each bank line (row) into database from csv_file. Also need an object Bank.
         Handle data from CEPAC bank (tested only with Cepac). Maybe need a change for data from other bank system. '''
-        msg_insert_error = []
-        line_counter = 0
+        timer = ImportTimer("csv_cepac %s" % (bank))
+        timer.start('parse')
+        banklines, msg_insert_error = cls.parse_csv_cepac(bank, csv_file)
+        inserted_line_counter = cls.bulk_insert_banklines(banklines, msg_insert_error, timer=timer)
+        timer.line_count, timer.inserted_line_count = len(banklines), inserted_line_counter
+        timer.finish()
+
+        return len(banklines), inserted_line_counter, msg_insert_error
+
+    @classmethod
+    def parse_datafile(cls, bank, datafile):
+        ''' Parse datafile, a binary file object or an iterable of bytes chunks (e.g. UploadedFile.chunks()), with
+        the importer registered for the datafile format of bank (see importers.py). The file is decoded and parsed
+        as it is read, so it is never held in memory. Return the list of unsaved BankLine objects and the error
+        messages of the lines which could not be parsed. '''
+        from .importers import get_importer
+        return get_importer(bank).parse_datafile(datafile)
+
+    @classmethod
+    def bulk_insert_banklines(cls, banklines, msg_insert_error, batch_size=IMPORT_BATCH_SIZE, timer=None):
+        ''' Insert the unsaved BankLine objects by chunks of batch_size with bulk_create, all inside one transaction.
+        A line whose transaction number already exists in database or appears earlier in banklines is skipped.
+        A chunk rejected by the database is inserted again line by line to report the failing lines in
+        msg_insert_error. The monthly summaries are updated with the inserted lines at the end of the transaction,
+        and the cached searches are invalidated after it. The lines without category are categorized by the
+        CategoryRule. The phases dedup, insert, commit and invalidate are timed by timer (an ImportTimer) if given.
+        Return the number of inserted lines. '''
+        timer = timer or ImportTimer(None)
+        timer.start('dedup')
         inserted_line_counter = 0
+        categorizer = Categorizer(CategoryRule.objects.all())
+        transaction_numbers = cls.existing_transaction_numbers(bankline.transaction_number for bankline in banklines)
+        new_banklines = []
 
-        # parse csv file to import line in database
-        for bankline_csv in csv_file:
+        for bankline in banklines:
+            if bankline.transaction_number in transaction_numbers:
+                msg_insert_error.append(MSG_LINE_ALREADY_IMPORTED % (bankline.transaction_number))
+                continue
             try:
-                if len(bankline_csv) >= 6:
-                    date = bankline_csv[0].strip()
-                    if re.match(r'^(\d{2})/(\d{2})/(\d{2})$', date) is not None:
-                        date_re = re.search(r'^(\d{2})/(\d{2})/(\d{2})$', date)
-                        date_formatted = '20%s-%s-%s' % (date_re.group(3), date_re.group(2), date_re.group(1))
-                        debit_decimal = bankline_csv[3].replace(",",".") if bankline_csv[3] else Decimal(0)
-                        credit_decimal = bankline_csv[4].replace(",",".") if bankline_csv[4] else Decimal(0)
-                        # Delete multiple whitespace in wording and detail to avoid future search errors.
-                        bank_detail = re.sub(' +', ' ', bankline_csv[5]).strip()
-                        wording = re.sub(' +', ' ', bankline_csv[2]).strip()
-                        if re.match(r'^(.*) -$', bankline_csv[1]) is not None:
-                            # Get transaction number (fitid) without " -" to match with ofx datafile by CEPAC
-                            transaction_number = re.search(r'^(.*) -$', bankline_csv[1]).group(1)
-                        else:
-                            transaction_number = bankline_csv[1].strip()
-
-                        line_counter += 1
-                        bankline = BankLine.objects.create(
-                            transaction_date=date_formatted,
-                            wording=wording,
-                            transaction_number=transaction_number,
-                            debit=debit_decimal,
-                            credit=credit_decimal,
-                            bank_detail=bank_detail,
-                            bank=bank)
-                        if bankline is not None:
-                            inserted_line_counter += 1
+                bankline.compute_amount()
+                bankline.compute_search_text()
+                if bankline.category_id is None and categorizer:
+                    bankline.category_id = categorizer.categorize(bankline)
+            except Exception as e:
+                msg_insert_error.append(MSG_LINE_NOT_IMPORTED % (bankline.transaction_number))
+                lg.warning(e)
+                continue
+            transaction_numbers.add(bankline.transaction_number)
+            new_banklines.append(bankline)
+
+        timer.start('insert')
+        month_totals = {}
+        with transaction.atomic():
+            for start in range(0, len(new_banklines), batch_size):
+                batch = new_banklines[start:start + batch_size]
+                try:
+                    with transaction.atomic():
+                        cls.objects.bulk_create(batch)
+                    BankMonthSummary.count_banklines(batch, month_totals)
+                    inserted_line_counter += len(batch)
+                except Exception as e:
+                    lg.warning("=> ERREUR bulk_create : lot de %s lignes importe ligne par ligne, %s" % (len(batch), e))
+                    inserted_line_counter += cls._insert_banklines_one_by_one(batch, msg_insert_error)
+            # the summaries of all the batches are written once, by bank and month
+            BankMonthSummary.add_totals(month_totals)
+            timer.start('commit')
 
+        timer.start('invalidate')
+        # once committed, the cached searches which may contain the new lines are deleted
+        invalidate_banklines(new_banklines)
+        timer.stop()
+        return inserted_line_counter
+
+    @classmethod
+    def recategorize(cls, banklines=None, chunk_size=RECATEGORIZE_CHUNK_SIZE):
+        ''' Set the category given by the CategoryRule to the lines of the banklines queryset (all by default),
+        read by chunks of chunk_size in id order and saved with bulk_update when their category changes.
+        Yield (number of lines read, number of lines changed) after each chunk. '''
+        if banklines is None:
+            banklines = cls.objects.all()
+        banklines = banklines.only('pk', 'bank', 'transaction_date', 'amount', 'search_text', 'category').order_by('pk')
+        categorizer = Categorizer(CategoryRule.objects.all())
+        last_pk = 0
+        while True:
+            chunk = list(banklines.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            changed = []
+            modified_at = timezone.now()
+            for bankline in chunk:
+                category_id = categorizer.categorize(bankline)
+                if category_id != bankline.category_id:
+                    bankline.category_id = category_id
+                    bankline.modified_at = modified_at
+                    changed.append(bankline)
+            with transaction.atomic():
+                cls.objects.bulk_update(changed, ['category', 'modified_at'], batch_size=IMPORT_BATCH_SIZE)
+            invalidate_banklines(changed)
+            last_pk = chunk[-1].pk
+            yield len(chunk), len(changed)
+
+    @classmethod
+    def existing_transaction_numbers(cls, transaction_numbers, chunk_size=PRESCAN_CHUNK_SIZE):
+        ''' Return the set of transaction_numbers already present in database, checked by chunks of chunk_size. '''
+        transaction_numbers = list(set(transaction_numbers))
+        existing = set()
+        for start in range(0, len(transaction_numbers), chunk_size):
+            existing.update(cls.objects.filter(
+                transaction_number__in=transaction_numbers[start:start + chunk_size]
+            ).values_list('transaction_number', flat=True))
+
+        return existing
+
+    @classmethod
+    def _insert_banklines_one_by_one(cls, banklines, msg_insert_error):
+        ''' Insert each BankLine object in its own savepoint. Return the number of inserted lines. '''
+        inserted_line_counter = 0
+        for bankline in banklines:
+            try:
+                with transaction.atomic():
+                    bankline.save(force_insert=True)
+                inserted_line_counter += 1
             except IntegrityError as e:
                 if "UNIQUE constraint failed" in str(e):
-                    msg_insert_error.append("-> Il semble que cette ligne est déjà été importée = %s" % (transaction_number))
+                    msg_insert_error.append(MSG_LINE_ALREADY_IMPORTED % (bankline.transaction_number))
                 lg.warning("=> ERREUR IntegrityError : de transaction data, %s" % (e))
             except Exception as e:
-                msg_insert_error.append("-> La ligne suivante n'a pas été importée => %s" % (transaction_number))
+                msg_insert_error.append(MSG_LINE_NOT_IMPORTED % (bankline.transaction_number))
                 lg.warning(e)
 
-        return line_counter, inserted_line_counter, msg_insert_error
+        return inserted_line_counter
+
+    @classmethod
+    def keywords_filter(cls, keywords, type_search, fulltext=None):
+        ''' Return the Q object selecting the lines whose wording, bank_detail or user_comment contains (or starts
+        with if type_search is "startswith") one of keywords, ignoring accents, case and repeated whitespace.
+        With type_search "fuzzy", a keyword long enough is also found with one typo (see fuzzy_patterns).
+        Keywords long enough are looked up in the full-text index when it is available (fulltext=None) or forced
+        (fulltext=True), the other ones with LIKE lookups on search_text. '''
+        if fulltext is None:
+            fulltext = fulltext_available()
+        keywords = [normalize_text(keyword) for keyword in keywords]
+        fuzzy_keywords = [keyword for keyword in keywords
+                          if type_search == "fuzzy" and len(keyword) >= FUZZY_MIN_KEYWORD_LENGTH]
+        fulltext_keywords = [keyword for keyword in keywords
+                             if fulltext and len(keyword) >= FTS_MIN_KEYWORD_LENGTH and keyword not in fuzzy_keywords]
+
+        q_search = Q()
+        for keyword in keywords:
+            if keyword not in fulltext_keywords and keyword not in fuzzy_keywords:
+                q_search |= cls._like_filter(keyword, type_search)
+        for keyword in fuzzy_keywords:
+            if fulltext:
+                q_search |= Q(pk__in=FulltextLikeSubquery(fuzzy_patterns(keyword)))
+            else:
+                for pattern in fuzzy_patterns(keyword):
+                    q_search |= Q(search_text__like=pattern)
+        if fulltext_keywords:
+            q_fulltext = Q(pk__in=FulltextSubquery(fulltext_keywords))
+            if type_search == "startswith":
+                # the index finds the lines containing the keywords, LIKE keeps those starting with them
+                q_startswith = Q()
+                for keyword in fulltext_keywords:
+                    q_startswith |= cls._like_filter(keyword, type_search)
+                q_fulltext &= q_startswith
+            q_search |= q_fulltext
+
+        return q_search
+
+    @staticmethod
+    def _like_filter(keyword, type_search):
+        ''' Return the Q object selecting the lines whose search_text contains the normalized keyword, or with
+        type_search "startswith", whose searchable fields (separated in search_text) start with it. '''
+        if type_search == "startswith":
+            return Q(search_text__startswith=keyword) | Q(search_text__contains=SEARCH_TEXT_SEPARATOR + keyword)
+        return Q(search_text__contains=keyword)
 
     @classmethod
     def search_bankline(cls, query, type_search, date_start, date_end, sum_min, sum_max, bank_id):
@@ -175,20 +524,10 @@ class BankLine(models.Model):
             keywords = query.split("\r\n")
             msg_search += ' sur " %s "' % (', '.join(keywords))
             # research contains or startswith keywords
-            q_search = Q()
-            for keyword in keywords:
-                if len(keyword) >= min_lenght_search:
-                    if type_search == "startswith":
-                        q_search |= Q(wording__istartswith=keyword)
-                        q_search |= Q(bank_detail__istartswith=keyword)
-                        q_search |= Q(user_comment__istartswith=keyword)
-                    else:
-                        q_search |= Q(wording__icontains=keyword)
-                        q_search |= Q(bank_detail__icontains=keyword)
-                        q_search |= Q(user_comment__icontains=keyword)
-            bankline_list = BankLine.objects.filter(q_search).select_related('bank')
+            keywords = [keyword for keyword in keywords if len(keyword) >= min_lenght_search]
+            bankline_list = BankLine.objects.filter(cls.keywords_filter(keywords, type_search)).select_related('bank', 'category')
         elif date_start or sum_min or bank_id:
-            bankline_list = BankLine.objects.all().select_related('bank')
+            bankline_list = BankLine.objects.all().select_related('bank', 'category')
             # message += "Vous devez lancer une recherche."
         else:
             bankline_list = None
@@ -207,10 +546,276 @@ class BankLine(models.Model):
             if sum_min > sum_max:
                 sum_min, sum_max = sum_max, sum_min
             msg_search += " avec un montant entre %s€ et %s€" % (sum_min, sum_max)
-            bankline_list = bankline_list.filter(Q(debit__range=(sum_min, sum_max)) | Q(credit__range=(sum_min, sum_max)))
+            # debit is negative and credit positive, so a range of one sign matches the signed amount
+            bankline_list = bankline_list.filter(amount__range=(sum_min, sum_max))
 
         if bank_id:
             bankline_list = bankline_list.filter(bank=bank_id)
             msg_search += " sur le compte bancaire n°%s" % (bank_id)
 
         return bankline_list, msg_search
+
+    @classmethod
+    def search_totals(cls, bankline_list):
+        ''' Compute in database, with a single grouped query, the number of lines and the total debit and credit
+        of the bankline_list queryset, overall and per bank. Return a dict with keys count, total_debit,
+        total_credit and banks (list of dicts with bank_id, bank__name, count, total_debit, total_credit). '''
+        banks = list(bankline_list.order_by().values('bank_id', 'bank__name').annotate(
+            count=Count('id'), total_debit=Sum('debit'), total_credit=Sum('credit')).order_by('bank__name'))
+
+        return {
+            'count': sum(bank['count'] for bank in banks),
+            'total_debit': sum((bank['total_debit'] for bank in banks), Decimal(0)),
+            'total_credit': sum((bank['total_credit'] for bank in banks), Decimal(0)),
+            'banks': banks,
+        }
+
+
+class BankMonthSummary(models.Model):
+    ''' BankMonthSummary is the number of lines and the total debit and credit of a Bank for one month.
+    Updated by each insert of BankLine (save and bulk_insert_banklines), rebuilt for their months by the deletions
+    of BankLine (delete of a line or a queryset) and entirely by the rebuild_summaries command. '''
+    bank = models.ForeignKey(Bank, on_delete=models.CASCADE)
+    month = models.DateField('mois') # first day of the month
+    line_count = models.IntegerField('nombre de lignes', default=0)
+    total_debit = models.DecimalField('total debit', decimal_places=2, max_digits=14, default=0)
+    total_credit = models.DecimalField('total credit', decimal_places=2, max_digits=14, default=0)
+
+    class Meta:
+        verbose_name = "Synthèse mensuelle"
+        unique_together = ('bank', 'month')
+        ordering = ['bank', 'month']
+
+    def __str__(self):
+        return "%s %s" % (self.bank, self.month.strftime('%Y-%m'))
+
+    @property
+    def balance(self):
+        return self.total_credit + self.total_debit
+
+    @staticmethod
+    def month_of(date):
+        ''' Return the first day of the month of date, a date or a "YYYY-MM-DD" string as given by the parsers. '''
+        if isinstance(date, str):
+            date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+        return date.replace(day=1)
+
+    @classmethod
+    def count_banklines(cls, banklines, totals=None):
+        ''' Add the counts and totals of banklines to totals, a dict {(bank id, month): [line_count, total_debit,
+        total_credit]} (a new one if None), and return it. '''
+        totals = {} if totals is None else totals
+        for bankline in banklines:
+            total = totals.setdefault((bankline.bank_id, cls.month_of(bankline.transaction_date)),
+                                      [0, Decimal(0), Decimal(0)])
+            total[0] += 1
+            total[1] += Decimal(str(bankline.debit or 0))
+            total[2] += Decimal(str(bankline.credit or 0))
+        return totals
+
+    @classmethod
+    def add_totals(cls, totals):
+        ''' Add the totals counted by count_banklines to their summaries, one UPDATE (or INSERT for a new month)
+        per bank and month. '''
+        for (bank_id, month), (line_count, total_debit, total_credit) in totals.items():
+            updated = cls.objects.filter(bank_id=bank_id, month=month).update(
+                line_count=F('line_count') + line_count,
+                total_debit=F('total_debit') + total_debit,
+                total_credit=F('total_credit') + total_credit)
+            if not updated:
+                cls.objects.create(bank_id=bank_id, month=month, line_count=line_count,
+                                   total_debit=total_debit, total_credit=total_credit)
+
+    @classmethod
+    def add_banklines(cls, banklines):
+        ''' Add the counts and totals of the newly inserted banklines to their summaries. '''
+        cls.add_totals(cls.count_banklines(banklines))
+
+    @classmethod
+    def rebuild(cls):
+        ''' Recompute all the summaries from BankLine with one grouped query. Return the number of summaries. '''
+        months = BankLine.objects.annotate(month=TruncMonth('transaction_date')).order_by().values(
+            'bank_id', 'month').annotate(line_count=Count('id'), total_debit=Sum('debit'), total_credit=Sum('credit'))
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(cls(**month) for month in months)
+
+        return cls.objects.count()
+
+    @classmethod
+    def rebuild_months(cls, months):
+        ''' Recompute from BankLine the summaries of months, a set of (bank id, first day of the month), with one
+        grouped query per bank. A month left without lines loses its summary. '''
+        bank_months = defaultdict(set)
+        for bank_id, month in months:
+            bank_months[bank_id].add(month)
+        for bank_id, months in bank_months.items():
+            month_end = max(months)
+            month_end = month_end.replace(year=month_end.year + month_end.month // 12, month=month_end.month % 12 + 1)
+            totals = BankLine.objects.filter(
+                bank_id=bank_id, transaction_date__gte=min(months), transaction_date__lt=month_end
+            ).annotate(month=TruncMonth('transaction_date')).order_by().values('bank_id', 'month').annotate(
+                line_count=Count('id'), total_debit=Sum('debit'), total_credit=Sum('credit'))
+            with transaction.atomic():
+                cls.objects.filter(bank_id=bank_id, month__in=months).delete()
+                cls.objects.bulk_create(cls(**total) for total in totals if total['month'] in months)
+
+    @classmethod
+    def yearly(cls, summaries):
+        ''' Return the monthly summaries grouped by bank and year: a list of dicts with bank, year,
+        line_count, total_debit, total_credit and balance, in the order of summaries. '''
+        years = {}
+        for summary in summaries:
+            year = years.setdefault((summary.bank_id, summary.month.year), {
+                'bank': summary.bank, 'year': summary.month.year,
+                'line_count': 0, 'total_debit': Decimal(0), 'total_credit': Decimal(0)})
+            year['line_count'] += summary.line_count
+            year['total_debit'] += summary.total_debit
+            year['total_credit'] += summary.total_credit
+        for year in years.values():
+            year['balance'] = year['total_credit'] + year['total_debit']
+
+        return list(years.values())
+
+
+class ImportJob(models.Model):
+    ''' ImportJob is the import of one datafile, run in background by a worker (see jobs.py). Linked to one Bank '''
+    STATUS_PENDING = "pending"
+    STATUS_PARSING = "parsing"
+    STATUS_INSERTING = "inserting"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = (
+        (STATUS_PENDING, "En attente"),
+        (STATUS_PARSING, "Lecture du fichier"),
+        (STATUS_INSERTING, "Import des lignes"),
+        (STATUS_DONE, "Terminé"),
+        (STATUS_FAILED, "Echec"),
+        )
+
+    bank = models.ForeignKey(Bank, on_delete=models.CASCADE)
+    file_name = models.CharField('nom du fichier', max_length=255)
+    status = models.CharField('statut', max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    line_counter = models.IntegerField('lignes lues', default=0)
+    inserted_line_counter = models.IntegerField('lignes importées', default=0)
+    messages = models.TextField('messages', blank=True)
+    created_at = models.DateTimeField('date de création', auto_now_add=True)
+    finished_at = models.DateTimeField('date de fin', null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Import de fichier"
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return self.file_name
+
+    @property
+    def is_finished(self):
+        return self.status in (self.STATUS_DONE, self.STATUS_FAILED)
+
+    @property
+    def get_messages(self):
+        return self.messages.splitlines()
+
+    def as_dict(self):
+        ''' Return the progress of the job, for the polling endpoint. '''
+        return {
+            'id': self.pk,
+            'bank': self.bank.name,
+            'file_name': self.file_name,
+            'status': self.status,
+            'status_display': self.get_status_display(),
+            'finished': self.is_finished,
+            'line_counter': self.line_counter,
+            'inserted_line_counter': self.inserted_line_counter,
+            'messages': self.get_messages,
+        }
+
+
+class ImportedFile(models.Model):
+    ''' ImportedFile is the ledger entry of a datafile imported cleanly into a Bank: the SHA-256 of its content, the
+    span of its transaction dates and its counters. The same content uploaded again for the same bank is not imported
+    again, and the lines of a new file dated strictly inside the span of an imported file whose transaction number is
+    already in BankLine are skipped with a single message (see narrow_banklines). The first and last days of a span
+    may be partial and are still checked line by line. '''
+    bank = models.ForeignKey(Bank, on_delete=models.CASCADE)
+    file_name = models.CharField('nom du fichier', max_length=255)
+    sha256 = models.CharField('empreinte SHA-256', max_length=64)
+    size = models.BigIntegerField('taille', default=0)
+    date_start = models.DateField('première date', null=True, blank=True)
+    date_end = models.DateField('dernière date', null=True, blank=True)
+    line_counter = models.IntegerField('lignes lues', default=0)
+    inserted_line_counter = models.IntegerField('lignes importées', default=0)
+    imported_at = models.DateTimeField("date d'import", auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Fichier importé"
+        unique_together = ('bank', 'sha256')
+        ordering = ['-imported_at']
+
+    def __str__(self):
+        return self.file_name
+
+    def already_imported_message(self):
+        return MSG_FILE_ALREADY_IMPORTED % (timezone.localtime(self.imported_at).strftime('%d/%m/%Y %H:%M'), self.bank,
+                                            self.inserted_line_counter)
+
+    @staticmethod
+    def hash_chunks(chunks):
+        ''' Return the hexadecimal SHA-256 and the size of the content given as an iterable of bytes chunks. '''
+        digest = hashlib.sha256()
+        size = 0
+        for chunk in chunks:
+            digest.update(chunk)
+            size += len(chunk)
+        return digest.hexdigest(), size
+
+    @classmethod
+    def covered_spans(cls, bank):
+        ''' Return the date spans of the files imported into bank, sorted and merged when one starts strictly
+        before the end of another, as a list of (date_start, date_end) "YYYY-MM-DD" strings. '''
+        spans = []
+        for date_start, date_end in cls.objects.filter(bank=bank, date_start__isnull=False).order_by(
+                'date_start').values_list('date_start', 'date_end'):
+            if spans and date_start.isoformat() < spans[-1][1]:
+                spans[-1][1] = max(spans[-1][1], date_end.isoformat())
+            else:
+                spans.append([date_start.isoformat(), date_end.isoformat()])
+        return [tuple(span) for span in spans]
+
+    @classmethod
+    def narrow_banklines(cls, bank, banklines):
+        ''' Return the unsaved banklines of bank without those dated strictly inside the span of a file already
+        imported into bank whose transaction number is already in BankLine, and the number of lines skipped.
+        A new line inside a span (e.g. added late by the bank) is kept. '''
+        spans = cls.covered_spans(bank)
+        if not spans:
+            return banklines, 0
+        starts = [date_start for date_start, date_end in spans]
+        covered = []
+        for bankline in banklines:
+            transaction_date = str(bankline.transaction_date)
+            index = bisect.bisect_left(starts, transaction_date) - 1
+            if index >= 0 and transaction_date < spans[index][1]:
+                covered.append(bankline.transaction_number)
+        existing = BankLine.existing_transaction_numbers(covered)
+        kept = [bankline for bankline in banklines if bankline.transaction_number not in existing]
+        return kept, len(banklines) - len(kept)
+
+    @classmethod
+    def record(cls, bank, file_name, sha256, size, banklines, inserted_line_counter, parse_error_counter=0):
+        ''' Add to the ledger the file sha256 imported into bank, whose parsed lines were banklines, if it was
+        imported cleanly: no line rejected by the parser (parse_error_counter) and all of banklines now in BankLine.
+        Otherwise the file can be imported again once fixed. Return the ImportedFile, or None if not recorded. '''
+        transaction_numbers = {bankline.transaction_number for bankline in banklines}
+        if parse_error_counter or len(BankLine.existing_transaction_numbers(transaction_numbers)) < len(transaction_numbers):
+            return None
+        transaction_dates = [str(bankline.transaction_date) for bankline in banklines]
+        return cls.objects.update_or_create(bank=bank, sha256=sha256, defaults={
+            'file_name': file_name[:255],
+            'size': size,
+            'date_start': min(transaction_dates) if transaction_dates else None,
+            'date_end': max(transaction_dates) if transaction_dates else None,
+            'line_counter': len(banklines),
+            'inserted_line_counter': inserted_line_counter,
+        })[0]
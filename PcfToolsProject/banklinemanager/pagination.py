@@ -0,0 +1,80 @@
+import datetime
+import re
+
+from django.db.models import Q
+
+
+CURSOR_FORMAT = re.compile(r'^(\d{4}-\d{2}-\d{2})_(\d+)$')
+
+
+def encode_cursor(bankline):
+    ''' Return the cursor of a bankline: its transaction date and id, e.g. "2018-03-04_12". bankline can also be a
+    dict of values() with the keys transaction_date and id. '''
+    if isinstance(bankline, dict):
+        return "%s_%s" % (bankline['transaction_date'].isoformat(), bankline['id'])
+    return "%s_%s" % (bankline.transaction_date.isoformat(), bankline.pk)
+
+
+def decode_cursor(cursor):
+    ''' Return the (transaction_date, id) tuple of a cursor, or None if the cursor is missing or invalid. '''
+    cursor_re = CURSOR_FORMAT.match(cursor or "")
+    if cursor_re is None:
+        return None
+    try:
+        return datetime.datetime.strptime(cursor_re.group(1), '%Y-%m-%d').date(), int(cursor_re.group(2))
+    except ValueError:
+        return None
+
+
+class KeysetPage:
+    ''' One page of banklines with the cursors to the previous and next pages. Iterable like a Paginator page. '''
+    def __init__(self, object_list, has_previous, has_next):
+        self.object_list = object_list
+        self.has_previous = has_previous
+        self.has_next = has_next
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def previous_cursor(self):
+        return encode_cursor(self.object_list[0]) if self.object_list else None
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.object_list[-1]) if self.object_list else None
+
+
+class KeysetPaginator:
+    ''' Paginate a BankLine queryset from the most recent transaction with a (transaction_date, id) cursor
+    instead of OFFSET, so every page costs one indexed range query of per_page + 1 rows. '''
+    def __init__(self, queryset, per_page):
+        self.queryset = queryset
+        self.per_page = per_page
+
+    def page(self, after=None, before=None):
+        ''' Return the page following the cursor after, or preceding the cursor before, or the first page. '''
+        after = decode_cursor(after)
+        before = decode_cursor(before)
+        if before is not None:
+            transaction_date, pk = before
+            object_list = list(self.queryset.filter(
+                Q(transaction_date__gt=transaction_date) | Q(pk__gt=pk),
+                transaction_date__gte=transaction_date,
+            ).order_by('transaction_date', 'pk')[:self.per_page + 1])
+            has_previous = len(object_list) > self.per_page
+            object_list = object_list[:self.per_page][::-1]
+            return KeysetPage(object_list, has_previous, True)
+
+        queryset = self.queryset
+        if after is not None:
+            transaction_date, pk = after
+            queryset = queryset.filter(
+                Q(transaction_date__lt=transaction_date) | Q(pk__lt=pk),
+                transaction_date__lte=transaction_date,
+            )
+        object_list = list(queryset.order_by('-transaction_date', '-pk')[:self.per_page + 1])
+        return KeysetPage(object_list[:self.per_page], after is not None, len(object_list) > self.per_page)
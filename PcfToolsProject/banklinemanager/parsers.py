@@ -0,0 +1,214 @@
+import codecs
+import itertools
+import re
+from xml.etree import ElementTree
+
+
+# Size of the blocks read from a datafile by the streaming parsers
+READ_CHUNK_SIZE = 64 * 1024
+
+OFX_SGML_STMTTRN_START = '<STMTTRN>'
+OFX_SGML_STMTTRN_END = '</STMTTRN>'
+OFX_SGML_FIELD = re.compile(r'<([A-Z0-9.]+)>([^<]*)')
+# Entities of the characters delimiting the tags, e.g. written by the OFX export
+OFX_SGML_ENTITY = re.compile(r'&(amp|lt|gt);')
+OFX_SGML_ENTITIES = {'amp': "&", 'lt': "<", 'gt': ">"}
+# Encoding of the datafiles without OFX header (CEPAC CSV) or whose header does not give a known charset
+DEFAULT_ENCODING = 'latin-1'
+# Size of the beginning of a datafile read before parsing to find its encoding
+HEADER_SEARCH_SIZE = 1024
+OFX_HEADER_ENCODING = re.compile(rb'^[ \t]*ENCODING:[ \t]*([\w-]+)', re.MULTILINE)
+OFX_HEADER_CHARSET = re.compile(rb'^[ \t]*CHARSET:[ \t]*([\w-]+)', re.MULTILINE)
+# OFX 1.x CHARSET values (with ENCODING:USASCII) and their Python codec
+OFX_CHARSETS = {b'1252': 'cp1252', b'ISO-8859-1': 'latin-1', b'8859-1': 'latin-1', b'NONE': DEFAULT_ENCODING}
+UTF8_BOM = codecs.BOM_UTF8
+
+
+def iter_chunks(datafile, chunk_size=READ_CHUNK_SIZE):
+    ''' Yield datafile by blocks of chunk_size. datafile can be a string, an object with a read() method
+    or an iterable of strings (e.g. the chunks of an upload). Bytes are accepted as well as strings. '''
+    if isinstance(datafile, (str, bytes)):
+        for start in range(0, len(datafile), chunk_size):
+            yield datafile[start:start + chunk_size]
+    elif hasattr(datafile, 'read'):
+        chunk = datafile.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = datafile.read(chunk_size)
+    else:
+        yield from datafile
+
+
+def peek_head(chunks, size=HEADER_SEARCH_SIZE):
+    ''' Return the first size bytes (at least) of the iterable of bytes chunks, and an iterator over all the chunks
+    including them. Only the chunks needed to get size bytes are read. '''
+    chunks = iter(chunks)
+    head = []
+    while sum(len(chunk) for chunk in head) < size:
+        chunk = next(chunks, None)
+        if chunk is None:
+            break
+        head.append(chunk)
+    return b"".join(head), itertools.chain(head, chunks)
+
+
+def detect_encoding(head):
+    ''' Return the Python codec of a datafile from its first bytes head: UTF-8 with a BOM or an OFX header
+    ENCODING:UTF-8, the codec of the OFX header CHARSET (e.g. 1252), else DEFAULT_ENCODING. '''
+    if head.startswith(UTF8_BOM):
+        return 'utf-8-sig'
+    # the OFX header ends at the first tag
+    header = head.split(b'<', 1)[0]
+    encoding_re = OFX_HEADER_ENCODING.search(header)
+    if encoding_re is not None and encoding_re.group(1).upper().replace(b'-', b'') == b'UTF8':
+        return 'utf-8'
+    charset_re = OFX_HEADER_CHARSET.search(header)
+    if charset_re is not None:
+        charset = charset_re.group(1).upper()
+        if charset in OFX_CHARSETS:
+            return OFX_CHARSETS[charset]
+        try:
+            return codecs.lookup(charset.decode('ascii')).name
+        except LookupError:
+            pass
+    return DEFAULT_ENCODING
+
+
+def iter_decoded(chunks, encoding, errors='replace'):
+    ''' Decode the iterable of bytes chunks with an incremental decoder and yield the text chunks. A character
+    split across two chunks is decoded once both are read. '''
+    decoder = codecs.getincrementaldecoder(encoding)(errors)
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def iter_lines(text_chunks):
+    ''' Yield the lines of the iterable of text chunks with their line ending, as read by csv.reader. '''
+    buffer = ""
+    for chunk in text_chunks:
+        buffer += chunk
+        lines = buffer.split("\n")
+        buffer = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if buffer:
+        yield buffer
+
+
+def _unescape_sgml(value):
+    return OFX_SGML_ENTITY.sub(lambda entity: OFX_SGML_ENTITIES[entity.group(1)], value) if "&" in value else value
+
+
+def iter_ofxsgml_transactions(ofx_file, chunk_size=READ_CHUNK_SIZE):
+    ''' Read an OFX SGML datafile by chunks and yield one dict per <STMTTRN> aggregate, in a single pass.
+    Keys are the tag names found in the aggregate (TRNTYPE, DTPOSTED, TRNAMT, FITID, NAME, MEMO...) and values
+    are the stripped tag contents with &amp;, &lt; and &gt; unescaped, so optional tags are simply missing. Closing tags of elements are optional
+    as in SGML, and line endings (\\n or \\r\\n) do not matter. '''
+    buffer = ""
+    for chunk in iter_chunks(ofx_file, chunk_size):
+        buffer += chunk
+        start = buffer.find(OFX_SGML_STMTTRN_START)
+        while start != -1:
+            end = buffer.find(OFX_SGML_STMTTRN_END, start)
+            if end == -1:
+                break
+            yield {tag: _unescape_sgml(value.strip())
+                   for tag, value in OFX_SGML_FIELD.findall(buffer, start + len(OFX_SGML_STMTTRN_START), end)}
+            start = buffer.find(OFX_SGML_STMTTRN_START, end)
+        # Keep the aggregate not yet closed, or the end of the buffer which may hold a truncated opening tag.
+        buffer = buffer[start:] if start != -1 else buffer[-len(OFX_SGML_STMTTRN_START):]
+
+
+def iter_xml_elements(xml_file, tag, chunk_size=READ_CHUNK_SIZE):
+    ''' Read an XML datafile by chunks with an incremental XML parser and yield each element named tag (whatever
+    its namespace) once fully read. The element is removed from the tree when the next one is requested, so a
+    large statement never builds a full DOM. Feeding bytes lets the parser use the encoding declared in the
+    XML header. '''
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    elements = []
+    for chunk in itertools.chain(iter_chunks(xml_file, chunk_size), [None]):
+        if chunk is None:
+            parser.close()
+        else:
+            parser.feed(chunk)
+        for event, element in parser.read_events():
+            if event == 'start':
+                elements.append(element)
+                continue
+            elements.pop()
+            if _local_tag(element.tag) == tag:
+                yield element
+                if elements:
+                    elements[-1].remove(element)
+                element.clear()
+
+
+def iter_ofxxml_transactions(ofx_file, chunk_size=READ_CHUNK_SIZE):
+    ''' Read an OFX XML (OFX 2.x) datafile by chunks and yield one dict per <STMTTRN> element, with the same
+    keys and values as iter_ofxsgml_transactions (see iter_xml_elements). '''
+    for element in iter_xml_elements(ofx_file, 'STMTTRN', chunk_size):
+        yield {_local_tag(child.tag): (child.text or "").strip() for child in element if len(child) == 0}
+
+
+def iter_camt053_entries(camt_file, chunk_size=READ_CHUNK_SIZE):
+    ''' Read a CAMT.053 (ISO 20022 bank to customer statement) XML datafile by chunks and yield one dict per
+    <Ntry> element (see iter_xml_elements). Keys are the tags of the simple children of the entry (Amt,
+    CdtDbtInd, NtryRef, AcctSvcrRef, AddtlNtryInf...), the dates and status (BookgDt, ValDt, Sts) with the
+    value of their single child, then from the transaction details: EndToEndId, CdtrNm and DbtrNm (names of the
+    creditor and debtor) and Ustrd (the unstructured remittance information lines joined by a space). '''
+    for entry in iter_xml_elements(camt_file, 'Ntry', chunk_size):
+        fields = {}
+        for child in entry:
+            if len(child) == 0:
+                fields[_local_tag(child.tag)] = (child.text or "").strip()
+            elif len(child[0]) == 0:
+                fields[_local_tag(child.tag)] = (child[0].text or "").strip()
+        remittance = []
+        for element in entry.iter():
+            tag = _local_tag(element.tag)
+            if tag == 'Ustrd':
+                remittance.append((element.text or "").strip())
+            elif tag in ('EndToEndId', 'AcctSvcrRef') and tag not in fields:
+                fields[tag] = (element.text or "").strip()
+            elif tag in ('Cdtr', 'Dbtr') and tag + 'Nm' not in fields:
+                name = next((name for name in element.iter() if _local_tag(name.tag) == 'Nm'), None)
+                if name is not None:
+                    fields[tag + 'Nm'] = (name.text or "").strip()
+        fields['Ustrd'] = " ".join(line for line in remittance if line)
+        yield fields
+
+
+def iter_qif_records(text_chunks):
+    ''' Yield one dict per record of a QIF datafile, read from an iterable of text chunks. A record is the lines
+    before a "^" line, each line being a field code (its first character: D date, T or U amount, N number,
+    P payee, M memo...) followed by its value. Only the first line of a code is kept, so the split lines
+    (S, E, $) of a record are ignored. The key "!" holds the last header line of the file without its "!"
+    (e.g. "Type:Bank"), so the records of the account or category lists can be told apart. '''
+    header = ""
+    record = {}
+    for line in iter_lines(text_chunks):
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('!'):
+            header = line[1:]
+        elif line == '^':
+            if record:
+                record['!'] = header
+                yield record
+            record = {}
+        else:
+            record.setdefault(line[0], line[1:].strip())
+    if record:
+        record['!'] = header
+        yield record
+
+
+def _local_tag(tag):
+    ''' Return tag without its XML namespace. '''
+    return tag.rsplit('}', 1)[-1]
@@ -0,0 +1,129 @@
+''' Reconciliation of two sets of bank lines, e.g. the CSV and OFX imports of the same period of an account, lines
+of two accounts (transfers between them), or a datafile with the lines already imported.
+
+Each line of one set is compared only with the lines of the other set having the same amount (or the opposite
+amount for transfers) and a transaction date in a window of a few days: the other set is bucketed by amount and
+each bucket sorted by date, so the candidates are found with a bisection instead of comparing all the pairs.
+Candidate pairs are ranked by the similarity of their wordings (trigrams of the search text), then by the gap
+between their dates. From the best ranked pairs down, a pair is matched when both of its lines are still free and
+neither line has another free candidate ranked the same; otherwise its lines are reported as ambiguous. '''
+import bisect
+import datetime
+import itertools
+from collections import defaultdict, namedtuple
+
+
+DEFAULT_DATE_WINDOW = 3
+
+ReconciliationLine = namedtuple('ReconciliationLine', ['id', 'transaction_date', 'amount', 'search_text',
+                                                       'transaction_number'])
+
+
+class ReconciliationReport:
+    ''' Result of reconcile: matched (list of (left line, right line, similarity)), ambiguous (list of
+    (left line, list of right lines ranked the same)), and the lines neither matched nor ambiguous, unmatched_left
+    and unmatched_right. '''
+    def __init__(self, matched, ambiguous, unmatched_left, unmatched_right):
+        self.matched = matched
+        self.ambiguous = ambiguous
+        self.unmatched_left = unmatched_left
+        self.unmatched_right = unmatched_right
+
+    def __str__(self):
+        return "%s rapprochées, %s ambiguës, %s sans correspondance à gauche, %s sans correspondance à droite" % (
+            len(self.matched), len(self.ambiguous), len(self.unmatched_left), len(self.unmatched_right))
+
+
+def trigrams(text):
+    ''' Return the set of the 3 characters sequences of text (as tuples), padded so short words have some too. '''
+    text = "  %s " % (" ".join(text.split()))
+    return set(zip(text, text[1:], text[2:]))
+
+
+def similarity(trigrams_a, trigrams_b):
+    ''' Return the Jaccard similarity of two trigram sets, from 0 (nothing in common) to 1. '''
+    if not trigrams_a and not trigrams_b:
+        return 1.0
+    return len(trigrams_a & trigrams_b) / len(trigrams_a | trigrams_b)
+
+
+def reconcile(left, right, date_window=DEFAULT_DATE_WINDOW, min_similarity=0.0, opposite=False, same_set=False):
+    ''' Reconcile the ReconciliationLine lists left and right (ids unique across both).
+    date_window is the largest gap in days between two matched lines, min_similarity the lowest similarity of
+    their wordings. With opposite, a line matches a line of the opposite amount (a transfer between two accounts).
+    With same_set, left and right are the same lines, searched for duplicates (unmatched_right is then
+    unmatched_left). Return a ReconciliationReport. '''
+    # right lines bucketed by amount, each bucket sorted by date with its dates apart for the bisection
+    buckets = defaultdict(list)
+    for line in sorted(right, key=lambda line: line.transaction_date):
+        buckets[line.amount].append(line)
+    bucket_dates = {amount: [line.transaction_date.toordinal() for line in lines] for amount, lines in buckets.items()}
+
+    # by text, since many lines share the same wording
+    trigram_cache = {}
+
+    def line_trigrams(line):
+        if line.search_text not in trigram_cache:
+            trigram_cache[line.search_text] = trigrams(line.search_text)
+        return trigram_cache[line.search_text]
+
+    pairs = []
+    for line in left:
+        amount = -line.amount if opposite else line.amount
+        if amount not in buckets:
+            continue
+        day = line.transaction_date.toordinal()
+        dates = bucket_dates[amount]
+        for candidate in buckets[amount][bisect.bisect_left(dates, day - date_window):
+                                         bisect.bisect_right(dates, day + date_window)]:
+            if same_set and candidate.id <= line.id:
+                continue
+            score = similarity(line_trigrams(line), line_trigrams(candidate))
+            if score < min_similarity:
+                continue
+            # rank: best similarity first, then smallest date gap (rounded so float noise does not break ties)
+            pairs.append(((-round(score, 6), abs(day - candidate.transaction_date.toordinal())), line, candidate))
+
+    pairs.sort(key=lambda pair: pair[0])
+    used = set()
+    matched, ambiguous = [], {}
+    for rank, group in itertools.groupby(pairs, key=lambda pair: pair[0]):
+        free_pairs = [(line, candidate) for rank, line, candidate in group
+                      if line.id not in used and candidate.id not in used]
+        left_counts = defaultdict(int)
+        right_counts = defaultdict(int)
+        for line, candidate in free_pairs:
+            left_counts[line.id] += 1
+            right_counts[candidate.id] += 1
+        for line, candidate in free_pairs:
+            if left_counts[line.id] == 1 and right_counts[candidate.id] == 1:
+                matched.append((line, candidate, -rank[0]))
+            else:
+                ambiguous.setdefault(line.id, (line, []))[1].append(candidate)
+        for line, candidate in free_pairs:
+            used.update((line.id, candidate.id))
+
+    unmatched_left = [line for line in left if line.id not in used]
+    unmatched_right = unmatched_left if same_set else [line for line in right if line.id not in used]
+    return ReconciliationReport(matched, list(ambiguous.values()), unmatched_left, unmatched_right)
+
+
+def lines_from_queryset(banklines):
+    ''' Return the ReconciliationLine of the banklines queryset, read without building model instances. '''
+    return [ReconciliationLine(*values) for values in banklines.order_by().values_list(
+        'pk', 'transaction_date', 'amount', 'search_text', 'transaction_number').iterator(chunk_size=10000)]
+
+
+def lines_from_banklines(banklines):
+    ''' Return the ReconciliationLine of unsaved BankLine objects (e.g. parsed from a datafile), with negative ids
+    which cannot collide with the ids of saved lines. '''
+    lines = []
+    for index, bankline in enumerate(banklines, 1):
+        bankline.compute_amount()
+        bankline.compute_search_text()
+        transaction_date = bankline.transaction_date
+        if isinstance(transaction_date, str):
+            transaction_date = datetime.datetime.strptime(transaction_date, '%Y-%m-%d').date()
+        lines.append(ReconciliationLine(-index, transaction_date, bankline.amount, bankline.search_text,
+                                        bankline.transaction_number))
+    return lines
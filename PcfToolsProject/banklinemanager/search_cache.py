@@ -0,0 +1,201 @@
+''' Cache of the search results (pages and totals), keyed by the normalized filters of the search.
+
+Each entry is recorded in a registry with the bank and the date range it covers, so inserting, editing or
+deleting lines of a bank between two dates deletes only the entries which may contain them: the entries of
+this bank or of all banks, whose date range overlaps (or which have no date range).
+A generation number, incremented by each invalidation, prevents storing a result computed while lines were
+being changed. Use a cache shared by all the processes (e.g. FileBasedCache) when imports run in another
+process than the web server, such as the import_datafiles command.
+The registry is read, changed and written back under a lock (see registry_lock), so two processes or threads
+updating it at once do not lose each other's entries. The lock is taken with cache.add, atomic with the
+local-memory, memcached or database caches, but not with FileBasedCache, whose lock is a file created in the
+cache directory with O_EXCL instead. '''
+import hashlib
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.filebased import FileBasedCache
+from django.db import transaction
+
+from .fulltext import normalize_text
+
+
+CACHE_KEY_PREFIX = 'banklinemanager:search:'
+REGISTRY_KEY = CACHE_KEY_PREFIX + 'registry'
+GENERATION_KEY = CACHE_KEY_PREFIX + 'generation'
+LOCK_KEY = CACHE_KEY_PREFIX + 'lock'
+LOCK_FILENAME = 'banklinemanager_search_registry.lock'
+# Seconds after which the lock expires, should its holder die before releasing it
+LOCK_TIMEOUT = 10
+# Seconds a new result waits for the lock before being returned without being cached
+LOCK_WAIT = 1
+LOCK_POLL_INTERVAL = 0.005
+# Oldest entries are dropped beyond this size, so the registry stays small to read and write
+REGISTRY_MAX_SIZE = 500
+
+
+def get_cache():
+    return caches[getattr(settings, 'BANKLINE_SEARCH_CACHE', 'default')]
+
+
+def get_timeout():
+    return getattr(settings, 'BANKLINE_SEARCH_CACHE_TIMEOUT', 600)
+
+
+def _amount(value):
+    try:
+        return Decimal(value).quantize(Decimal('0.01')) if value else None
+    except InvalidOperation:
+        return None
+
+
+def normalize_filters(query, type_search, date_start, date_end, sum_min, sum_max, bank_id):
+    ''' Return the filters of BankLine.search_bankline as a tuple equal for all the searches with the same
+    results: keywords normalized as search_text, sorted and without duplicates, single date or amount given
+    as a range, amount range in increasing order. '''
+    keywords = tuple(sorted({normalize_text(keyword) for keyword in query.split("\r\n")})) if query else ()
+    type_search = type_search if type_search in ("startswith", "fuzzy") else "contains"
+    date_range = (date_start, date_end or date_start) if date_start else None
+    sum_min, sum_max = _amount(sum_min), _amount(sum_max)
+    amount_range = tuple(sorted((sum_min, sum_max if sum_max is not None else sum_min))) if sum_min else None
+    bank_id = int(bank_id) if bank_id and str(bank_id).isdigit() else None
+    return keywords, type_search, date_range, amount_range, bank_id
+
+
+def cache_key(filters):
+    return CACHE_KEY_PREFIX + hashlib.sha1(repr(filters).encode()).hexdigest()
+
+
+class RegistryLocked(Exception):
+    pass
+
+
+def _acquire_cache_lock(cache, token):
+    return cache.add(LOCK_KEY, token, LOCK_TIMEOUT)
+
+
+def _release_cache_lock(cache, token):
+    if cache.get(LOCK_KEY) == token:
+        cache.delete(LOCK_KEY)
+
+
+def _lock_path(cache):
+    # FileBasedCache only lists and deletes its *.djcache files, so the lock file is left alone
+    return os.path.join(cache._dir, LOCK_FILENAME)
+
+
+def _acquire_file_lock(cache, token):
+    path = _lock_path(cache)
+    os.makedirs(cache._dir, exist_ok=True)
+    try:
+        descriptor = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(path) > LOCK_TIMEOUT:
+                # its holder died without releasing it
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        return False
+    with os.fdopen(descriptor, 'w') as lock_file:
+        lock_file.write(token)
+    return True
+
+
+def _release_file_lock(cache, token):
+    path = _lock_path(cache)
+    try:
+        with open(path) as lock_file:
+            if lock_file.read() == token:
+                os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+@contextmanager
+def registry_lock(cache, wait=None):
+    ''' Hold the lock of the registry within the block. Wait for it at most wait seconds, then raise
+    RegistryLocked; with wait None, until it is released or expires (LOCK_TIMEOUT). '''
+    if isinstance(cache, FileBasedCache):
+        acquire, release = _acquire_file_lock, _release_file_lock
+    else:
+        acquire, release = _acquire_cache_lock, _release_cache_lock
+    token = uuid.uuid4().hex
+    deadline = None if wait is None else time.monotonic() + wait
+    while not acquire(cache, token):
+        if deadline is not None and time.monotonic() > deadline:
+            raise RegistryLocked()
+        time.sleep(LOCK_POLL_INTERVAL)
+    try:
+        yield
+    finally:
+        release(cache, token)
+
+
+def get_or_compute(filters, compute):
+    ''' Return the cached result of the normalized filters, or compute() it and cache it. '''
+    cache = get_cache()
+    key = cache_key(filters)
+    result = cache.get(key)
+    if result is not None:
+        return result
+
+    generation = cache.get(GENERATION_KEY, 0)
+    result = compute()
+    try:
+        with registry_lock(cache, LOCK_WAIT):
+            if cache.get(GENERATION_KEY, 0) == generation:
+                date_range, bank_id = filters[2], filters[4]
+                registry = [entry for entry in cache.get(REGISTRY_KEY, []) if entry[0] != key]
+                registry.append((key, bank_id, date_range))
+                cache.delete_many([entry[0] for entry in registry[:-REGISTRY_MAX_SIZE]])
+                cache.set_many({key: result, REGISTRY_KEY: registry[-REGISTRY_MAX_SIZE:]}, get_timeout())
+    except RegistryLocked:
+        pass
+    return result
+
+
+def invalidate(bank_id, date_start, date_end):
+    ''' Delete the cached results which may contain lines of bank_id dated between date_start and date_end. '''
+    cache = get_cache()
+    date_start, date_end = str(date_start), str(date_end)
+    with registry_lock(cache):
+        try:
+            cache.incr(GENERATION_KEY)
+        except ValueError:
+            cache.set(GENERATION_KEY, 1, None)
+
+        stale, registry = [], []
+        for entry in cache.get(REGISTRY_KEY, []):
+            key, entry_bank_id, date_range = entry
+            if (entry_bank_id is None or entry_bank_id == bank_id) and (
+                    date_range is None or (date_range[0] <= date_end and date_start <= date_range[1])):
+                stale.append(key)
+            else:
+                registry.append(entry)
+        if stale:
+            cache.delete_many(stale)
+            cache.set(REGISTRY_KEY, registry, get_timeout())
+
+
+def invalidate_banklines(banklines):
+    ''' Delete the cached results which may contain any of banklines, one invalidation per bank, once the current
+    transaction is committed (at once outside a transaction): a search run before the commit still reads the old
+    lines, and must not be able to cache them under the new generation. '''
+    date_ranges = {}
+    for bankline in banklines:
+        transaction_date = str(bankline.transaction_date)
+        date_start, date_end = date_ranges.get(bankline.bank_id, (transaction_date, transaction_date))
+        date_ranges[bankline.bank_id] = (min(date_start, transaction_date), max(date_end, transaction_date))
+    if date_ranges:
+        transaction.on_commit(lambda: _invalidate_date_ranges(date_ranges))
+
+
+def _invalidate_date_ranges(date_ranges):
+    for bank_id, (date_start, date_end) in date_ranges.items():
+        invalidate(bank_id, date_start, date_end)
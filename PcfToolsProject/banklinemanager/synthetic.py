@@ -0,0 +1,127 @@
+''' Seeded generator of realistic synthetic bank lines and datafiles, for the benchmarks.
+
+The same seed always gives the same transactions: dates over several years, mostly small card payments with a
+few large transfers, recurring merchants with accents, varying case and repeated spaces as in the real datafiles.
+They are written in each datafile format accepted by the import: OFX SGML, OFX XML and CEPAC CSV.
+The benchmarks write them in a test database of their own (see benchmark_database). '''
+import datetime
+import os
+import random
+import tempfile
+from contextlib import contextmanager
+from xml.sax.saxutils import escape
+
+from django.db import connection
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+
+MERCHANTS = ["CB CARREFOUR MARKET", "CB  Intermarché", "CB BOULANGERIE DU PORT", "CB PHARMACIE CENTRALE",
+             "CB SNCF INTERNET", "CB Café de la Gare", "PRLV EDF CLIENTS PARTICULIERS", "PRLV ORANGE",
+             "PRLV FREE MOBILE", "RETRAIT DAB", "VIR SEPA LOYER", "CHQ", "CB LIDL", "CB AMAZON EU SARL",
+             "CB STATION TOTAL", "PRLV MUTUELLE SANTÉ", "CB RESTAURANT LE PANIER", "CB DÉCATHLON"]
+INCOMES = ["VIR SALAIRE", "VIR CAF", "REMBT CPAM", "VIR SEPA REÇU"]
+FIRST_DATE = datetime.date(2014, 1, 1)
+DAYS = 365 * 5
+# Caches of the benchmarks, so they neither read nor clear the caches shared with the web server
+BENCHMARK_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'pcftools-benchmark'},
+    'search': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'pcftools-benchmark-search'},
+}
+
+
+def synthetic_transactions(line_count, prefix="SYN", seed=0):
+    ''' Yield line_count transaction dicts with the keys date (datetime.date), amount (signed float), fitid
+    (starting with prefix, unique), name and memo. '''
+    rand = random.Random(seed)
+    for i in range(line_count):
+        if rand.random() < 0.9:
+            name = rand.choice(MERCHANTS)
+            # mostly small payments, sometimes a few hundreds
+            amount = -round(min(rand.lognormvariate(3, 1.1), 9000), 2) or -0.01
+        else:
+            name = rand.choice(INCOMES)
+            amount = round(rand.uniform(20, 4000), 2)
+        yield {
+            'date': FIRST_DATE + datetime.timedelta(days=rand.randrange(DAYS)),
+            'amount': amount,
+            'fitid': "%s%09d" % (prefix, i),
+            'name': "%s %s" % (name, rand.randint(1, 9999)),
+            'memo': "REF %s %s" % (rand.randint(10**5, 10**6), rand.choice(["", "", "FACTURE", "Échéance"])),
+        }
+
+
+OFX_SGML_TRANSACTION = """<STMTTRN>
+<TRNTYPE>%(trntype)s
+<DTPOSTED>%(date)s
+<TRNAMT>%(amount).2f
+<FITID>%(fitid)s
+<NAME>%(name)s
+<MEMO>%(memo)s
+</STMTTRN>
+"""
+
+OFX_XML_TRANSACTION = """<STMTTRN><TRNTYPE>%(trntype)s</TRNTYPE><DTPOSTED>%(date)s</DTPOSTED><TRNAMT>%(amount).2f</TRNAMT>\
+<FITID>%(fitid)s</FITID><NAME>%(name)s</NAME><MEMO>%(memo)s</MEMO></STMTTRN>
+"""
+
+
+def _ofx_values(transaction, escape_text=str):
+    return {
+        'trntype': "DEBIT" if transaction['amount'] < 0 else "CREDIT",
+        'date': transaction['date'].strftime('%Y%m%d'),
+        'amount': transaction['amount'],
+        'fitid': transaction['fitid'],
+        'name': escape_text(transaction['name']),
+        'memo': escape_text(transaction['memo']),
+    }
+
+
+def to_ofxsgml(transactions):
+    ''' Return the transactions as an OFX SGML datafile (str). '''
+    return "OFXHEADER:100\nDATA:OFXSGML\nVERSION:102\n\n<OFX>\n<BANKTRANLIST>\n%s</BANKTRANLIST>\n</OFX>\n" % (
+        "".join(OFX_SGML_TRANSACTION % _ofx_values(transaction) for transaction in transactions))
+
+
+def to_ofxxml(transactions):
+    ''' Return the transactions as an OFX XML datafile (bytes, encoded in UTF-8 as declared). '''
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<?OFX OFXHEADER="200" VERSION="211"?>\n<OFX><BANKMSGSRSV1>'
+            '<STMTTRNRS><STMTRS><BANKTRANLIST>\n%s</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>\n' % (
+                "".join(OFX_XML_TRANSACTION % _ofx_values(transaction, escape) for transaction in transactions))
+            ).encode('utf-8')
+
+
+def to_csv_cepac(transactions):
+    ''' Return the transactions as a CEPAC CSV datafile (str): date;number -;wording;debit;credit;detail. '''
+    rows = []
+    for transaction in transactions:
+        amount = ("%.2f" % (transaction['amount'])).replace(".", ",")
+        rows.append("%s;%s -;%s;%s;%s;%s;\r\n" % (
+            transaction['date'].strftime('%d/%m/%y'), transaction['fitid'], transaction['name'],
+            amount if transaction['amount'] < 0 else "", amount if transaction['amount'] >= 0 else "",
+            transaction['memo']))
+    return "".join(rows)
+
+
+@contextmanager
+def benchmark_database(use_test_database=True, verbosity=0):
+    ''' Run the block on a new test database, created and migrated as by the test runner then destroyed, with
+    local caches: a benchmark never writes in the configured database, holds its lock or clears the shared caches.
+    A SQLite test database is a temporary file rather than in memory, so the disk writes are measured too.
+    With use_test_database False (e.g. from the tests, which already run on a test database), the block runs on
+    the current database. '''
+    if not use_test_database:
+        yield
+        return
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    test_name = test_settings.get('NAME')
+    with tempfile.TemporaryDirectory() as directory, override_settings(CACHES=BENCHMARK_CACHES):
+        if connection.vendor == 'sqlite' and not test_name:
+            test_settings['NAME'] = os.path.join(directory, "benchmark.sqlite3")
+        try:
+            old_config = setup_databases(verbosity, interactive=False)
+            try:
+                yield
+            finally:
+                teardown_databases(old_config, verbosity)
+        finally:
+            test_settings['NAME'] = test_name
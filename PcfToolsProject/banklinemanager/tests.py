@@ -1,20 +1,65 @@
 import csv
+import datetime
+import importlib
 import io
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+import zipfile
+from decimal import Decimal
 
-from django.test import TestCase
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import connection
+from django.db.backends.sqlite3.base import DatabaseWrapper as SqliteDatabaseWrapper
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.utils.http import http_date
 from django.test.client import Client
 from django.contrib.auth.models import User
 from django.contrib.auth.models import Permission
 
-from .models import BankLine, Bank
+from . import analytics, importers
+from .batch import import_datafiles, iter_datafiles, resolve_bank
+from .categorization import Categorizer, KeywordAutomaton
+from .database import configure_connection
+from .fulltext import TRIGRAM_INDEX, fulltext_available
+from .instrumentation import SLOWEST_QUERIES_KEPT, UNRESOLVED_VIEW, RequestRecorder, get_stats
+from .models import BankLine, Bank, BankCsvFormat, BankMonthSummary, Category, CategoryRule, ImportedFile, ImportJob
+from .pagination import KeysetPaginator
+from .parsers import detect_encoding, iter_decoded, iter_lines, iter_ofxsgml_transactions, iter_ofxxml_transactions
+from .reconciliation import ReconciliationLine, reconcile
+from . import search_cache
+from .synthetic import synthetic_transactions, to_csv_cepac, to_ofxsgml, to_ofxxml
 
 # Create your tests here.
 
+# Per-process caches, so the tests never clear the shared search cache of the development server
+TEST_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'pcftools-tests'},
+    'search': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'pcftools-tests-search'},
+}
+
+
+def run_commit_callbacks():
+    """Run the on_commit callbacks of the transaction wrapping the test, as its commit would"""
+    callbacks, connection.run_on_commit = connection.run_on_commit, []
+    for savepoint_ids, callback in callbacks:
+        callback()
+
+
+@override_settings(CACHES=TEST_CACHES)
 class PrepareDataTestCase(TestCase):
     """Class to test Index page"""
     def setUp(self):
         '''Prepare data for test Search Data page. ran before each test. '''
+        search_cache.get_cache().clear()
         self.bank_cepac = Bank.objects.create(name="cepac test", _account_number="123456789", _datafile_format=Bank.FORMAT_CSV)
         self.bank_smc = Bank.objects.create(name="smc test", _account_number="987654321", _datafile_format=Bank.FORMAT_OFX_SGML)
         BankLine.objects.create(transaction_date="2018-03-01",
@@ -58,6 +103,27 @@ class IndexPageTestCase(PrepareDataTestCase):
         self.assertContains(response, 'test128 credit')
 
 
+    def test_index_cursor_page(self):
+        """Test that the next page of index starts after the cursor"""
+        response = self.client.get(reverse('banklinemanager:index'), {'after': '2018-03-04_%s' % (BankLine.objects.get(transaction_number="541876454").pk)})
+        self.assertContains(response, 'test128 credit')
+        self.assertNotContains(response, 'test debit')
+
+    def test_keyset_paginator(self):
+        """Test that pages follow each other both ways, same dates ordered by id"""
+        BankLine.objects.create(transaction_date="2018-03-04", wording="test same date", transaction_number="541876455",
+                                debit=-1.0, credit=0.0, bank=self.bank_cepac)
+        paginator = KeysetPaginator(BankLine.objects.all(), 1)
+        pages = [paginator.page()]
+        while pages[-1].has_next:
+            pages.append(paginator.page(after=pages[-1].next_cursor))
+        self.assertEqual([page.object_list[0].transaction_number for page in pages], ["541876455", "541876454", "15526026"])
+        self.assertFalse(pages[0].has_previous)
+        previous_page = paginator.page(before=pages[2].previous_cursor)
+        self.assertEqual(previous_page.object_list, pages[1].object_list)
+        self.assertTrue(previous_page.has_previous)
+
+
 class ImportDataPageTestCase(PrepareDataTestCase):
     """Class to test Import Data page"""
     def test_import_data_page(self):
@@ -65,6 +131,160 @@ class ImportDataPageTestCase(PrepareDataTestCase):
         response = self.client.get(reverse('banklinemanager:import_data'))
         self.assertEqual(response.status_code, 200)
 
+    @override_settings(BANKLINE_IMPORT_WORKERS=0)
+    def test_import_data_upload_job(self):
+        """Test that each uploaded file becomes an import job and that its status can be polled"""
+        csv_upload = SimpleUploadedFile("releve.csv", "31/03/18;31032018-1 -;vir été;504;;mon test vir;\n".encode('latin-1'))
+        response = self.client.post(reverse('banklinemanager:import_data'), {'bank': self.bank_cepac.pk, 'csv_file': csv_upload})
+        self.assertEqual(response.status_code, 200)
+        job = ImportJob.objects.get()
+        self.assertEqual((job.status, job.line_counter, job.inserted_line_counter), (ImportJob.STATUS_DONE, 1, 1))
+        self.assertEqual(BankLine.objects.get(transaction_number="31032018-1").wording, "vir été")
+        response = self.client.get(reverse('banklinemanager:import_job_status', args=[job.pk]))
+        self.assertEqual(response.json()['status'], ImportJob.STATUS_DONE)
+        self.assertEqual(response.json()['messages'], ["-> 1 lignes sur 1 ont été importés."])
+
+    @override_settings(BANKLINE_IMPORT_WORKERS=0)
+    def test_import_data_upload_job_failed(self):
+        """Test that an unreadable file gives a failed job"""
+        bank_xml = Bank.objects.create(name="xml test", _account_number="555", _datafile_format=Bank.FORMAT_OFX_XML)
+        xml_upload = SimpleUploadedFile("releve.ofx", b"<OFX><STMTTRN>")
+        self.client.post(reverse('banklinemanager:import_data'), {'bank': bank_xml.pk, 'csv_file': xml_upload})
+        job = ImportJob.objects.get()
+        self.assertEqual(job.status, ImportJob.STATUS_FAILED)
+        self.assertIn("n'a pas été importé", job.messages)
+
+    @override_settings(BANKLINE_IMPORT_WORKERS=0)
+    def test_import_data_upload_zip_detect_bank(self):
+        """Test that each file of an uploaded zip archive is imported in the bank detected from it"""
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as archive_file:
+            archive_file.writestr("releve.ofx", "<ACCTID>987654321\n<STMTTRN>\n<TRNTYPE>CREDIT\n<DTPOSTED>20180629\n"
+                                                "<TRNAMT>4.40\n<FITID>zip1\n<NAME>test zip\n</STMTTRN>")
+            archive_file.writestr("123456789_mars.csv", "31/03/18;zip2 -;vir test;504;;mon test vir;\n")
+        zip_upload = SimpleUploadedFile("releves.zip", archive.getvalue())
+        self.client.post(reverse('banklinemanager:import_data'),
+                         {'bank': self.bank_cepac.pk, 'detect_bank': '1', 'csv_file': zip_upload})
+        self.assertEqual(ImportJob.objects.filter(status=ImportJob.STATUS_DONE).count(), 2)
+        self.assertEqual(BankLine.objects.get(transaction_number="zip1").bank, self.bank_smc)
+        self.assertEqual(BankLine.objects.get(transaction_number="zip2").bank, self.bank_cepac)
+
+    def ofx_upload(self, name, transactions):
+        """Return an uploaded OFX SGML file with the (date, fitid) transactions"""
+        return SimpleUploadedFile(name, "".join(
+            "<STMTTRN>\n<TRNTYPE>DEBIT\n<DTPOSTED>%s\n<TRNAMT>-4.40\n<FITID>%s\n<NAME>test\n</STMTTRN>\n"
+            % (transaction_date, fitid) for transaction_date, fitid in transactions).encode('latin-1'))
+
+    @override_settings(BANKLINE_IMPORT_WORKERS=0)
+    def test_import_data_upload_same_file(self):
+        """Test that a file uploaded again for the same bank is recognized by its hash and not parsed again"""
+        transactions = [("20180601", "led1"), ("20180615", "led2")]
+        for i in range(2):
+            self.client.post(reverse('banklinemanager:import_data'),
+                             {'bank': self.bank_smc.pk, 'csv_file': self.ofx_upload("juin.ofx", transactions)})
+        imported_file = ImportedFile.objects.get()
+        self.assertEqual((imported_file.date_start, imported_file.date_end, imported_file.line_counter,
+                          imported_file.inserted_line_counter), (datetime.date(2018, 6, 1), datetime.date(2018, 6, 15), 2, 2))
+        job = ImportJob.objects.order_by('pk').last()
+        self.assertEqual((job.status, job.line_counter), (ImportJob.STATUS_DONE, 0))
+        self.assertEqual(len(job.get_messages), 1)
+        self.assertIn("Ce fichier a déjà été importé", job.messages)
+
+    @override_settings(BANKLINE_IMPORT_WORKERS=0)
+    def test_import_data_upload_overlapping_file(self):
+        """Test that the lines of a file already imported by an earlier file are skipped, not its new lines"""
+        self.client.post(reverse('banklinemanager:import_data'), {'bank': self.bank_smc.pk, 'csv_file': self.ofx_upload(
+            "juin.ofx", [("20180601", "led1"), ("20180615", "led2"), ("20180630", "led3")])})
+        self.client.post(reverse('banklinemanager:import_data'), {'bank': self.bank_smc.pk, 'csv_file': self.ofx_upload(
+            "juin-juillet.ofx", [("20180615", "led2"), ("20180620", "led4"), ("20180630", "led3"), ("20180705", "led5")])})
+        job = ImportJob.objects.order_by('pk').last()
+        self.assertEqual((job.line_counter, job.inserted_line_counter), (4, 2))
+        self.assertEqual(job.get_messages[:2], ["-> 1 lignes déjà importées par les fichiers précédents ont été ignorées.",
+                                                "-> Il semble que cette ligne est déjà été importée = led3"])
+        self.assertEqual(BankLine.objects.filter(transaction_number__in=["led4", "led5"]).count(), 2)
+        self.assertEqual(ImportedFile.covered_spans(self.bank_smc), [("2018-06-01", "2018-07-05")])
+
+    @override_settings(BANKLINE_IMPORT_WORKERS=0)
+    def test_import_data_upload_file_with_errors(self):
+        """Test that a file with rejected lines is not recorded in the ledger, so it can be imported again once fixed"""
+        transactions = "".join("<STMTTRN>\n<TRNTYPE>DEBIT\n<DTPOSTED>20180601\n<TRNAMT>%s\n<FITID>%s\n<NAME>test\n</STMTTRN>\n"
+                               % (amount, fitid) for amount, fitid in (("-4.40", "err1"), ("-12345678.00", "err2")))
+        self.client.post(reverse('banklinemanager:import_data'), {'bank': self.bank_smc.pk, 'csv_file': SimpleUploadedFile(
+            "erreur.ofx", transactions.encode('latin-1'))})
+        self.assertEqual(ImportJob.objects.get().inserted_line_counter, 1)
+        self.assertFalse(ImportedFile.objects.exists())
+
+        self.client.post(reverse('banklinemanager:import_data'), {'bank': self.bank_smc.pk, 'csv_file': SimpleUploadedFile(
+            "erreur.ofx", transactions.replace("-12345678.00", "-12.00").encode('latin-1'))})
+        self.assertEqual(ImportJob.objects.order_by('pk').last().inserted_line_counter, 1)
+        self.assertEqual(ImportedFile.objects.get().line_counter, 2)
+
+    def test_imported_file_spans(self):
+        """Test that the spans of the imported files are merged only when they overlap by more than a day"""
+        for sha256, date_start, date_end in (("a", "2018-01-01", "2018-01-31"), ("b", "2018-01-31", "2018-02-28"),
+                                             ("c", "2018-02-10", "2018-03-05"), ("d", "2018-04-01", None)):
+            ImportedFile.objects.create(bank=self.bank_smc, file_name=sha256, sha256=sha256,
+                                        date_start=date_start, date_end=date_end or date_start)
+        self.assertEqual(ImportedFile.covered_spans(self.bank_smc), [("2018-01-01", "2018-01-31"),
+                                                                     ("2018-01-31", "2018-03-05"),
+                                                                     ("2018-04-01", "2018-04-01")])
+        for transaction_date, transaction_number in (("2017-12-31", "span0"), ("2018-01-15", "span1"),
+                                                     ("2018-01-31", "span2"), ("2018-02-01", "span3")):
+            BankLine.objects.create(transaction_date=transaction_date, wording="span", transaction_number=transaction_number,
+                                    debit=-1.0, credit=0.0, bank=self.bank_smc)
+        banklines = [BankLine(transaction_date=transaction_date, transaction_number=transaction_number)
+                     for transaction_date, transaction_number in (
+                         ("2017-12-31", "span0"), ("2018-01-15", "span1"), ("2018-01-16", "new1"), ("2018-01-31", "span2"),
+                         ("2018-02-01", "span3"), ("2018-03-05", "new2"))]
+        kept, skipped = ImportedFile.narrow_banklines(self.bank_smc, banklines)
+        self.assertEqual([bankline.transaction_number for bankline in kept], ["span0", "new1", "span2", "new2"])
+        self.assertEqual(skipped, 2)
+
+    def test_resolve_bank(self):
+        """Test that a datafile is mapped to its bank by <ACCTID> first, then by file name"""
+        self.assertEqual(resolve_bank("releve.ofx", b"<OFX><ACCTID>987654321</ACCTID>"), self.bank_smc)
+        self.assertEqual(resolve_bank("123456789_releve.ofx", b"<OFX><ACCTID>987654321"), self.bank_smc)
+        self.assertEqual(resolve_bank("archive/123456789_releve.csv", b"31/03/18;"), self.bank_cepac)
+        self.assertIsNone(resolve_bank("1234567890.csv", b"<ACCTID>FR76"))
+
+    def test_import_datafiles_command(self):
+        """Test the batch import command with files of two banks"""
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "987654321_juin.ofx"), 'w') as ofx_file:
+                ofx_file.write("<STMTTRN>\n<TRNTYPE>DEBIT\n<DTPOSTED>20180629\n<TRNAMT>-4.40\n<FITID>cmd1\n<NAME>test\n</STMTTRN>")
+            with zipfile.ZipFile(os.path.join(directory, "releves.zip"), 'w') as archive_file:
+                archive_file.writestr("123456789_mars.csv", "31/03/18;cmd2 -;vir test;504;;mon test vir;\n"
+                                                            "31/03/18;15526026 -;vir test;504;;mon test vir;\n")
+            output = io.StringIO()
+            call_command('import_datafiles', os.path.join(directory, "987654321_juin.ofx"),
+                         os.path.join(directory, "releves.zip"), workers=2, stdout=output)
+        self.assertIn("987654321_juin.ofx [smc test] : 1 lignes sur 1 ont été importés", output.getvalue())
+        self.assertIn("123456789_mars.csv [cepac test] : 1 lignes sur 2 ont été importés", output.getvalue())
+        self.assertIn("déjà été importée = 15526026", output.getvalue())
+        self.assertIn("Total : 3 lignes lues", output.getvalue())
+        self.assertEqual(BankLine.objects.get(transaction_number="cmd1").bank, self.bank_smc)
+
+    @mock.patch('banklinemanager.batch.MAX_PENDING_PER_WORKER', 1)
+    def test_import_datafiles_streamed(self):
+        """Test that the files of an archive are extracted one at a time and imported with a bounded queue"""
+        with tempfile.TemporaryDirectory() as directory:
+            archive_path = os.path.join(directory, "releves.zip")
+            with zipfile.ZipFile(archive_path, 'w') as archive_file:
+                for i in range(3):
+                    archive_file.writestr("987654321_%s.ofx" % (i), "<STMTTRN>\n<TRNTYPE>DEBIT\n<DTPOSTED>2018060%s\n"
+                                          "<TRNAMT>-4.40\n<FITID>stream%s\n<NAME>test\n</STMTTRN>" % (i + 1, i))
+            extract_directory = os.path.join(directory, "extract")
+            os.mkdir(extract_directory)
+            datafiles = iter_datafiles([archive_path], extract_directory)
+            name, path = next(datafiles)
+            self.assertEqual((name, os.listdir(extract_directory)), ("987654321_0.ofx", [os.path.basename(path)]))
+            datafiles.close()
+
+            results = list(import_datafiles([archive_path], workers=1))
+        self.assertEqual(sorted((result['name'], result['inserted_line_counter']) for result in results),
+                         [("987654321_%s.ofx" % (i), 1) for i in range(3)])
+        self.assertEqual(BankLine.objects.filter(transaction_number__startswith="stream", bank=self.bank_smc).count(), 3)
+
     def test_import_data_form_csv(self):
         """Test import data from csv string IO"""
         self.str_import_test = """31/03/18;3103201820180331-08.55.26.1 -;credit test;302;;mon test credit;
@@ -107,6 +327,224 @@ class ImportDataPageTestCase(PrepareDataTestCase):
         self.assertTrue(inserted_line_counter == 2)
         self.assertTrue(len(msg_insert_error) == 0)
 
+    def test_import_data_form_ofxxml(self):
+        """Test import data from ofx xml bytes"""
+        str_import_test = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+            <?OFX OFXHEADER="200" VERSION="220" SECURITY="NONE" OLDFILEUID="NONE" NEWFILEUID="NONE"?>
+            <OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKTRANLIST>
+            <DTSTART>20180601000000</DTSTART><DTEND>20180630235959</DTEND>
+            <STMTTRN><TRNTYPE>DEBIT</TRNTYPE><DTPOSTED>20180629000000.000[+1:CET]</DTPOSTED>
+            <TRNAMT>-4.40</TRNAMT><FITID>xml54f54ef5454</FITID><NAME>test né</NAME><MEMO>test memo</MEMO></STMTTRN>
+            <STMTTRN><TRNTYPE>CREDIT</TRNTYPE><DTPOSTED>20180630</DTPOSTED>
+            <TRNAMT>4.40</TRNAMT><FITID>541876454</FITID><NAME>test name2</NAME></STMTTRN>
+            </BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>"""
+        line_counter, inserted_line_counter, msg_insert_error = BankLine.insert_data_from_ofxxml(
+            self.bank_smc, io.BytesIO(str_import_test.encode('utf-8')))
+        self.assertEqual((line_counter, inserted_line_counter), (2, 1))
+        self.assertEqual(msg_insert_error, ["-> Il semble que cette ligne est déjà été importée = 541876454"])
+        bankline = BankLine.objects.get(transaction_number="xml54f54ef5454")
+        self.assertEqual((bankline.wording, bankline.bank_detail, str(bankline.transaction_date)),
+                         ("test né", "test memo", "2018-06-29"))
+
+    def test_import_data_duplicate_csv(self):
+        """Test that lines already in database or twice in the file are reported and not inserted"""
+        self.str_import_test = """31/03/18;15526026 -;credit test;;302;mon test credit;
+                    31/03/18;3103201820180331-08.55.26.1 -;vir test;504;;mon test vir;
+                    31/03/18;3103201820180331-08.55.26.1 -;vir test;504;;mon test vir;
+                    """
+        csv_file = csv.reader(io.StringIO(self.str_import_test), delimiter=';', quotechar='|')
+        line_counter, inserted_line_counter, msg_insert_error = BankLine.insert_data_from_csv_cepac(self.bank_cepac, csv_file)
+        self.assertEqual(line_counter, 3)
+        self.assertEqual(inserted_line_counter, 1)
+        self.assertEqual(len(msg_insert_error), 2)
+        self.assertIn("déjà été importée = 15526026", msg_insert_error[0])
+        self.assertEqual(BankLine.objects.filter(transaction_number="3103201820180331-08.55.26.1").count(), 1)
+
+    def test_bulk_insert_banklines_batches(self):
+        """Test that every batch is inserted and a rejected batch still inserts its valid lines"""
+        banklines = [BankLine(transaction_date="2018-04-%02d" % (i + 1), wording="batch %s" % i,
+                              transaction_number="batch%s" % i, debit=0, credit=i, bank=self.bank_smc)
+                     for i in range(7)]
+        banklines.append(BankLine(transaction_date="2018-04-01", wording="existing", transaction_number="541876454",
+                                  debit=-1, credit=0, bank=self.bank_smc))
+        msg_insert_error = []
+        inserted_line_counter = BankLine.bulk_insert_banklines(banklines, msg_insert_error, batch_size=3)
+        self.assertEqual(inserted_line_counter, 7)
+        self.assertEqual(msg_insert_error, ["-> Il semble que cette ligne est déjà été importée = 541876454"])
+        self.assertEqual(BankLine.objects.filter(bank=self.bank_smc).count(), 7)
+
+    def test_existing_transaction_numbers(self):
+        """Test that known transaction numbers are found with one query per chunk"""
+        with self.assertNumQueries(3):
+            existing = BankLine.existing_transaction_numbers(["15526026", "unknown", "541876454"], chunk_size=1)
+        self.assertEqual(existing, {"15526026", "541876454"})
+
+    def test_import_data_ofxsgml_reimport(self):
+        """Test that re-importing an ofx file skips every line already in database"""
+        str_import_test = """<STMTTRN>
+            <TRNTYPE>DEBIT
+            <DTPOSTED>20180629000000
+            <TRNAMT>-4.40
+            <FITID>541876454
+            <NAME>test name
+            </STMTTRN>
+            <STMTTRN>
+            <TRNTYPE>CREDIT
+            <DTPOSTED>20180629000000
+            <TRNAMT>4.40
+            <FITID>98rgrgr98rgr
+            <NAME>test name2
+            </STMTTRN>"""
+        line_counter, inserted_line_counter, msg_insert_error = BankLine.insert_data_from_ofxsgml(self.bank_smc, str_import_test)
+        self.assertEqual((line_counter, inserted_line_counter), (2, 1))
+        self.assertEqual(msg_insert_error, ["-> Il semble que cette ligne est déjà été importée = 541876454"])
+        line_counter, inserted_line_counter, msg_insert_error = BankLine.insert_data_from_ofxsgml(self.bank_smc, str_import_test)
+        self.assertEqual((line_counter, inserted_line_counter), (2, 0))
+        self.assertEqual(len(msg_insert_error), 2)
+
+
+class ParsersTestCase(TestCase):
+    """Class to test the datafile parsers"""
+    def test_iter_ofxsgml_transactions_chunks(self):
+        """Test that transactions are the same whatever the chunk size, with \\r\\n and missing memo"""
+        ofx_file = ("OFXHEADER:100\r\n<OFX>\r\n<STMTTRN>\r\n<TRNTYPE>DEBIT\r\n<DTPOSTED>20180629000000\r\n"
+                    "<TRNAMT>-4,40\r\n<FITID>54f54ef5454\r\n<NAME>test name</NAME>\r\n<MEMO>test memo\r\n</STMTTRN>\r\n"
+                    "<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20180630<TRNAMT>4.40<FITID>98rgrgr98rgr<NAME>test name2</STMTTRN>"
+                    "\r\n</OFX>")
+        expected = [
+            {'TRNTYPE': 'DEBIT', 'DTPOSTED': '20180629000000', 'TRNAMT': '-4,40', 'FITID': '54f54ef5454',
+             'NAME': 'test name', 'MEMO': 'test memo'},
+            {'TRNTYPE': 'CREDIT', 'DTPOSTED': '20180630', 'TRNAMT': '4.40', 'FITID': '98rgrgr98rgr',
+             'NAME': 'test name2'},
+        ]
+        for chunk_size in (1, 3, 10, 4096):
+            self.assertEqual(list(iter_ofxsgml_transactions(io.StringIO(ofx_file), chunk_size)), expected)
+
+
+    def test_detect_encoding(self):
+        """Test that the encoding of a datafile comes from its BOM or OFX header, latin-1 by default"""
+        self.assertEqual(detect_encoding(b"OFXHEADER:100\r\nENCODING:UTF-8\r\nCHARSET:NONE\r\n<OFX>"), 'utf-8')
+        self.assertEqual(detect_encoding(b"OFXHEADER:100\r\nENCODING:USASCII\r\nCHARSET:1252\r\n<OFX>"), 'cp1252')
+        self.assertEqual(detect_encoding(b"OFXHEADER:100\nCHARSET:ISO-8859-1\n<OFX>"), 'latin-1')
+        self.assertEqual(detect_encoding(b"<OFX><NAME>CHARSET:1252"), 'latin-1')
+        self.assertEqual(detect_encoding(b"\xef\xbb\xbf31/03/18;1 -;vir"), 'utf-8-sig')
+        self.assertEqual(detect_encoding(b"31/03/18;1 -;vir"), 'latin-1')
+
+    def test_iter_decoded_lines(self):
+        """Test that characters and lines split across chunks are decoded once"""
+        content = "31/03/18;1 -;vir été;;504;mon test\r\n01/04/18;2 -;cb café;-4,40;;détail\r\n".encode('utf-8')
+        chunks = [content[i:i + 3] for i in range(0, len(content), 3)]
+        self.assertEqual(list(iter_lines(iter_decoded(chunks, 'utf-8'))),
+                         ["31/03/18;1 -;vir été;;504;mon test\r\n", "01/04/18;2 -;cb café;-4,40;;détail\r\n"])
+
+    def test_parse_datafile_chunks(self):
+        """Test that an uploaded file is parsed from its chunks with the charset of its OFX header"""
+        bank = Bank(_datafile_format=Bank.FORMAT_OFX_SGML)
+        content = ("OFXHEADER:100\r\nDATA:OFXSGML\r\nENCODING:USASCII\r\nCHARSET:1252\r\n\r\n<OFX>\r\n<STMTTRN>\r\n"
+                   "<TRNTYPE>DEBIT\r\n<DTPOSTED>20180629\r\n<TRNAMT>-4.40\r\n<FITID>enc1\r\n<NAME>CB CAFÉ 5€\r\n"
+                   "</STMTTRN>\r\n</OFX>").encode('cp1252')
+        banklines, msgs = BankLine.parse_datafile(bank, SimpleUploadedFile("juin.ofx", content).chunks(7))
+        self.assertEqual([bankline.wording for bankline in banklines], ["CB CAFÉ 5€"])
+        banklines, msgs = BankLine.parse_datafile(
+            bank, [chunk.encode('utf-8') for chunk in ("ENCODING:UTF-8\n<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20180629"
+                                                         "<TRNAMT>1<FITID>enc2<NAME>vir reçu</STMTTRN>")])
+        self.assertEqual(banklines[0].wording, "vir reçu")
+
+    def test_iter_ofxxml_transactions_chunks(self):
+        """Test that ofx xml transactions are the same whatever the chunk size, with a namespace"""
+        ofx_file = ('<OFX xmlns="http://ofx.net/ifx/2.0/ofx"><BANKTRANLIST><STMTTRN><TRNTYPE>DEBIT</TRNTYPE>'
+                    '<TRNAMT>-4.40</TRNAMT><FITID>a1</FITID><NAME> name </NAME></STMTTRN>'
+                    '<STMTTRN><TRNTYPE>CREDIT</TRNTYPE><FITID>b2</FITID></STMTTRN></BANKTRANLIST></OFX>')
+        expected = [
+            {'TRNTYPE': 'DEBIT', 'TRNAMT': '-4.40', 'FITID': 'a1', 'NAME': 'name'},
+            {'TRNTYPE': 'CREDIT', 'FITID': 'b2'},
+        ]
+        for chunk_size in (1, 7, 4096):
+            self.assertEqual(list(iter_ofxxml_transactions(ofx_file, chunk_size)), expected)
+
+
+class ImportersTestCase(PrepareDataTestCase):
+    """Class to test the importers of the registry"""
+    def test_parse_qif(self):
+        """Test that the bank records of a QIF file are parsed with generated numbers, stable on a new import"""
+        bank = Bank.objects.create(name="qif test", _account_number="555", _datafile_format=Bank.FORMAT_QIF)
+        content = ("!Account\nNCompte courant\nTBank\n^\n!Type:Bank\nD03/04/2018\nT-1,234.56\nPLOYER AVRIL\n"
+                   "MLoyer  appartement\nN1234\n^\nD05/04'18\nU504,00\nPVIR SALAIRE\n^\nD05/04'18\nU504,00\n"
+                   "PVIR SALAIRE\n^\nD31/02/2018\nT10.00\nPERREUR\n^\n").encode('latin-1')
+        banklines, msgs = BankLine.parse_datafile(bank, io.BytesIO(content))
+        self.assertEqual([(bankline.transaction_date, bankline.wording, bankline.debit, bankline.credit,
+                           bankline.bank_detail) for bankline in banklines],
+                         [("2018-04-03", "LOYER AVRIL", "-1234.56", 0, "Loyer appartement N° 1234"),
+                          ("2018-04-05", "VIR SALAIRE", 0, "504.00", ""),
+                          ("2018-04-05", "VIR SALAIRE", 0, "504.00", "")])
+        self.assertEqual(len({bankline.transaction_number for bankline in banklines}), 3)
+        self.assertTrue(banklines[0].transaction_number.startswith("QIF-"))
+        self.assertEqual(msgs, ["-> La ligne suivante n'a pas été importée => D31/02/2018 T10.00 PERREUR"])
+        self.assertEqual([bankline.transaction_number for bankline in BankLine.parse_datafile(bank, content)[0]],
+                         [bankline.transaction_number for bankline in banklines])
+
+    def test_parse_camt053(self):
+        """Test that the booked entries of a CAMT.053 statement are parsed, with the name of the other party"""
+        bank = Bank.objects.create(name="camt test", _account_number="556", _datafile_format=Bank.FORMAT_CAMT053)
+        content = ('<?xml version="1.0" encoding="UTF-8"?><Document xmlns="urn:iso:std:iso:20022:tech:xsd:camt.053.001.02">'
+                   '<BkToCstmrStmt><Stmt><Ntry><Amt Ccy="EUR">42.50</Amt><CdtDbtInd>DBIT</CdtDbtInd><Sts>BOOK</Sts>'
+                   '<BookgDt><Dt>2018-06-29</Dt></BookgDt><ValDt><Dt>2018-06-30</Dt></ValDt><AcctSvcrRef>REF-1</AcctSvcrRef>'
+                   '<NtryDtls><TxDtls><Refs><EndToEndId>E2E-1</EndToEndId></Refs><RltdPties><Cdtr><Nm>Électricité SA</Nm>'
+                   '</Cdtr></RltdPties><RmtInf><Ustrd>Facture</Ustrd><Ustrd>juin 2018</Ustrd></RmtInf></TxDtls></NtryDtls></Ntry>'
+                   '<Ntry><Amt Ccy="EUR">1000</Amt><CdtDbtInd>CRDT</CdtDbtInd><Sts>BOOK</Sts><BookgDt><DtTm>2018-06-30T10:00:00'
+                   '</DtTm></BookgDt><NtryRef>REF-2</NtryRef><AddtlNtryInf>VIREMENT RECU</AddtlNtryInf></Ntry>'
+                   '<Ntry><Amt Ccy="EUR">5</Amt><CdtDbtInd>DBIT</CdtDbtInd><Sts>PDNG</Sts><AcctSvcrRef>REF-3</AcctSvcrRef></Ntry>'
+                   '</Stmt></BkToCstmrStmt></Document>').encode('utf-8')
+        banklines, msgs = BankLine.parse_datafile(bank, SimpleUploadedFile("releve.xml", content).chunks(16))
+        self.assertEqual([(bankline.transaction_date, bankline.transaction_number, bankline.wording, bankline.debit,
+                           bankline.credit, bankline.bank_detail) for bankline in banklines],
+                         [("2018-06-29", "REF-1", "Électricité SA", "-42.50", 0, "Facture juin 2018"),
+                          ("2018-06-30", "REF-2", "VIREMENT RECU", 0, "1000", "")])
+        self.assertEqual(msgs, [])
+
+    def test_parse_configurable_csv(self):
+        """Test that a CSV file is parsed with the columns, delimiter and formats of its bank"""
+        bank = Bank.objects.create(name="csv test", _account_number="557", _datafile_format=Bank.FORMAT_CSV_CONFIGURABLE)
+        with self.assertRaises(ValueError):
+            BankLine.parse_datafile(bank, b"")
+        csv_format = BankCsvFormat(bank=bank, columns="date,wording,,amount,number", delimiter=",",
+                                   date_format="%Y-%m-%d", decimal_separator=".", encoding="utf-8")
+        csv_format.full_clean()
+        csv_format.save()
+        with self.assertRaises(ValidationError):
+            BankCsvFormat(bank=bank, columns="date,libelle,amount").full_clean()
+        content = ("Date,Libellé,Catégorie,Montant,Référence\n2018-07-01,\"Café, croissant\",Repas,-3.20,R1\n"
+                   "2018-07-02,VIR  REÇU,,\"1,250.00\",\n2018-07-03,TROP CHER,,-1000000.00,R3\n").encode('utf-8')
+        banklines, msgs = BankLine.parse_datafile(Bank.objects.get(pk=bank.pk), io.BytesIO(content))
+        self.assertEqual([(bankline.transaction_date, bankline.wording, bankline.debit, bankline.credit)
+                          for bankline in banklines],
+                         [("2018-07-01", "Café, croissant", "-3.20", 0), ("2018-07-02", "VIR REÇU", 0, "1250.00")])
+        self.assertEqual(banklines[0].transaction_number, "R1")
+        self.assertTrue(banklines[1].transaction_number.startswith("CSVC-"))
+        self.assertEqual(msgs, ["-> La ligne suivante n'a pas été importée => 2018-07-03,TROP CHER,,-1000000.00,R3"])
+
+    @override_settings(BANKLINE_VALIDATION_WORKERS=2)
+    @mock.patch('banklinemanager.importers.VALIDATION_BATCH_SIZE', 2)
+    def test_parse_validation_pool(self):
+        """Test that the batches validated by the process pool keep the order of the lines and errors"""
+        transactions = list(synthetic_transactions(7, "POOL"))
+        transactions[3]['amount'] = -12345678.0
+        content = to_ofxsgml(transactions)
+        banklines, msgs = BankLine.parse_ofxsgml(self.bank_smc, content)
+        self.assertEqual(importers._executor._mp_context.get_start_method(), 'spawn')
+        self.assertEqual([bankline.transaction_number for bankline in banklines],
+                         [transaction['fitid'] for index, transaction in enumerate(transactions) if index != 3])
+        self.assertEqual(len(msgs), 1)
+        self.assertIn("<TRNAMT>-12345678.00", msgs[0])
+        self.assertEqual(banklines[0].bank, self.bank_smc)
+
+    def test_registry(self):
+        """Test that each datafile format has its importer and an unknown format is refused"""
+        self.assertEqual(set(importers.IMPORTERS), {choice for choice, label in Bank.FORMAT_DATAFILE_ACCEPTED})
+        self.assertIsInstance(importers.get_importer(self.bank_cepac), importers.CepacCsvImporter)
+        with self.assertRaises(ValueError):
+            importers.get_importer(Bank(_datafile_format="PDF"))
+
 
 class SearchPageTestCase(PrepareDataTestCase):
     """Class to test Search Data page"""
@@ -170,3 +608,697 @@ class SearchPageTestCase(PrepareDataTestCase):
         bankline_list = response.context['bankline_list']
         self.assertTrue(len(bankline_list) == 1)
         self.assertContains(response, 'test128 credit')
+
+    def test_search_export_csv(self):
+        """Test that the CSV export streams the search results in the CEPAC layout, readable by the import"""
+        response = self.client.get(reverse('banklinemanager:export'), {'query': "test", 'type_search': "contains",
+                                                                        'bank': self.bank_cepac.pk, 'format': "csv"})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertIn('attachment; filename="export_', response['Content-Disposition'])
+        content = b"".join(response.streaming_content).decode('latin-1')
+        self.assertEqual(content, "01/03/18;15526026 -;test128 credit;;100,00;detail de la banque\r\n"
+                                  "04/03/18;541876454 -;test debit;-200,00;;detail de la banque\r\n")
+        banklines, msg_parse_error = BankLine.parse_csv_cepac(
+            self.bank_cepac, csv.reader(io.StringIO(content), delimiter=';', quotechar='|'))
+        self.assertEqual([(bankline.transaction_number, bankline.debit) for bankline in banklines],
+                         [("15526026", 0), ("541876454", "-200.00")])
+
+    def test_search_export_csv_round_trip(self):
+        """Test that a line exported to CSV with ";", '"' and "|" in its texts is imported again with the same texts"""
+        BankLine.objects.create(transaction_date="2018-03-05", wording='CB "Chez Paul"; Lyon', transaction_number="rt1",
+                                debit=-5.0, credit=0.0, bank_detail="carte | 1234;", bank=self.bank_cepac)
+        response = self.client.get(reverse('banklinemanager:export'), {'query': "paul", 'format': "csv"})
+        content = b"".join(response.streaming_content)
+        self.assertEqual(content, b'05/03/18;rt1 -;|CB "Chez Paul"; Lyon|;-5,00;;|carte || 1234;|\r\n')
+        banklines, msg_parse_error = BankLine.parse_datafile(self.bank_cepac, io.BytesIO(content))
+        self.assertEqual([(bankline.transaction_number, bankline.wording, bankline.bank_detail, bankline.debit)
+                          for bankline in banklines],
+                         [("rt1", 'CB "Chez Paul"; Lyon', "carte | 1234;", "-5.00")])
+
+    def test_search_export_ofx(self):
+        """Test that the OFX export of a filtered search can be parsed again"""
+        response = self.client.get(reverse('banklinemanager:export'), {'sum_min': "-300", 'sum_max': "-100", 'format': "ofx"})
+        self.assertEqual(response['Content-Type'], "application/x-ofx")
+        banklines, msg_parse_error = BankLine.parse_ofxsgml(
+            self.bank_smc, io.StringIO(b"".join(response.streaming_content).decode('cp1252')))
+        self.assertEqual(len(banklines), 1)
+        self.assertEqual((banklines[0].transaction_number, banklines[0].wording, banklines[0].debit), ("541876454", "test debit", "-200.00"))
+        self.assertEqual(self.client.get(reverse('banklinemanager:export'), {'format': "pdf"}).status_code, 404)
+
+    def test_search_export_ofx_round_trip(self):
+        """Test that a line exported to OFX with "€" and "&<>" is imported again with the same texts"""
+        BankLine.objects.create(transaction_date="2018-03-05", wording="CB Café & <Thé> 5€", transaction_number="rt&1",
+                                debit=-5.0, credit=0.0, bank_detail="R&D > 2€", bank=self.bank_cepac)
+        response = self.client.get(reverse('banklinemanager:export'), {'query': "the", 'format': "ofx"})
+        content = b"".join(response.streaming_content)
+        self.assertIn("5€".encode('cp1252'), content)
+        self.assertIn(b"Caf\xe9 &amp; &lt;Th\xe9&gt;", content)
+        banklines, msg_parse_error = BankLine.parse_datafile(self.bank_smc, io.BytesIO(content))
+        self.assertEqual([(bankline.transaction_number, bankline.wording, bankline.bank_detail) for bankline in banklines],
+                         [("rt&1", "CB Café & <Thé> 5€", "R&D > 2€")])
+
+    @mock.patch('banklinemanager.views.SEARCH_PAGE_SIZE', 1)
+    def test_search_get_pages(self):
+        """Test that a GET search is paginated by cursor, keeps its filters in the pager and streams its rows"""
+        response = self.client.get(reverse('banklinemanager:search'), {'query': self.query, 'type_search': self.type_search})
+        self.assertTrue(response.streaming)
+        self.assertEqual([bankline.transaction_number for bankline in response.context['bankline_list']], ["541876454"])
+        next_cursor = response.context['bankline_list'].next_cursor
+        content = b"".join(response.streaming_content).decode()
+        self.assertIn("?query=test&amp;type_search=contains&amp;after=%s" % (next_cursor), content)
+        self.assertIn("<td>541876454</td>", content)
+        self.assertNotIn("15526026", content)
+
+        response = self.client.get(reverse('banklinemanager:search'), {'query': self.query, 'after': next_cursor})
+        self.assertEqual([bankline.transaction_number for bankline in response.context['bankline_list']], ["15526026"])
+        self.assertFalse(response.context['bankline_list'].has_next)
+        self.assertEqual(response.context['total_debit'], -200)
+
+    def test_search_result_cached(self):
+        """Test that a repeated search is read from the cache, until a line of its bank and dates is imported"""
+        search = {'query': "Test", 'type_search': "contains", 'date_start': "2018-03-01", 'date_end': "2018-03-31"}
+        response = self.client.post(reverse('banklinemanager:search'), search)
+        self.assertEqual(len(response.context['bankline_list']), 2)
+        with self.assertNumQueries(5):
+            # session, user, user and group permissions, banks: no search query
+            response = self.client.post(reverse('banklinemanager:search'), dict(search, query="TEST"))
+        self.assertEqual(len(response.context['bankline_list']), 2)
+
+        # a line out of the date range does not invalidate the search, a line in it does
+        BankLine.objects.create(transaction_date="2018-04-02", wording="test avril", transaction_number="cache1",
+                                debit=0.0, credit=10.0, bank=self.bank_smc)
+        run_commit_callbacks()
+        self.assertEqual(len(self.client.post(reverse('banklinemanager:search'), search).context['bankline_list']), 2)
+        BankLine.bulk_insert_banklines([BankLine(transaction_date="2018-03-02", wording="test mars", transaction_number="cache2",
+                                                 debit=0, credit=10, bank=self.bank_smc)], [])
+        run_commit_callbacks()
+        self.assertEqual(len(self.client.post(reverse('banklinemanager:search'), search).context['bankline_list']), 3)
+
+    def test_search_cache_invalidate(self):
+        """Test that only the cached searches of the bank and dates of the changed lines are deleted"""
+        cepac_march = search_cache.normalize_filters("test", "contains", "2018-03-01", "2018-03-31", None, None, self.bank_cepac.pk)
+        smc = search_cache.normalize_filters("test", "contains", None, None, None, None, self.bank_smc.pk)
+        all_banks_april = search_cache.normalize_filters("test", "contains", "2018-04-01", "2018-04-30", None, None, None)
+        for filters in (cepac_march, smc, all_banks_april):
+            search_cache.get_or_compute(filters, lambda: "cached")
+
+        bankline = BankLine.objects.get(transaction_number="15526026")
+        bankline.user_comment = "commentaire"
+        bankline.save()
+        # not before the commit: a search run meanwhile would cache the old lines under the new generation
+        self.assertEqual(search_cache.get_cache().get(search_cache.cache_key(cepac_march)), "cached")
+        run_commit_callbacks()
+        cached = [search_cache.get_cache().get(search_cache.cache_key(filters)) for filters in (cepac_march, smc, all_banks_april)]
+        self.assertEqual(cached, [None, "cached", "cached"])
+
+    def test_search_cache_concurrent_registry(self):
+        """Test that concurrent searches all register their entry, and a search waiting too long for the lock is not cached"""
+        filters = [search_cache.normalize_filters("test%s" % (i), "contains", None, None, None, None, None) for i in range(8)]
+
+        def compute():
+            time.sleep(0.01)
+            return "cached"
+        threads = [threading.Thread(target=search_cache.get_or_compute, args=(f, compute)) for f in filters]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        registry_keys = {entry[0] for entry in search_cache.get_cache().get(search_cache.REGISTRY_KEY)}
+        self.assertEqual(registry_keys, {search_cache.cache_key(f) for f in filters})
+
+        locked = search_cache.normalize_filters("locked", "contains", None, None, None, None, None)
+        search_cache.get_cache().add(search_cache.LOCK_KEY, "other", 10)
+        with mock.patch('banklinemanager.search_cache.LOCK_WAIT', 0.05):
+            self.assertEqual(search_cache.get_or_compute(locked, lambda: "computed"), "computed")
+        self.assertIsNone(search_cache.get_cache().get(search_cache.cache_key(locked)))
+
+    def test_search_cache_file_lock(self):
+        """Test that the registry lock of a FileBasedCache is a file taken by one holder at a time, or once expired"""
+        with tempfile.TemporaryDirectory() as directory:
+            cache = FileBasedCache(directory, {})
+            with search_cache.registry_lock(cache):
+                with self.assertRaises(search_cache.RegistryLocked):
+                    with search_cache.registry_lock(cache, wait=0.05):
+                        pass
+            self.assertFalse(os.path.exists(os.path.join(directory, search_cache.LOCK_FILENAME)))
+
+            with open(os.path.join(directory, search_cache.LOCK_FILENAME), 'w') as lock_file:
+                lock_file.write("dead holder")
+            expired = time.time() - search_cache.LOCK_TIMEOUT - 1
+            os.utime(lock_file.name, (expired, expired))
+            with search_cache.registry_lock(cache, wait=1):
+                cache.clear()
+                self.assertTrue(os.path.exists(lock_file.name))
+
+    def test_search_totals(self):
+        """Test that totals of the search are computed overall and per bank"""
+        BankLine.objects.create(transaction_date="2018-03-05", wording="test smc", transaction_number="smc1",
+                                debit=-50.0, credit=0.0, bank=self.bank_smc)
+        bankline_list, msg_search = BankLine.search_bankline(self.query, self.type_search, None, None, None, None, None)
+        with self.assertNumQueries(1):
+            totals = BankLine.search_totals(bankline_list)
+        self.assertEqual((totals['count'], totals['total_debit'], totals['total_credit']), (3, -250, 100))
+        self.assertEqual([(bank['bank__name'], bank['count'], bank['total_debit']) for bank in totals['banks']],
+                         [("cepac test", 2, -200), ("smc test", 1, -50)])
+
+    def test_search_result_totals(self):
+        """test search form totals in context"""
+        response = self.client.post(reverse('banklinemanager:search'), {'query': self.query})
+        self.assertEqual(response.context['total_credit'], 100)
+        self.assertEqual(response.context['total_debit'], -200)
+        self.assertEqual(len(response.context['bankline_list']), 2)
+
+    def test_keywords_filter_fulltext(self):
+        """Test that the full-text index gives the same lines as LIKE lookups, after a user_comment edit too"""
+        if not fulltext_available():
+            self.skipTest("No FTS5 full-text index in this database")
+        bankline = BankLine.objects.get(transaction_number="541876454")
+        bankline.user_comment = "Loyer Mars"
+        bankline.save()
+        for keywords, type_search in ((["test"], "contains"), (["128", "oyer"], "contains"), (["DETAIL"], "startswith"),
+                                      (["loyer", "de"], "startswith"), (["credit"], "startswith")):
+            like_lines = BankLine.objects.filter(BankLine.keywords_filter(keywords, type_search, fulltext=False))
+            fulltext_lines = BankLine.objects.filter(BankLine.keywords_filter(keywords, type_search, fulltext=True))
+            self.assertEqual(set(fulltext_lines), set(like_lines), (keywords, type_search))
+        self.assertEqual(BankLine.objects.filter(BankLine.keywords_filter(["oyer"], "contains", fulltext=True)).count(), 1)
+
+    def test_keywords_filter_normalized(self):
+        """Test that keywords match whatever the accents, case and repeated spaces, with and without the index"""
+        BankLine.objects.create(transaction_date="2018-03-05", wording="CB  Café   ÉLYSÉE", transaction_number="norm1",
+                                debit=-3.5, credit=0.0, bank_detail="Pharmacie", bank=self.bank_smc)
+        self.assertEqual(BankLine.objects.get(transaction_number="norm1").search_text, "cb cafe elysee\npharmacie\n")
+        for fulltext in (False, True) if fulltext_available() else (False,):
+            for keywords, type_search in ((["cafe ely"], "contains"), (["ÉlYsée"], "contains"), (["pharma"], "startswith"),
+                                          (["cb café"], "startswith"), (["elysée"], "fuzzy"), (["eylsee"], "fuzzy"),
+                                          (["pharmaice"], "fuzzy"), (["café elsee"], "fuzzy")):
+                banklines = BankLine.objects.filter(BankLine.keywords_filter(keywords, type_search, fulltext))
+                self.assertEqual([bankline.transaction_number for bankline in banklines], ["norm1"], (keywords, fulltext))
+            self.assertFalse(BankLine.objects.filter(BankLine.keywords_filter(["elysee"], "startswith", fulltext)).exists())
+            self.assertFalse(BankLine.objects.filter(BankLine.keywords_filter(["eylsee"], "contains", fulltext)).exists())
+            self.assertFalse(BankLine.objects.filter(BankLine.keywords_filter(["pharmaxxe"], "fuzzy", fulltext)).exists())
+
+    def test_search_amount_debit(self):
+        """test search on a negative amount range finds debits only"""
+        bankline_list, msg_search = BankLine.search_bankline(None, None, None, None, "-300", "-100", None)
+        self.assertEqual([bankline.transaction_number for bankline in bankline_list], ["541876454"])
+
+
+class SummaryTestCase(PrepareDataTestCase):
+    """Class to test the monthly summaries and the Summary page"""
+    def summary_values(self):
+        return list(BankMonthSummary.objects.values_list('bank__name', 'month', 'line_count', 'total_debit', 'total_credit'))
+
+    def test_summary_updated_by_imports(self):
+        """Test that saved and bulk inserted lines are added to their month, and duplicates are not"""
+        banklines, msg_parse_error = BankLine.parse_csv_cepac(self.bank_cepac, [
+            ["31/03/18", "15526026 -", "vir test", "", "504", ""],
+            ["02/04/18", "sum1 -", "vir test", "-10,50", "", ""],
+            ["05/04/18", "sum2 -", "vir test", "", "20", ""]])
+        BankLine.bulk_insert_banklines(banklines, msg_parse_error)
+        self.assertEqual(self.summary_values(), [
+            ("cepac test", datetime.date(2018, 3, 1), 2, Decimal("-200"), Decimal("100")),
+            ("cepac test", datetime.date(2018, 4, 1), 2, Decimal("-10.5"), Decimal("20"))])
+
+        BankMonthSummary.objects.update(line_count=0)
+        call_command('rebuild_summaries', stdout=io.StringIO())
+        self.assertEqual(self.summary_values(), [
+            ("cepac test", datetime.date(2018, 3, 1), 2, Decimal("-200"), Decimal("100")),
+            ("cepac test", datetime.date(2018, 4, 1), 2, Decimal("-10.5"), Decimal("20"))])
+
+    def test_summary_written_once_per_import(self):
+        """Test that the summaries of all the batches of an import are written once per bank and month"""
+        banklines = [BankLine(transaction_date="2018-0%s-%02d" % (month, day), wording="lot", transaction_number="lot%s%s" % (month, day),
+                              debit=-1.0, credit=0.0, bank=self.bank_smc) for month in (5, 6) for day in range(1, 11)]
+        with mock.patch.object(BankMonthSummary, 'add_totals', wraps=BankMonthSummary.add_totals) as add_totals:
+            self.assertEqual(BankLine.bulk_insert_banklines(banklines, [], batch_size=3), 20)
+        add_totals.assert_called_once()
+        self.assertEqual(self.summary_values()[1:], [
+            ("smc test", datetime.date(2018, 5, 1), 10, Decimal("-10"), Decimal("0")),
+            ("smc test", datetime.date(2018, 6, 1), 10, Decimal("-10"), Decimal("0"))])
+
+    def test_summary_updated_by_deletions(self):
+        """Test that deleting a line or a queryset of lines rebuilds the summaries of their months"""
+        BankLine.objects.create(transaction_date="2018-04-02", wording="test", transaction_number="del1",
+                                debit=-10.0, credit=0.0, bank=self.bank_cepac)
+        BankLine.objects.get(transaction_number="541876454").delete()
+        self.assertEqual(self.summary_values(), [
+            ("cepac test", datetime.date(2018, 3, 1), 1, Decimal("0"), Decimal("100")),
+            ("cepac test", datetime.date(2018, 4, 1), 1, Decimal("-10"), Decimal("0"))])
+        BankLine.objects.filter(transaction_number__in=["15526026", "del1"]).delete()
+        self.assertEqual(self.summary_values(), [])
+
+    def test_summary_page(self):
+        """Test the monthly and yearly summaries with their running balance, without reading BankLine"""
+        BankLine.objects.create(transaction_date="2019-01-10", wording="test", transaction_number="sum3",
+                                debit=-50.0, credit=0.0, bank=self.bank_cepac)
+        with self.assertNumQueries(6):
+            # session, user, user and group permissions, summaries, banks
+            response = self.client.get(reverse('banklinemanager:summary'), {'year': "2019"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['years'], [2018, 2019])
+        self.assertEqual([(summary.balance, summary.running_balance) for summary in response.context['month_summaries']],
+                         [(Decimal("-50"), Decimal("-150"))])
+        self.assertEqual([(year['year'], year['line_count']) for year in response.context['year_summaries']], [(2019, 1)])
+
+
+class CategorizationTestCase(PrepareDataTestCase):
+    """Class to test the categorization of the banklines by the category rules"""
+    def setUp(self):
+        super(CategorizationTestCase, self).setUp()
+        self.groceries = Category.objects.create(name="Courses")
+        self.rent = Category.objects.create(name="Loyer")
+        self.incomes = Category.objects.create(name="Revenus")
+        CategoryRule.objects.create(category=self.groceries, pattern="Carrefour", priority=10)
+        CategoryRule.objects.create(category=self.groceries, rule_type=CategoryRule.RULE_REGEX, pattern=r"\bcb\s+lidl")
+        CategoryRule.objects.create(category=self.rent, pattern="vir loyer", amount_max=-500, priority=10)
+        CategoryRule.objects.create(category=self.incomes, amount_min=1000, priority=200)
+
+    def bankline(self, wording, amount):
+        bankline = BankLine(wording=wording, debit=min(amount, 0), credit=max(amount, 0))
+        bankline.compute_amount()
+        bankline.compute_search_text()
+        return bankline
+
+    def test_categorizer(self):
+        """Test the category found by the combined matcher for keyword, regex and amount rules"""
+        categorizer = Categorizer(CategoryRule.objects.all())
+        self.assertEqual(categorizer.categorize(self.bankline("CB CARREFOUR MARKET", -20)), self.groceries.pk)
+        self.assertEqual(categorizer.categorize(self.bankline("CB  Lidl 1234", -20)), self.groceries.pk)
+        self.assertEqual(categorizer.categorize(self.bankline("Vir Loyer Mars", -650)), self.rent.pk)
+        self.assertEqual(categorizer.categorize(self.bankline("Vir Loyer Mars", -100)), None)
+        self.assertEqual(categorizer.categorize(self.bankline("VIR SALAIRE", 2000)), self.incomes.pk)
+        self.assertEqual(categorizer.categorize(self.bankline("PRLV EDF", -50)), None)
+
+    def test_keyword_automaton(self):
+        """Test that the automaton finds every keyword in one pass, overlapping ones included"""
+        automaton = KeywordAutomaton(["he", "she", "his", "hers", "cb carrefour", "carrefour market"])
+        self.assertEqual(automaton.search("ushers"), {0, 1, 3})
+        self.assertEqual(automaton.search("cb carrefour market"), {4, 5})
+        self.assertEqual(automaton.search("carrefou"), set())
+
+    def test_categorizer_hidden_rule(self):
+        """Test that a rule matching at the same place as a prior rule out of its amount range is still found"""
+        CategoryRule.objects.create(category=self.groceries, pattern="vir", priority=300)
+        categorizer = Categorizer(CategoryRule.objects.all())
+        self.assertEqual(categorizer.categorize(self.bankline("VIR LOYER", -100)), self.groceries.pk)
+
+    def test_categorizer_separate_regexes(self):
+        """Test that regexes which can't be combined are tried on their own and an invalid one never fails an import"""
+        rent_rule = CategoryRule.objects.create(category=self.rent, rule_type=CategoryRule.RULE_REGEX,
+                                                pattern="(?i)loyer", priority=1)
+        rent_rule.full_clean()
+        CategoryRule.objects.create(category=self.rent, rule_type=CategoryRule.RULE_REGEX, pattern="(?P<edf>prlv) edf")
+        CategoryRule.objects.create(category=self.groceries, rule_type=CategoryRule.RULE_REGEX,
+                                    pattern="(?P<edf>cb) market")
+        CategoryRule.objects.create(category=self.incomes, rule_type=CategoryRule.RULE_REGEX, pattern=r"(\w)\1\w",
+                                    priority=5)
+        CategoryRule.objects.create(category=self.incomes, rule_type=CategoryRule.RULE_REGEX, pattern="[", priority=0)
+        categorizer = Categorizer(CategoryRule.objects.all())
+        self.assertEqual(categorizer.categorize(self.bankline("Vir Loyer Mars", -100)), self.rent.pk)
+        self.assertEqual(categorizer.categorize(self.bankline("PRLV EDF", -50)), self.rent.pk)
+        self.assertEqual(categorizer.categorize(self.bankline("CB MARKET", -5)), self.groceries.pk)
+        self.assertEqual(categorizer.categorize(self.bankline("VIR AAB", 10)), self.incomes.pk)
+
+        banklines, msg_parse_error = BankLine.parse_csv_cepac(self.bank_cepac, [
+            ["05/04/18", "cat3 -", "VIR LOYER AVRIL", "-700", "", ""]])
+        BankLine.bulk_insert_banklines(banklines, msg_parse_error)
+        self.assertEqual(BankLine.objects.get(transaction_number="cat3").category, self.rent)
+
+    def test_categorize_import_and_command(self):
+        """Test that imported lines are categorized, and the command categorizes the existing ones by chunks"""
+        banklines, msg_parse_error = BankLine.parse_csv_cepac(self.bank_cepac, [
+            ["02/04/18", "cat1 -", "CB CARREFOUR", "-10,50", "", ""],
+            ["05/04/18", "cat2 -", "VIR LOYER AVRIL", "-700", "", ""]])
+        BankLine.bulk_insert_banklines(banklines, msg_parse_error)
+        self.assertEqual(BankLine.objects.get(transaction_number="cat1").category, self.groceries)
+        self.assertEqual(BankLine.objects.get(transaction_number="cat2").category, self.rent)
+
+        CategoryRule.objects.create(category=self.rent, pattern="test debit")
+        output = io.StringIO()
+        call_command('recategorize', chunk_size=1, stdout=output)
+        self.assertIn("4 lignes lues, 1 catégories modifiées", output.getvalue())
+        self.assertEqual(BankLine.objects.get(transaction_number="541876454").category, self.rent)
+
+
+class ReconciliationTestCase(PrepareDataTestCase):
+    """Class to test the reconciliation of bank lines"""
+    def line(self, line_id, transaction_date, amount, wording):
+        return ReconciliationLine(line_id, datetime.date(*transaction_date), Decimal(amount), wording, str(line_id))
+
+    def test_reconcile(self):
+        """Test matched, ambiguous and unmatched lines, by amount, date window and wording similarity"""
+        left = [self.line(1, (2018, 3, 1), "-20.00", "cb carrefour 28/02"),
+                self.line(2, (2018, 3, 1), "-20.00", "prlv edf"),
+                self.line(3, (2018, 3, 5), "-4.50", "cb boulangerie"),
+                self.line(4, (2018, 3, 5), "-4.50", "cb boulangerie"),
+                self.line(5, (2018, 3, 9), "100.00", "vir recu")]
+        right = [self.line(11, (2018, 3, 3), "-20.00", "prlv edf clients"),
+                 self.line(12, (2018, 3, 2), "-20.00", "carte carrefour"),
+                 self.line(13, (2018, 3, 6), "-4.50", "cb boulangerie"),
+                 self.line(14, (2018, 3, 20), "100.00", "vir recu")]
+        report = reconcile(left, right)
+        self.assertEqual(sorted((line.id, candidate.id) for line, candidate, score in report.matched), [(1, 12), (2, 11)])
+        self.assertEqual([(line.id, [candidate.id for candidate in candidates]) for line, candidates in report.ambiguous],
+                         [(3, [13]), (4, [13])])
+        self.assertEqual(([line.id for line in report.unmatched_left], [line.id for line in report.unmatched_right]), ([5], [14]))
+        self.assertEqual(len(reconcile(left, right, date_window=15).matched), 3)
+        self.assertEqual(len(reconcile(left, right, min_similarity=0.5).matched), 1)
+
+    def test_reconcile_command(self):
+        """Test the duplicates of an account, and a datafile against the imported lines"""
+        BankLine.objects.create(transaction_date="2018-03-02", wording="test credit", transaction_number="REC-15526026",
+                                debit=0.0, credit=100.0, bank=self.bank_cepac)
+        output = io.StringIO()
+        call_command('reconcile', bank=123456789, stdout=output)
+        self.assertIn("1 rapprochées, 0 ambiguës, 1 sans correspondance", output.getvalue())
+
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "juin.ofx"), 'w') as ofx_file:
+                ofx_file.write("<STMTTRN>\n<TRNTYPE>DEBIT\n<DTPOSTED>20180305\n<TRNAMT>-200.00\n<FITID>rec1\n"
+                               "<NAME>TEST DEBIT\n</STMTTRN>")
+            call_command('reconcile', bank=123456789, file=os.path.join(directory, "juin.ofx"), format=Bank.FORMAT_OFX_SGML,
+                         report=os.path.join(directory, "report.csv"), stdout=output)
+            with open(os.path.join(directory, "report.csv")) as report_file:
+                rows = list(csv.reader(report_file, delimiter=';'))
+        self.assertEqual(rows[1][:2] + rows[1][5:7], ["rapprochee", "rec1", "541876454", "2018-03-04"])
+        self.assertEqual(len(rows), 4)
+
+
+class BenchmarkTestCase(PrepareDataTestCase):
+    """Class to test the synthetic datafiles and the benchmark command"""
+    def test_synthetic_datafiles(self):
+        """Test that the synthetic datafiles are the same for a seed and are parsed in each format"""
+        transactions = list(synthetic_transactions(30, prefix="SYN", seed=1))
+        self.assertEqual(transactions, list(synthetic_transactions(30, prefix="SYN", seed=1)))
+        for banklines, msgs in (BankLine.parse_ofxsgml(self.bank_cepac, to_ofxsgml(transactions)),
+                                BankLine.parse_ofxxml(self.bank_cepac, to_ofxxml(transactions)),
+                                BankLine.parse_csv_cepac(self.bank_cepac, csv.reader(
+                                    io.StringIO(to_csv_cepac(transactions)), delimiter=';', quotechar='|'))):
+            self.assertEqual((len(banklines), msgs), (30, []))
+            for bankline in banklines:
+                bankline.compute_amount()
+            self.assertEqual([(bankline.transaction_number, bankline.amount, " ".join(bankline.wording.split()))
+                              for bankline in banklines],
+                             [(transaction['fitid'], Decimal("%.2f" % transaction['amount']), " ".join(transaction['name'].split()))
+                              for transaction in transactions])
+
+    def test_benchmark_command(self):
+        """Test the JSON results, rolled back lines and regressions flagged against a baseline, with a benchmark user already there"""
+        User.objects.create_superuser("benchmark", "benchmark@example.com", None)
+        with tempfile.TemporaryDirectory() as directory:
+            baseline_path = os.path.join(directory, "baseline.json")
+            with open(baseline_path, 'w') as baseline_file:
+                json.dump({'results': {'40': {'search_contains': {'seconds': 1e-9}, 'export_csv': {'seconds': 1000}}}},
+                          baseline_file)
+            output = io.StringIO()
+            call_command('benchmark', sizes=[40], repeat=1, output=os.path.join(directory, "results.json"),
+                         baseline=baseline_path, min_seconds=0, test_database=False, stdout=output)
+            with open(os.path.join(directory, "results.json")) as results_file:
+                results = json.load(results_file)
+        self.assertEqual(results['results']['40']['import_ofxxml']['lines'], 40)
+        self.assertIn('view_search', results['results']['40'])
+        self.assertEqual(results['regressions'], ["40/search_contains"])
+        self.assertIn("REGRESSION", output.getvalue())
+        self.assertFalse(Bank.objects.filter(name__startswith="BENCH").exists())
+
+
+class InstrumentationTestCase(PrepareDataTestCase):
+    """Class to test the request and import instrumentation"""
+    def setUp(self):
+        super().setUp()
+        get_stats().clear()
+
+    def test_request_stats(self):
+        """Test the queries, SQL and render times recorded per view, streamed pages included"""
+        self.client.get(reverse('banklinemanager:index'))
+        response = self.client.get(reverse('banklinemanager:search'), {'query': "test"})
+        self.assertEqual(get_stats().as_dict()['views'].keys(), {'banklinemanager:index'})
+        b"".join(response.streaming_content)
+        stats = get_stats().as_dict()
+        self.assertEqual(stats['views'].keys(), {'banklinemanager:index', 'banklinemanager:search'})
+        record = stats['requests'][-1]
+        self.assertEqual((record['view'], record['status']), ('banklinemanager:search', 200))
+        self.assertGreater(record['queries'], 0)
+        self.assertGreater(record['render_ms'], 0)
+        self.assertEqual(stats['slow_requests'], [])
+
+    @override_settings(BANKLINE_SLOW_REQUEST_MS=0)
+    def test_slow_request(self):
+        """Test that a slow request is logged as a warning with its slowest queries"""
+        with self.assertLogs('banklinemanager.instrumentation', 'WARNING') as logs:
+            self.client.get(reverse('banklinemanager:index'))
+        self.assertIn("event=slow_request view=banklinemanager:index", logs.output[0])
+        self.assertIn("SELECT", logs.output[0])
+        self.assertIn("SELECT", get_stats().as_dict()['slow_requests'][0]['slowest_queries'][0]['sql'])
+
+    def test_unresolved_requests_and_query_formatting(self):
+        """Test that the requests matching no URL share one view, and only the slowest queries are formatted"""
+        for path in ("/wp-login.php", "/.env", "/admin/config.php"):
+            self.client.get(path)
+        self.assertEqual(list(get_stats().as_dict()['views']), [UNRESOLVED_VIEW])
+
+        recorder = RequestRecorder()
+        with mock.patch.object(RequestRecorder, '_with_params', side_effect=RequestRecorder._with_params) as with_params:
+            for i in range(20):
+                recorder(lambda sql, params, many, context: None, "SELECT %s", [i], False, {})
+            with_params.assert_not_called()
+            self.assertEqual(len(recorder.slowest_queries()), SLOWEST_QUERIES_KEPT)
+        self.assertEqual(with_params.call_count, SLOWEST_QUERIES_KEPT)
+
+    def test_import_stats(self):
+        """Test the phases of an import and the stats view, for staff only"""
+        BankLine.insert_data_from_ofxsgml(self.bank_smc, "<STMTTRN>\n<TRNTYPE>DEBIT\n<DTPOSTED>20180629\n"
+                                          "<TRNAMT>-4.40\n<FITID>instr1\n<NAME>test\n</STMTTRN>")
+        self.assertEqual(self.client.get(reverse('banklinemanager:instrumentation_stats')).status_code, 302)
+        self.user.is_staff = True
+        self.user.save()
+        record = self.client.get(reverse('banklinemanager:instrumentation_stats')).json()['imports'][-1]
+        self.assertEqual((record['label'], record['lines'], record['inserted']), ("ofxsgml smc test", 1, 1))
+        self.assertEqual({'parse_ms', 'dedup_ms', 'insert_ms', 'commit_ms', 'invalidate_ms'} - record.keys(), set())
+
+
+class ApiTestCase(PrepareDataTestCase):
+    """Class to test the JSON API"""
+    def test_api_banks(self):
+        """Test that the banks are listed with an ETag which gives a 304 while they do not change"""
+        response = self.client.get(reverse('banklinemanager:api_banks'))
+        self.assertEqual([(bank['name'], bank['account_number'], bank['datafile_format']) for bank in response.json()['results']],
+                         [("cepac test", 123456789, Bank.FORMAT_CSV), ("smc test", 987654321, Bank.FORMAT_OFX_SGML)])
+        response = self.client.get(reverse('banklinemanager:api_banks'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.bank_smc.name = "smc renamed"
+        self.bank_smc.save()
+        self.assertEqual(self.client.get(reverse('banklinemanager:api_banks'), HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_api_banklines_pages(self):
+        """Test that the lines are paginated by cursor with the selected fields only"""
+        response = self.client.get(reverse('banklinemanager:api_banklines'), {'limit': 1, 'fields': "wording,amount"})
+        data = response.json()
+        self.assertEqual(data['results'], [{'wording': "test debit", 'amount': "-200.00"}])
+        self.assertIsNone(data['previous'])
+        self.assertIn("limit=1", data['next'])
+        data = self.client.get(data['next']).json()
+        self.assertEqual(data['results'], [{'wording': "test128 credit", 'amount': "100.00"}])
+        self.assertIsNone(data['next'])
+        data = self.client.get(reverse('banklinemanager:api_banklines'), {'bank': self.bank_cepac.pk, 'sum_min': "50", 'sum_max': "150"}).json()
+        self.assertEqual([(line['transaction_number'], line['transaction_date'], line['bank_id']) for line in data['results']],
+                         [("15526026", "2018-03-01", self.bank_cepac.pk)])
+        self.assertEqual(self.client.get(reverse('banklinemanager:api_banklines'), {'fields': "wording,bank"}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('banklinemanager:api_banklines'), {'sum_min': "1.2.3"}).status_code, 400)
+
+    def test_api_banklines_conditional(self):
+        """Test the conditional GET of the lines: 304 until lines are imported, edited or deleted"""
+        url = reverse('banklinemanager:api_banklines')
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertEqual(response['Cache-Control'], "private, no-cache")
+        self.assertFalse(response.has_header('Last-Modified'))
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertNotEqual(self.client.get(url, {'limit': 1}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        bankline = BankLine.objects.get(transaction_number="541876454")
+        bankline.user_comment = "loyer"
+        bankline.save()
+        # changed in the same second as the first GET: If-Modified-Since alone must not give a 304
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag, HTTP_IF_MODIFIED_SINCE=http_date())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['user_comment'], "loyer")
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=http_date()).status_code, 200)
+
+        # read from the database: a deletion which invalidates no cache changes the ETag too
+        etag = response['ETag']
+        BankLine.objects.filter(transaction_number="15526026").delete()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_api_search(self):
+        """Test that the API search uses the filters of the search page and returns its totals"""
+        data = self.client.get(reverse('banklinemanager:api_search'), {'query': "test", 'type_search': "contains",
+                                                                       'fields': "transaction_number"}).json()
+        self.assertEqual(data['results'], [{'transaction_number': "541876454"}, {'transaction_number': "15526026"}])
+        self.assertEqual((data['totals']['count'], Decimal(data['totals']['total_debit']), Decimal(data['totals']['total_credit'])),
+                         (2, -200, 100))
+        self.assertIn("test", data['message'])
+        self.assertEqual(self.client.get(reverse('banklinemanager:api_search')).status_code, 400)
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('banklinemanager:api_search'), {'query': "test"}).status_code, 302)
+
+
+@unittest.skipUnless(analytics.analytics_available(), "NumPy is not installed")
+class AnalyticsTestCase(PrepareDataTestCase):
+    """Class to test the cash-flow statistics computed with NumPy"""
+    def setUp(self):
+        super().setUp()
+        self.outflow = BankLine.objects.create(transaction_date="2018-05-10", wording="test debit 2",
+                                               transaction_number="AN-1", debit=-50.0, credit=0.0, bank=self.bank_cepac)
+
+    def test_cashflow_statistics(self):
+        """Test the balance, monthly totals and averages, largest outflows and forecast of a bank"""
+        statistics, = analytics.cashflow_statistics(BankLine.objects.all(), top=5, forecast_months=3)
+        self.assertEqual(statistics['balance'], {'dates': ['2018-03-01', '2018-03-04', '2018-05-10'],
+                                                 'values': [100.0, -100.0, -150.0], 'min': -150.0, 'max': 100.0,
+                                                 'final': -150.0})
+        self.assertEqual([(month['month'], month['line_count'], month['net']) for month in statistics['months']],
+                         [('2018-03', 2, -100.0), ('2018-04', 0, 0.0), ('2018-05', 1, -50.0)])
+        self.assertEqual(statistics['monthly_average'], {'debit': -83.33, 'credit': 33.33, 'net': -50.0})
+        self.assertEqual([outflow['amount'] for outflow in statistics['largest_outflows']], [-200.0, -50.0])
+        self.assertEqual(statistics['largest_outflows'][1]['id'], self.outflow.pk)
+        self.assertEqual([(month['month'], month['net'], month['balance']) for month in statistics['forecast']],
+                         [('2018-06', 0.0, -150.0), ('2018-07', 25.0, -125.0), ('2018-08', 50.0, -75.0)])
+
+    def test_analytics_view_and_command(self):
+        """Test the JSON view with filters, and the command compared with the Python loop"""
+        response = self.client.get(reverse('banklinemanager:analytics'),
+                                   {'bank': self.bank_cepac.pk, 'date_end': "2018-03-31", 'top': 1})
+        statistics, = response.json()['banks']
+        self.assertEqual((statistics['name'], statistics['line_count']), ("cepac test", 2))
+        self.assertEqual(len(statistics['largest_outflows']), 1)
+        self.assertEqual(self.client.get(reverse('banklinemanager:analytics'), {'bank': self.bank_smc.pk}).json(),
+                         {'banks': []})
+
+        output = io.StringIO()
+        call_command('analytics', benchmark=True, stdout=output)
+        self.assertIn("cepac test : 3 lignes, solde -150.00", output.getvalue())
+        self.assertIn("résultats identiques", output.getvalue())
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', "EXPLAIN QUERY PLAN output is specific to SQLite")
+class QueryPlanTestCase(PrepareDataTestCase):
+    """Class to test that the search filters and the listing use an index"""
+    def query_plan(self, queryset):
+        """Return the steps of the SQLite query plan of queryset"""
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN %s" % (sql), params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertSearchUsesIndex(self, queryset):
+        """Assert that the bankline table is searched through an index, never scanned"""
+        plan = self.query_plan(queryset)
+        bankline_steps = [step for step in plan if "banklinemanager_bankline " in step]
+        self.assertTrue(bankline_steps, plan)
+        for step in bankline_steps:
+            self.assertTrue(step.startswith("SEARCH") and "INDEX" in step, plan)
+
+    def test_search_filters_use_index(self):
+        """Test the query plan of each common combination of search filters"""
+        filters = [
+            ("2018-03-01", "2018-03-31", None, None, None),
+            (None, None, "100", "5000", None),
+            (None, None, "-5000", "-100", None),
+            (None, None, None, None, self.bank_cepac.pk),
+            ("2018-03-01", "2018-03-31", None, None, self.bank_cepac.pk),
+            (None, None, "100", "5000", self.bank_cepac.pk),
+            ("2018-03-01", "2018-03-31", "100", "5000", None),
+            ("2018-03-01", "2018-03-31", "100", "5000", self.bank_cepac.pk),
+        ]
+        for date_start, date_end, sum_min, sum_max, bank_id in filters:
+            bankline_list, msg_search = BankLine.search_bankline(None, None, date_start, date_end, sum_min, sum_max, bank_id)
+            self.assertSearchUsesIndex(bankline_list)
+            self.assertSearchUsesIndex(bankline_list.order_by('-transaction_date', '-pk')[:101])
+
+    def test_listing_uses_index(self):
+        """Test that the listing pages read the bankline table in index order"""
+        paginator_queryset = BankLine.objects.select_related('bank').order_by('-transaction_date', '-pk')[:101]
+        plan = self.query_plan(paginator_queryset)
+        self.assertIn("SCAN banklinemanager_bankline USING INDEX bankline_date_id_idx", plan)
+        self.assertNotIn("USE TEMP B-TREE FOR ORDER BY", plan)
+        after_cursor = BankLine.objects.filter(transaction_date__lte="2018-03-04").order_by('-transaction_date', '-pk')[:101]
+        self.assertSearchUsesIndex(after_cursor)
+
+
+class SettingsTestCase(TestCase):
+    """Class to test the settings profiles and the tuning of the database connections"""
+    def load_settings(self, environ):
+        """Return the settings module reloaded with the PCFTOOLS_ variables of environ"""
+        from PcfToolsProject import settings as settings_module
+        environ = {key: value for key, value in os.environ.items() if not key.startswith('PCFTOOLS_')} | environ
+        try:
+            with mock.patch.dict(os.environ, environ, clear=True):
+                return vars(importlib.reload(settings_module)).copy()
+        finally:
+            importlib.reload(settings_module)
+
+    def test_profiles(self):
+        """Test the development and production settings, and the PostgreSQL switch"""
+        development = self.load_settings({})
+        self.assertTrue(development['DEBUG'])
+        self.assertIn('debug_toolbar', development['INSTALLED_APPS'])
+        self.assertEqual(development['BANKLINE_SQLITE_PRAGMAS'], {})
+        self.assertEqual(development['DATABASES']['default']['CONN_MAX_AGE'], 0)
+        self.assertEqual(development['BANKLINE_VALIDATION_WORKERS'], 0)
+
+        production = self.load_settings({'PCFTOOLS_PROFILE': "production", 'PCFTOOLS_SECRET_KEY': "secret",
+                                         'PCFTOOLS_ALLOWED_HOSTS': "pcf.example.org, 10.0.0.2"})
+        self.assertFalse(production['DEBUG'])
+        self.assertNotIn('debug_toolbar', production['INSTALLED_APPS'])
+        self.assertFalse([name for name in production['MIDDLEWARE'] if name.startswith('debug_toolbar')])
+        self.assertEqual(production['ALLOWED_HOSTS'], ["pcf.example.org", "10.0.0.2"])
+        self.assertEqual(production['DATABASES']['default']['CONN_MAX_AGE'], 600)
+        self.assertEqual(production['BANKLINE_SQLITE_PRAGMAS']['journal_mode'], 'WAL')
+
+        postgresql = self.load_settings({'PCFTOOLS_DB_ENGINE': "postgresql", 'PCFTOOLS_DB_NAME': "pcf",
+                                         'PCFTOOLS_CONN_MAX_AGE': "60"})
+        self.assertEqual((postgresql['DATABASES']['default']['ENGINE'], postgresql['DATABASES']['default']['NAME'],
+                          postgresql['DATABASES']['default']['CONN_MAX_AGE']), ('django.db.backends.postgresql', "pcf", 60))
+
+        for environ in ({'PCFTOOLS_PROFILE': "production"}, {'PCFTOOLS_DB_ENGINE': "mysql"}):
+            with self.assertRaises(ImproperlyConfigured):
+                self.load_settings(environ)
+
+    def test_sqlite_pragmas(self):
+        """Test that a new SQLite connection runs the pragmas of the production profile"""
+        pragmas = {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'mmap_size': 1024 * 1024, 'cache_size': -2000}
+        with tempfile.TemporaryDirectory() as directory, override_settings(BANKLINE_SQLITE_PRAGMAS=pragmas):
+            sqlite_connection = SqliteDatabaseWrapper(
+                dict(connection.settings_dict, NAME=os.path.join(directory, "pragmas.sqlite3")), 'pragmas')
+            try:
+                with sqlite_connection.cursor() as cursor:
+                    values = {}
+                    for name in pragmas:
+                        cursor.execute("PRAGMA %s" % (name))
+                        values[name] = cursor.fetchone()[0]
+            finally:
+                sqlite_connection.close()
+        # synchronous NORMAL is 1
+        self.assertEqual(values, {'journal_mode': 'wal', 'synchronous': 1, 'mmap_size': 1024 * 1024, 'cache_size': -2000})
+        with override_settings(BANKLINE_SQLITE_PRAGMAS={}), mock.patch.object(connection, 'cursor') as cursor:
+            configure_connection(None, connection)
+            cursor.assert_not_called()
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "The trigram index is specific to PostgreSQL")
+class PostgresqlTestCase(PrepareDataTestCase):
+    """Class to test the search on PostgreSQL (PCFTOOLS_DB_ENGINE=postgresql)"""
+    def test_trigram_index(self):
+        """Test that the keyword search finds its lines through the GIN trigram index"""
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT indexdef FROM pg_indexes WHERE indexname = %s", [TRIGRAM_INDEX])
+            self.assertIn("gin_trgm_ops", cursor.fetchone()[0])
+        banklines = BankLine.objects.filter(BankLine.keywords_filter(["detail"], "contains", False))
+        self.assertEqual(banklines.count(), 2)
+        sql, params = banklines.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            cursor.execute("EXPLAIN %s" % (sql), params)
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+        self.assertIn(TRIGRAM_INDEX, plan)
@@ -1,6 +1,6 @@
 from django.conf.urls import url
 
-from . import views
+from . import api, views
 
 app_name='banklinemanager'
 
@@ -8,6 +8,14 @@ app_name='banklinemanager'
 urlpatterns = [
     url(r'^$', views.index, name='index'),
     url(r'^import-data/$', views.import_data, name='import_data'),
+    url(r'^import-data/job/(?P<job_id>[0-9]+)/$', views.import_job_status, name='import_job_status'),
     url(r'^search/$', views.search, name='search'),
+    url(r'^search/export/$', views.export, name='export'),
+    url(r'^summary/$', views.summary, name='summary'),
+    url(r'^analytics/$', views.analytics_view, name='analytics'),
+    url(r'^stats/$', views.instrumentation_stats, name='instrumentation_stats'),
+    url(r'^api/banks/$', api.banks, name='api_banks'),
+    url(r'^api/banklines/$', api.banklines, name='api_banklines'),
+    url(r'^api/search/$', api.search, name='api_search'),
     #url(r'^(?P<album_id>[0-9]+)/$', views.detail, name='detail'),
 ]
\ No newline at end of file
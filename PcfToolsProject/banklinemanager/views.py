@@ -1,35 +1,79 @@
-import csv
-import io
-from decimal import Decimal
-
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required, permission_required
-from django.shortcuts import render
-from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
+from django.core.cache import cache
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, render
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.http import urlencode
 
-from .models import BankLine, Bank
+from . import analytics
+from .batch import ACCTID_SEARCH_SIZE, iter_zip_datafiles, resolve_bank
+from .exports import EXPORT_ENCODING, iter_csv_cepac, iter_ofxsgml
+from .instrumentation import get_stats
+from .jobs import submit_import_job
+from .models import BankLine, Bank, BankMonthSummary, ImportJob
+from .pagination import KeysetPaginator
+from . import search_cache
 from PcfToolsProject.Utils.utils import cleaned_data
 
+LISTING_PAGE_SIZE = 100
+SEARCH_PAGE_SIZE = 100
+# Rows of a search page rendered and sent at a time
+SEARCH_ROWS_CHUNK_SIZE = 50
+# Stands for the rows in the rendered search page, which are then streamed in its place
+BANKLINE_ROWS_MARKER = 'BANKLINE-ROWS-MARKER'
+IMPORT_JOBS_SHOWN = 20
+# The total number of banklines shown in the listing header is approximate: counted at most every 5 minutes
+BANKLINE_TOTAL_CACHE_KEY = 'banklinemanager:bankline_total'
+BANKLINE_TOTAL_CACHE_TIMEOUT = 300
+SEARCH_FILTERS = ('query', 'type_search', 'date_start', 'date_end', 'sum_min', 'sum_max', 'bank')
+EXPORT_FORMATS = {
+    'csv': (iter_csv_cepac, 'text/csv; charset=%s' % (EXPORT_ENCODING), 'csv'),
+    'ofx': (iter_ofxsgml, 'application/x-ofx', 'ofx'),
+}
+
+
+def search_filters(data):
+    ''' Return the cleaned search filters of the POST or GET data, in the order of search_bankline arguments. '''
+    return {search_filter: cleaned_data(data.get(search_filter)) for search_filter in SEARCH_FILTERS}
+
+
+def render_streaming_rows(request, template_name, context, bankline_list):
+    ''' Return a StreamingHttpResponse of template_name whose table rows (list_rows.html) are rendered and sent
+    by chunks of SEARCH_ROWS_CHUNK_SIZE after the top of the page, instead of rendering the whole page at once. '''
+    page_head, page_tail = render_to_string(template_name, dict(context, bankline_rows_marker=BANKLINE_ROWS_MARKER),
+                                            request).split(BANKLINE_ROWS_MARKER, 1)
+
+    def iter_page():
+        yield page_head
+        banklines = list(bankline_list or [])
+        for start in range(0, len(banklines), SEARCH_ROWS_CHUNK_SIZE):
+            yield render_to_string('banklinemanager/list_rows.html',
+                                   {'bankline_list': banklines[start:start + SEARCH_ROWS_CHUNK_SIZE]})
+        yield page_tail
+
+    return StreamingHttpResponse(iter_page())
+
+
 @login_required
 @permission_required('banklinemanager.can_list')
 def index(request):
-    ''' Show page with all elements of BankLine segmented by page'''
+    ''' Show page with all elements of BankLine segmented by page, from the most recent transaction.
+    Pages are selected by the cursor of their neighbour page (GET after or before), not by number. '''
     list_message = []
-    bankline_list = BankLine.objects.all().order_by('-transaction_date').select_related('bank')
+    paginator = KeysetPaginator(BankLine.objects.select_related('bank', 'category'), LISTING_PAGE_SIZE)
+    bankline_list = paginator.page(after=request.GET.get('after'), before=request.GET.get('before'))
 
-    if len(bankline_list) > 0:
-        paginator = Paginator(bankline_list, 100)
-        page = request.GET.get('page')
-        try:
-            bankline_list = paginator.page(page)
-        except PageNotAnInteger:
-            bankline_list = paginator.page(1)
-        except EmptyPage:
-            bankline_list = paginator.page(paginator.num_pages)
-    else:
+    if len(bankline_list) == 0 and (request.GET.get('after') or request.GET.get('before')):
+        # cursor past the end of the list: go back to the first page
+        bankline_list = paginator.page()
+    if len(bankline_list) == 0:
         list_message.append("Aucune donnée présente.")
 
     context = {
         'bankline_list': bankline_list,
+        'bankline_total': cache.get_or_set(BANKLINE_TOTAL_CACHE_KEY, BankLine.objects.count, BANKLINE_TOTAL_CACHE_TIMEOUT),
         'paginate': True,
         'list_message': list_message
     }
@@ -38,95 +82,192 @@ def index(request):
 @login_required
 @permission_required('banklinemanager.can_search')
 def search(request):
-    ''' Get the query and filters then show page with result of query'''
-    msg_search = ""
+    ''' Get the query and filters (GET, or POST) then show page with result of query: a page of banklines,
+    from the most recent, selected by the cursor of its neighbour page (GET after or before) as in the listing,
+    and the totals of all results. Both are computed by the database or read from the search cache
+    (see search_cache.py). The rows are streamed by chunks. '''
     list_message = []
-    total_credit = 0
-    total_debit = 0
-    bank_id = cleaned_data(request.POST.get('bank'))
-    sum_min = cleaned_data(request.POST.get('sum_min'))
-    sum_max = cleaned_data(request.POST.get('sum_max'))
-    date_start = cleaned_data(request.POST.get('date_start'))
-    date_end = cleaned_data(request.POST.get('date_end'))
-    type_search = cleaned_data(request.POST.get('type_search'))
-    query = cleaned_data(request.POST.get('query'))
-
-    bankline_list, msg_search = BankLine.search_bankline(query, type_search, date_start, date_end, sum_min, sum_max, bank_id)
-
-    if bankline_list and len(bankline_list) > 0:
+    filters = search_filters(request.POST if request.method == 'POST' else request.GET)
+    bank_id = filters['bank']
+    sum_min = filters['sum_min']
+    sum_max = filters['sum_max']
+    date_start = filters['date_start']
+    date_end = filters['date_end']
+    type_search = filters['type_search']
+    query = filters['query']
+    after = request.GET.get('after')
+    before = request.GET.get('before')
+
+    def compute_search():
+        bankline_list, msg_search = BankLine.search_bankline(query, type_search, date_start, date_end, sum_min, sum_max, bank_id)
+        totals = BankLine.search_totals(bankline_list) if bankline_list is not None else {}
+        if totals and totals['count'] > 0:
+            paginator = KeysetPaginator(bankline_list, SEARCH_PAGE_SIZE)
+            bankline_list = paginator.page(after=after, before=before)
+            if len(bankline_list) == 0:
+                # cursor past the end of the results: go back to the first page
+                bankline_list = paginator.page()
+        else:
+            bankline_list = None
+        return bankline_list, msg_search, totals
+
+    bankline_list, msg_search, totals = search_cache.get_or_compute(
+        search_cache.normalize_filters(query, type_search, date_start, date_end, sum_min, sum_max, bank_id) + (after, before),
+        compute_search)
+
+    if bankline_list is not None:
         list_message.append(msg_search)
-        list_message.append("%s résultat trouvé(s)" % (len(bankline_list)))
-        for bankline in bankline_list:
-            total_credit += bankline.credit
-            total_debit += bankline.debit
+        list_message.append("%s résultat trouvé(s)" % (totals['count']))
     elif query or date_start or sum_min or bank_id:
         list_message.append(msg_search)
         list_message.append("Aucun résultat trouvé pour %s" % (query))
 
+    search_query = urlencode({key: value for key, value in filters.items() if value})
     banks = Bank.objects.all()
     context = {
         'bankline_list': bankline_list,
         'list_message': list_message,
-        'total_credit' : total_credit,
-        'total_debit' : total_debit,
+        'total_credit' : totals.get('total_credit', 0),
+        'total_debit' : totals.get('total_debit', 0),
+        'bank_totals': totals.get('banks', []),
+        'filters': filters,
+        'pager_query': search_query + "&" if search_query else "",
         'banks': banks
     }
-    return render(request, 'banklinemanager/search.html', context)
+    return render_streaming_rows(request, 'banklinemanager/search.html', context, bankline_list)
+
+@login_required
+@permission_required('banklinemanager.can_search')
+def export(request):
+    ''' Stream the banklines matching the search filters (GET, same as the search page) as a datafile:
+    format=csv for the CEPAC CSV layout (default), format=ofx for OFX SGML. '''
+    if request.GET.get('format', 'csv') not in EXPORT_FORMATS:
+        raise Http404("Format d'export inconnu.")
+    iter_datafile, content_type, extension = EXPORT_FORMATS[request.GET.get('format', 'csv')]
+    filters = search_filters(request.GET)
+    bankline_list = BankLine.search_bankline(
+        filters['query'], filters['type_search'], filters['date_start'], filters['date_end'],
+        filters['sum_min'], filters['sum_max'], filters['bank'])[0]
+    if bankline_list is None:
+        bankline_list = BankLine.objects.all()
+
+    response = StreamingHttpResponse(iter_datafile(bankline_list.order_by('transaction_date', 'pk')),
+                                     content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="export_%s.%s"' % (
+        timezone.now().strftime('%Y%m%d_%H%M%S'), extension)
+    return response
+
+@login_required
+@permission_required('banklinemanager.can_list')
+def summary(request):
+    ''' Show the monthly and yearly totals of each bank (GET bank and year to filter) with the running balance,
+    read from BankMonthSummary only: the cost depends on the number of months, not of banklines. '''
+    list_message = []
+    summaries = BankMonthSummary.objects.select_related('bank')
+    bank_id = request.GET.get('bank')
+    if bank_id and bank_id.isdigit():
+        bank_id = int(bank_id)
+        summaries = summaries.filter(bank=bank_id)
+    else:
+        bank_id = None
+    year = request.GET.get('year')
+    year = int(year) if year and year.isdigit() else None
+
+    # the running balance of a month includes all the previous months of its bank, even before year
+    month_summaries = []
+    running_balances = {}
+    for month_summary in summaries:
+        running_balances[month_summary.bank_id] = running_balances.get(month_summary.bank_id, 0) + month_summary.balance
+        month_summary.running_balance = running_balances[month_summary.bank_id]
+        month_summaries.append(month_summary)
+    years = sorted({month_summary.month.year for month_summary in month_summaries})
+    if year is not None:
+        month_summaries = [month_summary for month_summary in month_summaries if month_summary.month.year == year]
+    if not month_summaries:
+        list_message.append("Aucune donnée présente.")
+
+    context = {
+        'month_summaries': month_summaries,
+        'year_summaries': BankMonthSummary.yearly(month_summaries),
+        'years': years,
+        'year': year,
+        'bank_id': bank_id,
+        'banks': Bank.objects.all(),
+        'list_message': list_message
+    }
+    return render(request, 'banklinemanager/summary.html', context)
 
 @login_required
 @permission_required('banklinemanager.can_import')
 def import_data(request):
-    ''' View to import data from csv file. this function read csv file and call BankLine.insert_data_from_csv
-    to import in database. At the end, show page with csv import result.
-    '''
+    ''' View to import data from datafiles. Each uploaded file, or each file of an uploaded zip archive, is queued
+    as an ImportJob imported in background (see jobs.py), so the page returns immediately and shows the progress
+    of the last imports. With detect_bank, a file goes to the bank found from its content or name (see batch.py). '''
     list_message = []
     list_message_error = []
-    line_counter = 0
-    inserted_line_counter = 0
 
     # check method POST and file imported
-    if request.method == 'POST' and request.FILES["csv_file"] is not None:
-
+    if request.method == 'POST' and request.FILES.getlist("csv_file"):
         try:
             bank_id = request.POST.get('bank')
             bank = Bank.objects.get(pk=bank_id)
 
-            file_uploaded = request.FILES['csv_file'].read()
-            decoded_file = file_uploaded.decode('latin-1') #utf-8
-            io_string = io.StringIO(decoded_file)
-
-            #if bank.name.lower().startswith("csv cepac"):
-            if bank.get_datafile_format == Bank.FORMAT_OFX_SGML:
-                # Call BankLine.insert_data_from_ofx to import each line data
-                line_counter, inserted_line_counter, message_error_lines = BankLine.insert_data_from_ofxsgml(bank, io_string.getvalue())
-                list_message_error.extend(message_error_lines)
-            elif bank.get_datafile_format == Bank.FORMAT_CSV:
-                csv_file = csv.reader(io_string, delimiter=';', quotechar='|')
-                # Call BankLine.insert_data_from_csv to import each line data
-                line_counter, inserted_line_counter, message_error_lines = BankLine.insert_data_from_csv_cepac(bank, csv_file)
-                list_message_error.extend(message_error_lines)
-            elif bank.get_datafile_format == Bank.FORMAT_OFX_XML:
-                # (not yet defined) maybe in future version 
-                list_message_error.append("Ce compte bancaire est prévu pour importer un fichier %s. \
-                    Ce type de fichier n est pas encore géré par cette application." % (Bank.FORMAT_OFX_XML))
-
-        except csv.Error as e:
-            list_message_error.append("-> Le fichier n'a pas été importé  -- ERREUR csv.Error lors de l import datas")
-            list_message_error.append("--> ERREUR csv.Error = file %s, line %d: %s" % (request.FILES['csv_file'], csv_file.line_num, e))
-        except Exception as e:
-            list_message_error.append("-> Le fichier n'a pas été importé  -- file %s, %s" % (request.FILES['csv_file'], e))
-        else:
-            io_string.close()
-            list_message.append("-> imports des données OK")
-        finally:
-            list_message.append("-> %s lignes sur %s ont été importés." % (inserted_line_counter, line_counter))
+            account_banks = {account_bank.get_account_number: account_bank for account_bank in Bank.objects.all()}
+
+            for uploaded_file in request.FILES.getlist('csv_file'):
+                if uploaded_file.name.lower().endswith('.zip'):
+                    # each file of the archive is decompressed while it is copied for its import job
+                    datafiles = iter_zip_datafiles(uploaded_file)
+                else:
+                    datafiles = [uploaded_file]
+                for datafile in datafiles:
+                    datafile_bank = bank
+                    if request.POST.get('detect_bank'):
+                        head = next(datafile.chunks(ACCTID_SEARCH_SIZE), b"")
+                        datafile_bank = resolve_bank(datafile.name, head, account_banks) or bank
+                    job = submit_import_job(datafile_bank, datafile)
+                    list_message.append("-> Import du fichier %s lancé sur le compte %s." % (job.file_name, datafile_bank))
 
+        except Exception as e:
+            list_message_error.append("-> Le fichier n'a pas été importé  -- %s" % (e))
 
-    # show page with csv import result
+    # show page with the progress of the last imports
     banks = Bank.objects.all()
     context = {
         'list_message': list_message,
         'list_message_error': list_message_error,
+        'import_jobs': ImportJob.objects.select_related('bank')[:IMPORT_JOBS_SHOWN],
         'banks': banks
     }
     return render(request, 'banklinemanager/import_data.html', context)
+
+@login_required
+@permission_required('banklinemanager.can_import')
+def import_job_status(request, job_id):
+    ''' Return in JSON the status, counters and messages of an ImportJob, polled by the import page. '''
+    job = get_object_or_404(ImportJob.objects.select_related('bank'), pk=job_id)
+    return JsonResponse(job.as_dict())
+
+@login_required
+@permission_required('banklinemanager.can_list')
+def analytics_view(request):
+    ''' Return in JSON the cash-flow statistics of each bank (see analytics.py): running balance, monthly totals
+    and averages, largest outflows and forecast. GET bank, date_start and date_end filter the lines, top is the
+    number of largest outflows and months the number of forecast months. '''
+    if not analytics.analytics_available():
+        return JsonResponse({'error': "Les statistiques nécessitent NumPy, qui n'est pas installé."}, status=501)
+    bank_id = request.GET.get('bank')
+    top = request.GET.get('top', "")
+    months = request.GET.get('months', "")
+    banklines = analytics.filter_banklines(int(bank_id) if bank_id and bank_id.isdigit() else None,
+                                           request.GET.get('date_start'), request.GET.get('date_end'))
+    statistics = analytics.cashflow_statistics(
+        banklines, top=min(int(top), 100) if top.isdigit() else analytics.LARGEST_OUTFLOWS,
+        forecast_months=min(int(months), 24) if months.isdigit() else analytics.FORECAST_MONTHS)
+    return JsonResponse({'banks': analytics.with_bank_names(statistics)})
+
+@staff_member_required
+def instrumentation_stats(request):
+    ''' Return in JSON the rolling stats of this process: recent and slow requests with their SQL, mean values per
+    view and the phases of the last imports (see instrumentation.py). '''
+    return JsonResponse(get_stats().as_dict())